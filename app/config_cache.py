@@ -0,0 +1,113 @@
+import os
+import time
+from threading import Lock
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Configurations
+
+# Intervalo mínimo entre verificações da versão no banco (mudanças feitas por outros workers)
+CONFIG_CHECK_INTERVAL_SECONDS = float(
+    os.getenv("CONFIG_CHECK_INTERVAL_SECONDS", "5"))
+
+TIPOS_DOCUMENTO = ("xml", "imagem", "pdf")
+
+
+def tipo_do_documento(content_type: str) -> str | None:
+    if content_type in ["text/xml", "application/xml"]:
+        return "xml"
+    if content_type.startswith("image/"):
+        return "imagem"
+    if content_type == "application/pdf":
+        return "pdf"
+    return None
+
+
+class ConfigCache:
+    """
+    Prompts da tabela `configurations` mantidos em memória.
+
+    Cada alteração grava um novo valor do contador global `versao`. Em vez de ler os
+    prompts a cada extração, o cache consulta apenas `max(versao)` no máximo uma vez a
+    cada CONFIG_CHECK_INTERVAL_SECONDS e recarrega tudo quando ela muda.
+    """
+
+    def __init__(self):
+        self.versao = -1
+        self._prompts: dict[str | None, tuple[str, int]] = {}
+        self._verificado_em = 0.0
+        self._lock = Lock()
+
+    async def carregar(self, session: AsyncSession):
+        prompts = {}
+        versao = 0
+        for config in await session.scalars(select(Configurations)):
+            if not config.prompt:
+                continue
+            prompts[config.tipo_documento or None] = (config.prompt, config.versao or 0)
+            versao = max(versao, config.versao or 0)
+
+        with self._lock:
+            self._prompts = prompts
+            self.versao = versao
+            self._verificado_em = time.monotonic()
+
+    async def _atualizar_se_necessario(self, session: AsyncSession):
+        if time.monotonic() - self._verificado_em < CONFIG_CHECK_INTERVAL_SECONDS:
+            return
+        versao = await session.scalar(select(func.max(Configurations.versao))) or 0
+        if versao != self.versao:
+            await self.carregar(session)
+        else:
+            self._verificado_em = time.monotonic()
+
+    async def prompt_para(self, session: AsyncSession, tipo: str | None) -> tuple[str | None, int]:
+        """
+        Retorna (prompt, versao) do tipo de documento, caindo para o prompt geral.
+        Sem prompt configurado retorna (None, 0) e o prompt padrão do código é usado.
+        """
+        await self._atualizar_se_necessario(session)
+        prompts = self._prompts
+        return prompts.get(tipo) or prompts.get(None) or (None, 0)
+
+    async def obter(self, session: AsyncSession, tipo: str | None) -> Configurations | None:
+        return await session.scalar(select(Configurations).filter(
+            Configurations.tipo_documento.is_(None) if tipo is None
+            else Configurations.tipo_documento == tipo
+        ).order_by(Configurations.id).limit(1))
+
+    async def vigente(self, session: AsyncSession, tipo: str | None) -> Configurations | None:
+        """
+        Configuração em uso para o tipo: a do próprio tipo, senão a geral. Sem prompt geral,
+        a consulta sem tipo devolve o primeiro prompt por tipo cadastrado.
+        """
+        config = await self.obter(session, tipo) if tipo else None
+        config = config or await self.obter(session, None)
+        if config is None and tipo is None:
+            config = await session.scalar(select(Configurations).filter(
+                Configurations.prompt.is_not(None)).order_by(Configurations.id).limit(1))
+        return config
+
+    async def gravar(self, session: AsyncSession, prompt: str, tipo: str | None) -> tuple[Configurations, bool]:
+        """
+        Grava o prompt (write-through) com uma nova versão.
+        Retorna (configuração, alterou).
+        """
+        config = await self.obter(session, tipo)
+        if config and config.prompt == prompt:
+            return config, False
+
+        if config is None:
+            config = Configurations(tipo_documento=tipo)
+            session.add(config)
+        config.prompt = prompt
+        config.versao = (await session.scalar(select(func.max(Configurations.versao))) or 0) + 1
+        await session.commit()
+        await session.refresh(config)
+
+        await self.carregar(session)
+        return config, True
+
+
+config_cache = ConfigCache()
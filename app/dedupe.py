@@ -0,0 +1,211 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.executor import image_pool
+from app.hash_util import PHASH_BITS, gerar_hash_perceptual
+from app.ingest import UploadSpool
+from app.log_config import logger
+from app.models import Invoice
+
+# Possíveis duplicatas: imagens cujo pHash difere em até PHASH_DISTANCIA_MAXIMA dos PHASH_BITS bits
+PHASH_ENABLED = os.getenv("PHASH_ENABLED", "true").lower() == "true"
+PHASH_DISTANCIA_MAXIMA = int(os.getenv("PHASH_DISTANCIA_MAXIMA", "8"))
+# Ids relidos abaixo do último já lido: transações concorrentes podem confirmar fora de ordem
+PHASH_JANELA_RELEITURA = int(os.getenv("PHASH_JANELA_RELEITURA", "200"))
+
+
+class HashIndex:
+    """
+    Cache em memória hash -> id da nota fiscal.
+
+    A fonte da verdade continua sendo a coluna única `Invoice.imagem_hash`: o cache
+    só guarda hashes já confirmados no banco e é validado a cada acerto, de modo que
+    uma nota removida por outro processo nunca é devolvida.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._ids: OrderedDict[str, int] = OrderedDict()
+        self._lock = Lock()
+
+    async def buscar(self, session: AsyncSession, hash_value: str) -> Invoice | None:
+        """
+        Retorna a nota já cadastrada com o hash informado, ou None.
+        """
+        with self._lock:
+            invoice_id = self._ids.get(hash_value)
+            if invoice_id is not None:
+                self._ids.move_to_end(hash_value)
+
+        if invoice_id is not None:
+            invoice = await session.get(Invoice, invoice_id)
+            if invoice is not None and invoice.imagem_hash == hash_value:
+                return invoice
+            self.remover(hash_value)
+
+        invoice = await session.scalar(select(Invoice).filter_by(
+            imagem_hash=hash_value).limit(1))
+        if invoice is not None:
+            self.registrar(hash_value, invoice.id)
+        return invoice
+
+    def registrar(self, hash_value: str | None, invoice_id: int):
+        if not hash_value:
+            return
+        with self._lock:
+            self._ids[hash_value] = invoice_id
+            self._ids.move_to_end(hash_value)
+            while len(self._ids) > self.max_entries:
+                self._ids.popitem(last=False)
+
+    def remover(self, hash_value: str | None):
+        if not hash_value:
+            return
+        with self._lock:
+            self._ids.pop(hash_value, None)
+
+
+hash_index = HashIndex()
+
+
+class BKTree:
+    """
+    Árvore BK sobre a distância de Hamming: cada filho fica na aresta da sua distância
+    ao pai e, pela desigualdade triangular, a busca por raio r só desce pelas arestas
+    entre d - r e d + r, visitando uma pequena parte dos hashes.
+    """
+
+    def __init__(self):
+        self._raiz: tuple[int, dict] | None = None
+        self.tamanho = 0
+
+    def adicionar(self, valor: int):
+        if self._raiz is None:
+            self._raiz = (valor, {})
+            self.tamanho = 1
+            return
+        no = self._raiz
+        while True:
+            distancia = (valor ^ no[0]).bit_count()
+            if distancia == 0:
+                return
+            filho = no[1].get(distancia)
+            if filho is None:
+                no[1][distancia] = (valor, {})
+                self.tamanho += 1
+                return
+            no = filho
+
+    def buscar(self, valor: int, raio: int) -> list[tuple[int, int]]:
+        """
+        Retorna (distância, valor) dos hashes a até `raio` bits, do mais próximo ao mais distante.
+        """
+        encontrados = []
+        pendentes = [self._raiz] if self._raiz else []
+        while pendentes:
+            atual, filhos = pendentes.pop()
+            distancia = (valor ^ atual).bit_count()
+            if distancia <= raio:
+                encontrados.append((distancia, atual))
+            pendentes.extend(filho for aresta, filho in filhos.items()
+                             if distancia - raio <= aresta <= distancia + raio)
+        return sorted(encontrados)
+
+
+class PerceptualIndex:
+    """
+    Índice em memória dos hashes perceptuais das notas (BK-tree) para achar imagens
+    quase iguais (recompressão, outra resolução, nova foto da mesma nota) sem varrer a tabela.
+
+    As notas gravadas por outros processos entram na próxima busca (leitura incremental
+    por id, relendo os últimos PHASH_JANELA_RELEITURA ids); como no HashIndex, cada acerto
+    é confirmado no banco, e ids de notas removidas são descartados.
+    """
+
+    def __init__(self, distancia_maxima: int = PHASH_DISTANCIA_MAXIMA):
+        self.distancia_maxima = distancia_maxima
+        self._arvore = BKTree()
+        self._ids: dict[int, set[int]] = {}
+        self._ultimo_id = 0
+
+    async def atualizar(self, session: AsyncSession):
+        linhas = await session.execute(
+            select(Invoice.id, Invoice.imagem_phash)
+            .where(Invoice.id > self._ultimo_id - PHASH_JANELA_RELEITURA,
+                   Invoice.imagem_phash.is_not(None))
+            .order_by(Invoice.id))
+        for linha in linhas:
+            self.registrar(linha.imagem_phash, linha.id)
+            self._ultimo_id = max(self._ultimo_id, linha.id)
+
+    def registrar(self, phash: str | None, invoice_id: int):
+        """
+        Adiciona o hash ao índice. Não avança a leitura incremental: uma nota gravada
+        aqui pode ter id maior que o de notas de outros processos ainda não lidas.
+        """
+        if not phash:
+            return
+        valor = int(phash, 16)
+        if valor not in self._ids:
+            self._arvore.adicionar(valor)
+        self._ids.setdefault(valor, set()).add(invoice_id)
+
+    async def buscar(self, session: AsyncSession, phash: str) -> tuple[Invoice, int] | None:
+        """
+        Retorna (nota, distância) da nota cadastrada com a imagem mais parecida, ou None.
+        """
+        await self.atualizar(session)
+        for distancia, valor in self._arvore.buscar(int(phash, 16), self.distancia_maxima):
+            for invoice_id in sorted(self._ids.get(valor, ())):
+                invoice = await session.get(Invoice, invoice_id)
+                if invoice is not None and invoice.imagem_phash and int(invoice.imagem_phash, 16) == valor:
+                    return invoice, distancia
+                self._ids[valor].discard(invoice_id)
+        return None
+
+
+perceptual_index = PerceptualIndex()
+
+
+async def buscar_duplicada(session: AsyncSession, documento: UploadSpool) -> Invoice | None:
+    """
+    Nota já cadastrada com o mesmo arquivo (MD5).
+    """
+    return await hash_index.buscar(session, documento.hash)
+
+
+async def buscar_semelhante(session: AsyncSession, documento: UploadSpool) -> Invoice | None:
+    """
+    Para imagens, nota já cadastrada com uma imagem quase igual (pHash). Calcula
+    `documento.phash`, gravado junto com a nota nova.
+
+    Não é uma duplicata certa: notas do mesmo modelo que só diferem em uma ou duas linhas
+    (outro valor, outra data) também ficam próximas. A nota nova é extraída e gravada
+    normalmente, marcada com `possivel_duplicada` para revisão.
+    """
+    if not PHASH_ENABLED or not documento.content_type.startswith("image/"):
+        return None
+    if documento.phash is None:
+        documento.phash = await image_pool.run(gerar_hash_perceptual, documento.abrir())
+    if documento.phash is None:
+        return None
+
+    semelhante = await perceptual_index.buscar(session, documento.phash)
+    if semelhante is None:
+        return None
+    invoice, distancia = semelhante
+    logger.info(f"Imagem {documento.hash} semelhante à nota {invoice.id} "
+                f"(distância {distancia}/{PHASH_BITS})")
+    return invoice
+
+
+def registrar_invoice(invoice: Invoice):
+    """
+    Registra uma nota recém-gravada nos índices de duplicidade.
+    """
+    hash_index.registrar(invoice.imagem_hash, invoice.id)
+    perceptual_index.registrar(invoice.imagem_phash, invoice.id)
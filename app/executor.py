@@ -0,0 +1,123 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+# Limites configuráveis via variáveis de ambiente
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "32"))
+MISTRAL_MAX_CONCURRENCY = int(os.getenv("MISTRAL_MAX_CONCURRENCY", "16"))
+
+# Todos os limitadores criados, na ordem de criação (usado em executor_metrics)
+LIMITERS = []
+IMAGE_MAX_WORKERS = int(
+    os.getenv("IMAGE_MAX_WORKERS", str(os.cpu_count() or 2)))
+
+
+class ConcurrencyLimiter:
+    """
+    Limita quantas chamadas assíncronas de um mesmo tipo ficam em execução.
+
+    Chamadas além do limite aguardam na fila do semáforo sem bloquear o event loop;
+    o tamanho dessa fila é exposto em `metrics()`.
+    """
+
+    def __init__(self, nome: str, limite: int):
+        self.nome = nome
+        self.limite = limite
+        self._semaforo = asyncio.Semaphore(limite)
+        self.em_fila = 0
+        self.em_execucao = 0
+        self.pico_fila = 0
+        self.concluidas = 0
+        self.falhas = 0
+        LIMITERS.append(self)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Aguarda uma vaga e executa a corrotina `func(*args, **kwargs)`.
+        """
+        async with self.vaga():
+            return await self._executar(func, *args, **kwargs)
+
+    @asynccontextmanager
+    async def vaga(self):
+        """
+        Ocupa uma vaga durante o bloco (ex.: enquanto uma resposta em streaming é lida).
+        """
+        self.em_fila += 1
+        self.pico_fila = max(self.pico_fila, self.em_fila)
+        try:
+            await self._semaforo.acquire()
+        finally:
+            self.em_fila -= 1
+
+        self.em_execucao += 1
+        try:
+            yield
+        except Exception:
+            self.falhas += 1
+            raise
+        finally:
+            self.em_execucao -= 1
+            self._semaforo.release()
+
+        self.concluidas += 1
+
+    async def _executar(self, func, *args, **kwargs):
+        return await func(*args, **kwargs)
+
+    def metrics(self) -> dict:
+        return {
+            "nome": self.nome,
+            "limite": self.limite,
+            "em_execucao": self.em_execucao,
+            "em_fila": self.em_fila,
+            "pico_fila": self.pico_fila,
+            "concluidas": self.concluidas,
+            "falhas": self.falhas,
+        }
+
+
+class BlockingPool(ConcurrencyLimiter):
+    """
+    Executa funções bloqueantes (ex.: pytesseract) em um pool de threads limitado.
+    """
+
+    def __init__(self, nome: str, workers: int):
+        super().__init__(nome, workers)
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=nome)
+
+    async def _executar(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ProcessPool(BlockingPool):
+    """
+    Pool de processos para trabalho CPU-bound. O `initializer` roda uma vez em cada
+    processo, o que permite manter recursos caros (ex.: engine do Tesseract) aquecidos.
+    """
+
+    def __init__(self, nome: str, workers: int, initializer=None, initargs=()):
+        ConcurrencyLimiter.__init__(self, nome, workers)
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=initializer,
+            initargs=initargs,
+        )
+
+
+gemini_limiter = ConcurrencyLimiter("gemini", GEMINI_MAX_CONCURRENCY)
+mistral_limiter = ConcurrencyLimiter("mistral", MISTRAL_MAX_CONCURRENCY)
+image_pool = BlockingPool("imagem", IMAGE_MAX_WORKERS)
+
+
+def executor_metrics() -> list[dict]:
+    return [limiter.metrics() for limiter in LIMITERS]
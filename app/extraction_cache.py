@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import time
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import ExtractionCache
+
+# Limites configuráveis via variáveis de ambiente
+EXTRACTION_CACHE_MAX_ENTRIES = int(
+    os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", "5000"))
+EXTRACTION_CACHE_TTL_SECONDS = int(
+    os.getenv("EXTRACTION_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+# O horário de acesso (LRU) só é regravado quando tem mais que isso: um acerto comum não escreve no banco
+EXTRACTION_CACHE_ACESSO_SECONDS = int(
+    os.getenv("EXTRACTION_CACHE_ACESSO_SECONDS", "3600"))
+# Expirados e excedentes são removidos a cada N gravações (o limite pode ser ultrapassado em até N)
+EXTRACTION_CACHE_LIMPEZA_GRAVACOES = int(
+    os.getenv("EXTRACTION_CACHE_LIMPEZA_GRAVACOES", "100"))
+
+# Campos do JSON retornado pelo modelo que são guardados no cache
+CAMPOS = ("cnpj", "data", "valor", "tipo_despesa", "explicacao")
+
+
+def gerar_chave(hash_value: str, prompt: str, modelo: str) -> str:
+    """
+    Gera a chave do cache a partir do conteúdo, do prompt e do modelo usados.
+    """
+    base = "\0".join([hash_value, prompt, modelo])
+    return hashlib.sha256(base.encode("utf-8")).hexdigest()
+
+
+class ExtractionResultCache:
+    """
+    Cache persistente (tabela `extraction_cache`) do JSON extraído pelo LLM.
+
+    O resultado de uma extração depende apenas do conteúdo do arquivo, do prompt e do
+    modelo. Entradas expiram após `ttl_seconds` e, acima de `max_entries`, as menos
+    acessadas recentemente são removidas (LRU). O horário de acesso tem resolução de
+    `acesso_seconds` e a limpeza roda a cada `limpeza_gravacoes` gravações.
+    """
+
+    def __init__(self, max_entries: int = EXTRACTION_CACHE_MAX_ENTRIES,
+                 ttl_seconds: int = EXTRACTION_CACHE_TTL_SECONDS,
+                 acesso_seconds: int = EXTRACTION_CACHE_ACESSO_SECONDS,
+                 limpeza_gravacoes: int = EXTRACTION_CACHE_LIMPEZA_GRAVACOES):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.acesso_seconds = acesso_seconds
+        self.limpeza_gravacoes = max(1, limpeza_gravacoes)
+        self._gravacoes = 0
+
+    async def buscar(self, session: AsyncSession, hash_value: str, prompt: str, modelo: str) -> dict | None:
+        """
+        Retorna o JSON extraído anteriormente ou None se não houver entrada válida.
+        """
+        chave = gerar_chave(hash_value, prompt, modelo)
+        entrada = await session.scalar(
+            select(ExtractionCache).filter_by(chave=chave).limit(1))
+        if entrada is None:
+            return None
+
+        agora = time.time()
+        if agora - entrada.criado_em > self.ttl_seconds:
+            await session.delete(entrada)
+            await session.commit()
+            return None
+
+        if agora - (entrada.acessado_em or 0) > self.acesso_seconds:
+            entrada.acessado_em = agora
+            await session.commit()
+        return json.loads(entrada.resultado)
+
+    async def gravar(self, session: AsyncSession, hash_value: str, prompt: str, modelo: str, json_data: dict):
+        """
+        Grava o resultado de uma extração e aplica os limites de TTL e tamanho.
+        """
+        agora = time.time()
+        resultado = {campo: json_data.get(campo) for campo in CAMPOS}
+        session.add(ExtractionCache(
+            chave=gerar_chave(hash_value, prompt, modelo),
+            imagem_hash=hash_value,
+            modelo=modelo,
+            resultado=json.dumps(resultado, ensure_ascii=False),
+            criado_em=agora,
+            acessado_em=agora,
+        ))
+        try:
+            await session.commit()
+        except IntegrityError:
+            # Mesma extração gravada em paralelo por outra requisição
+            await session.rollback()
+            return
+
+        self._gravacoes += 1
+        if self._gravacoes % self.limpeza_gravacoes == 0:
+            await self._remover_excedentes(session, agora)
+
+    async def invalidar(self, session: AsyncSession) -> int:
+        """
+        Remove todas as entradas (ex.: quando o prompt de extração muda).
+        O commit fica a cargo de quem chama.
+        """
+        resultado = await session.execute(delete(ExtractionCache))
+        return resultado.rowcount
+
+    async def _remover_excedentes(self, session: AsyncSession, agora: float):
+        await session.execute(delete(ExtractionCache).where(
+            ExtractionCache.criado_em < agora - self.ttl_seconds))
+
+        total = await session.scalar(select(func.count()).select_from(ExtractionCache))
+        excedente = total - self.max_entries
+        if excedente > 0:
+            antigos = (
+                select(ExtractionCache.id)
+                .order_by(ExtractionCache.acessado_em.asc())
+                .limit(excedente)
+                .subquery()
+            )
+            await session.execute(delete(ExtractionCache).where(
+                ExtractionCache.id.in_(antigos.select())))
+        await session.commit()
+
+
+extraction_cache = ExtractionResultCache()
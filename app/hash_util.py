@@ -1,6 +1,24 @@
 import hashlib
 import io
-from typing import Union
+import math
+from typing import BinaryIO, Union
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from app.image_preprocess import corrigir_inclinacao, recortar_fundo, recortar_tinta
+
+# pHash: DCT da imagem reduzida a PHASH_LADO x PHASH_LADO; as PHASH_FREQUENCIAS² frequências
+# mais baixas, sem o termo constante, geram PHASH_BITS bits
+PHASH_LADO = 32
+PHASH_FREQUENCIAS = 12
+PHASH_BITS = PHASH_FREQUENCIAS ** 2 - 1
+# Resolução em que o JPEG é decodificado para o hash
+PHASH_DECODIFICACAO = 1024
+
+# Cossenos da DCT-II: _COSSENOS[u][x] = cos(pi * (2x + 1) * u / 2N)
+_COSSENOS = [[math.cos(math.pi * (2 * x + 1) * u / (2 * PHASH_LADO)) for x in range(PHASH_LADO)]
+             for u in range(PHASH_FREQUENCIAS)]
+
 
 def gerar_hash_imagem(image_data: Union[bytes, io.BytesIO]) -> str:
     """
@@ -26,4 +44,52 @@ def gerar_hash_imagem(image_data: Union[bytes, io.BytesIO]) -> str:
     md5_hash = hashlib.md5(bytes_to_hash)
     
     # Retorna o hash em formato hexadecimal
-    return md5_hash.hexdigest()
\ No newline at end of file
+    return md5_hash.hexdigest()
+
+
+def gerar_hash_perceptual(stream: BinaryIO) -> str | None:
+    """
+    Gera o pHash (hash perceptual pela DCT) de PHASH_BITS bits de uma imagem.
+
+    A imagem em tons de cinza tem o fundo recortado, a inclinação corrigida e é recortada
+    ao retângulo da impressão antes de ser reduzida a PHASH_LADO x PHASH_LADO; cada bit
+    indica se um coeficiente de baixa frequência da DCT está acima da mediana deles.
+    Recompressão, mudança de resolução ou de brilho, margens e fundo ao redor da nota e uma
+    inclinação de até ~2° alteram poucos bits, ao contrário do MD5. Recortes que cortam a
+    impressão não são tolerados: mudam o enquadramento de todo o conteúdo.
+
+    Args:
+        stream: O arquivo da imagem.
+
+    Returns:
+        O hash em hexadecimal, ou None se o arquivo não for uma imagem legível.
+    """
+    try:
+        image = Image.open(stream)
+        # JPEG: decodifica já em escala reduzida, sem carregar a resolução original
+        image.draft("L", (PHASH_DECODIFICACAO, PHASH_DECODIFICACAO))
+        image = ImageOps.exif_transpose(image)
+        image = recortar_fundo(image.convert("L"), margem=0)
+        image = recortar_tinta(corrigir_inclinacao(image))
+        pixels = image.resize((PHASH_LADO, PHASH_LADO), Image.LANCZOS).tobytes()
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
+
+    # DCT separável: primeiro nas linhas, depois nas colunas, só até PHASH_FREQUENCIAS
+    linhas = [[sum(c * p for c, p in zip(cossenos, pixels[y * PHASH_LADO:(y + 1) * PHASH_LADO]))
+               for cossenos in _COSSENOS] for y in range(PHASH_LADO)]
+    coeficientes = [sum(_COSSENOS[v][y] * linhas[y][u] for y in range(PHASH_LADO))
+                    for v in range(PHASH_FREQUENCIAS) for u in range(PHASH_FREQUENCIAS)][1:]
+    mediana = sorted(coeficientes)[len(coeficientes) // 2]
+
+    valor = 0
+    for coeficiente in coeficientes:
+        valor = (valor << 1) | (coeficiente > mediana)
+    return f"{valor:0{(PHASH_BITS + 3) // 4}x}"
+
+
+def distancia_hamming(hash_a: str, hash_b: str) -> int:
+    """
+    Quantidade de bits diferentes entre dois hashes perceptuais.
+    """
+    return (int(hash_a, 16) ^ int(hash_b, 16)).bit_count()
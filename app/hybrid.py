@@ -0,0 +1,179 @@
+import os
+import re
+import unicodedata
+from datetime import date, datetime
+
+# Configuração do fluxo híbrido (OCR local antes do modelo)
+HIBRIDO_ENABLED = os.getenv("HIBRIDO_ENABLED", "true").lower() == "true"
+HIBRIDO_CONFIANCA_MINIMA = float(os.getenv("HIBRIDO_CONFIANCA_MINIMA", "1.0"))
+
+CNPJ_REGEX = re.compile(r"\d{2}[.,\s]?\d{3}[.,\s]?\d{3}\s?/?\s?\d{4}\s?-?\s?\d{2}")
+DATA_REGEX = re.compile(r"\b(\d{2})[/.-](\d{2})[/.-](\d{4}|\d{2})\b")
+VALOR_REGEX = re.compile(r"\d{1,3}(?:[.\s]\d{3})*,\d{2}|\d+\.\d{2}\b")
+
+# Rótulos do valor total, em ordem de prioridade (o valor pago vence o total bruto).
+# O lookbehind evita que "TOTAL" case com "SUBTOTAL".
+ROTULOS_VALOR = tuple(re.compile(r"(?<![A-Z])" + re.escape(rotulo)) for rotulo in (
+    "VALOR A PAGAR", "TOTAL A PAGAR", "VALOR PAGO", "VALOR TOTAL", "TOTAL R$", "TOTAL"))
+
+PALAVRAS_DESPESA = {
+    "VEICULO": ("GASOLINA", "ETANOL", "DIESEL", "COMBUSTIVEL", "LUBRIFICANTE", "PNEU",
+                "ESTACIONAMENTO", "PEDAGIO", "POSTO"),
+    "ALIMENTACAO": ("RESTAURANTE", "LANCHONETE", "LANCHE", "REFEICAO", "ALIMENTACAO",
+                    "PADARIA", "PIZZARIA", "CAFE", "REFRIGERANTE", "MARMITA"),
+    "ESCRITORIO": ("PAPELARIA", "CANETA", "PAPEL A4", "SULFITE", "TONER", "CARTUCHO",
+                   "GRAMPEADOR", "CADERNO", "ENVELOPE"),
+}
+
+CAMPOS_OBRIGATORIOS = ("cnpj", "data", "valor")
+
+
+def _normalizar(texto: str) -> str:
+    sem_acento = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode()
+    return sem_acento.upper()
+
+
+def validar_cnpj(cnpj: str) -> bool:
+    """
+    Valida os dois dígitos verificadores de um CNPJ (com ou sem pontuação).
+    """
+    digitos = re.sub(r"\D", "", cnpj)
+    if len(digitos) != 14 or digitos == digitos[0] * 14:
+        return False
+
+    def digito(base: str, pesos: list[int]) -> str:
+        resto = sum(int(d) * p for d, p in zip(base, pesos)) % 11
+        return "0" if resto < 2 else str(11 - resto)
+
+    pesos = [5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2]
+    return digitos[12] == digito(digitos[:12], pesos) and \
+        digitos[13] == digito(digitos[:13], [6] + pesos)
+
+
+def encontrar_cnpj(texto: str) -> str | None:
+    """
+    Primeiro CNPJ válido do texto (o do emitente costuma vir no topo do cupom).
+    """
+    for candidato in CNPJ_REGEX.findall(texto):
+        digitos = re.sub(r"\D", "", candidato)
+        if validar_cnpj(digitos):
+            return digitos
+    return None
+
+
+def encontrar_data(texto: str) -> str | None:
+    """
+    Data de emissão em DD/MM/AAAA. Datas em linhas com "EMISS" têm preferência.
+    """
+    candidatas = []
+    for linha in _normalizar(texto).splitlines():
+        for dia, mes, ano in DATA_REGEX.findall(linha):
+            ano = ano if len(ano) == 4 else f"20{ano}"
+            try:
+                valor = datetime.strptime(f"{dia}/{mes}/{ano}", "%d/%m/%Y").date()
+            except ValueError:
+                continue
+            if valor > date.today():
+                continue
+            candidatas.append(("EMISS" not in linha, valor.strftime("%d/%m/%Y")))
+    if not candidatas:
+        return None
+    return min(candidatas, key=lambda c: c[0])[1]
+
+
+def _to_float(valor: str) -> float | None:
+    valor = valor.replace(" ", "")
+    if "," in valor:
+        valor = valor.replace(".", "").replace(",", ".")
+    try:
+        return float(valor)
+    except ValueError:
+        return None
+
+
+def encontrar_valor(texto: str) -> float | None:
+    """
+    Valor total a partir das linhas rotuladas (VALOR A PAGAR, VALOR TOTAL, TOTAL...).
+    Quando a linha do rótulo não tem valor, usa a linha seguinte.
+    """
+    linhas = _normalizar(texto).splitlines()
+    for rotulo in ROTULOS_VALOR:
+        for i, linha in enumerate(linhas):
+            encontrado = rotulo.search(linha)
+            if not encontrado:
+                continue
+            valores = VALOR_REGEX.findall(linha[encontrado.end():])
+            if not valores and i + 1 < len(linhas):
+                valores = VALOR_REGEX.findall(linhas[i + 1])
+            if valores:
+                return _to_float(valores[-1])
+    return None
+
+
+def classificar_despesa(texto: str) -> str | None:
+    normalizado = _normalizar(texto)
+    contagem = {
+        tipo: sum(normalizado.count(palavra) for palavra in palavras)
+        for tipo, palavras in PALAVRAS_DESPESA.items()
+    }
+    tipo, ocorrencias = max(contagem.items(), key=lambda par: par[1])
+    return tipo if ocorrencias else None
+
+
+def extrair_campos(texto: str) -> tuple[dict, float]:
+    """
+    Extrai CNPJ, data, valor e tipo de despesa do texto do OCR por regras.
+
+    Retorna (json_data, confianca); a confiança é a fração dos campos obrigatórios
+    encontrados (o CNPJ só conta com dígitos verificadores válidos).
+    """
+    json_data = {
+        "cnpj": encontrar_cnpj(texto),
+        "data": encontrar_data(texto),
+        "valor": encontrar_valor(texto),
+        "tipo_despesa": classificar_despesa(texto) or "",
+        "explicacao": "Extraído do OCR local por regras.",
+    }
+    encontrados = sum(json_data[campo] is not None for campo in CAMPOS_OBRIGATORIOS)
+    return json_data, encontrados / len(CAMPOS_OBRIGATORIOS)
+
+
+def campos_faltando(json_data: dict) -> list[str]:
+    faltando = [campo for campo in CAMPOS_OBRIGATORIOS
+                if json_data.get(campo) in (None, "")]
+    if not json_data.get("tipo_despesa"):
+        faltando.append("tipo_despesa")
+    return faltando
+
+
+class HybridMetrics:
+    """
+    Quantas extrações cada etapa resolveu: regras sobre o OCR, LLM só texto e visão.
+    """
+
+    ETAPAS = ("ocr_regras", "llm_texto", "visao")
+
+    def __init__(self):
+        self.total = 0
+        self.falhas_ocr = 0
+        self.resolvidas = {etapa: 0 for etapa in self.ETAPAS}
+
+    def registrar(self, etapa: str):
+        self.total += 1
+        self.resolvidas[etapa] += 1
+
+    def metrics(self) -> dict:
+        return {
+            "total": self.total,
+            "falhas_ocr": self.falhas_ocr,
+            "etapas": {
+                etapa: {
+                    "resolvidas": resolvidas,
+                    "taxa": resolvidas / self.total if self.total else 0.0,
+                }
+                for etapa, resolvidas in self.resolvidas.items()
+            },
+        }
+
+
+hybrid_metrics = HybridMetrics()
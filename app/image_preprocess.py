@@ -0,0 +1,207 @@
+import io
+import math
+import os
+from typing import BinaryIO
+
+from PIL import Image, ImageChops, ImageFilter, ImageOps, UnidentifiedImageError
+
+from app.log_config import logger
+
+# Parâmetros configuráveis via variáveis de ambiente
+PREPROCESS_ENABLED = os.getenv("PREPROCESS_ENABLED", "true").lower() == "true"
+PREPROCESS_MAX_EDGE = int(os.getenv("PREPROCESS_MAX_EDGE", "2000"))
+PREPROCESS_OCR_MAX_EDGE = int(os.getenv("PREPROCESS_OCR_MAX_EDGE", "3000"))
+PREPROCESS_GRAYSCALE = os.getenv("PREPROCESS_GRAYSCALE", "true").lower() == "true"
+PREPROCESS_FORMAT = os.getenv("PREPROCESS_FORMAT", "JPEG").upper()  # JPEG ou WEBP
+PREPROCESS_QUALITY = int(os.getenv("PREPROCESS_QUALITY", "80"))
+
+# Recorte automático: diferença mínima em relação ao fundo e área mínima preservada
+LIMIAR_FUNDO = 40
+AREA_MINIMA_RECORTE = 0.2
+MARGEM_RECORTE = 10
+
+# Correção de inclinação: ângulos testados (em graus) e lado da miniatura usada na busca
+INCLINACAO_MAXIMA = 5.0
+INCLINACAO_PASSO = 0.5
+INCLINACAO_REFINO = 0.1
+INCLINACAO_LADO = 300
+# Recorte pela impressão: pixels mais escuros que FRACAO_TINTA do brilho mediano
+FRACAO_TINTA = 0.5
+TINTA_LADO = 400
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+class PreprocessMetrics:
+    def __init__(self):
+        self.imagens = 0
+        self.bytes_originais = 0
+        self.bytes_finais = 0
+
+    def registrar(self, original: int, final: int):
+        self.imagens += 1
+        self.bytes_originais += original
+        self.bytes_finais += final
+
+    def metrics(self) -> dict:
+        return {
+            "imagens": self.imagens,
+            "bytes_originais": self.bytes_originais,
+            "bytes_finais": self.bytes_finais,
+            "economia_bytes": self.bytes_originais - self.bytes_finais,
+        }
+
+
+preprocess_metrics = PreprocessMetrics()
+
+
+def recortar_fundo(image: Image.Image, margem: int = MARGEM_RECORTE) -> Image.Image:
+    """
+    Recorta as bordas com a cor de fundo (mesa, margem de captura de tela) ao redor da nota,
+    mantendo `margem` pixels do fundo. A cor de fundo é estimada pelos cantos; recortes
+    pequenos demais são ignorados.
+    """
+    cinza = image.convert("L")
+    largura, altura = cinza.size
+    cantos = sorted(cinza.getpixel(p) for p in [
+        (0, 0), (largura - 1, 0), (0, altura - 1), (largura - 1, altura - 1)])
+    fundo = (cantos[1] + cantos[2]) // 2
+
+    diferenca = ImageChops.difference(cinza, Image.new("L", cinza.size, fundo))
+    mascara = diferenca.point(lambda p: 255 if p > LIMIAR_FUNDO else 0)
+    bbox = mascara.getbbox()
+    if not bbox:
+        return image
+
+    esquerda, topo, direita, base = bbox
+    if (direita - esquerda) * (base - topo) < AREA_MINIMA_RECORTE * largura * altura:
+        return image
+
+    return image.crop((
+        max(esquerda - margem, 0),
+        max(topo - margem, 0),
+        min(direita + margem, largura),
+        min(base + margem, altura),
+    ))
+
+
+def angulo_inclinacao(image: Image.Image) -> float:
+    """
+    Ângulo (em graus, até INCLINACAO_MAXIMA) que deixa as linhas de texto na horizontal.
+
+    Com o texto alinhado, o perfil de brilho das linhas alterna entre linhas de texto e
+    entrelinhas; o ângulo escolhido é o que maximiza essa variação na região central da
+    imagem (as bordas mudam com a rotação e com recortes). Busca em passos de
+    INCLINACAO_PASSO, refinada em passos de INCLINACAO_REFINO.
+    """
+    miniatura = image.convert("L")
+    miniatura.thumbnail((INCLINACAO_LADO, INCLINACAO_LADO))
+    invertida = ImageOps.invert(miniatura)
+    largura, altura = invertida.size
+    centro = (largura * 15 // 100, altura * 15 // 100, largura * 85 // 100, altura * 85 // 100)
+
+    def variacao(angulo: float) -> float:
+        regiao = invertida.rotate(angulo, resample=Image.BILINEAR).crop(centro)
+        perfil = regiao.resize((1, regiao.height), Image.BOX).tobytes()
+        return sum((b - a) ** 2 for a, b in zip(perfil, perfil[1:]))
+
+    passos = round(INCLINACAO_MAXIMA / INCLINACAO_PASSO)
+    angulo = max((i * INCLINACAO_PASSO for i in range(-passos, passos + 1)), key=variacao)
+    passos = round(INCLINACAO_PASSO / INCLINACAO_REFINO)
+    return max((angulo + i * INCLINACAO_REFINO for i in range(1 - passos, passos)), key=variacao)
+
+
+def corrigir_inclinacao(image: Image.Image) -> Image.Image:
+    """
+    Gira a imagem (em tons de cinza) para deixar as linhas de texto na horizontal.
+    """
+    angulo = angulo_inclinacao(image)
+    if abs(angulo) < INCLINACAO_REFINO / 2:
+        return image
+    return image.rotate(angulo, resample=Image.BICUBIC, expand=True, fillcolor=255)
+
+
+def recortar_tinta(image: Image.Image) -> Image.Image:
+    """
+    Recorta a imagem (em tons de cinza) ao retângulo que contém a impressão, descartando
+    margens em branco de qualquer largura. A detecção é feita em uma miniatura.
+    """
+    miniatura = image.copy()
+    miniatura.thumbnail((TINTA_LADO, TINTA_LADO))
+    mediana = sorted(miniatura.tobytes())[miniatura.width * miniatura.height // 2]
+    limiar = mediana * FRACAO_TINTA
+    mascara = miniatura.point(lambda p: 255 if p < limiar else 0)
+    # Sem a linha de pixels da borda (o contorno borrado do papel depois de recortar_fundo);
+    # MaxFilter: ignora pontos isolados de ruído da compressão
+    mascara = mascara.crop((1, 1, mascara.width - 1, mascara.height - 1))
+    mascara = mascara.filter(ImageFilter.MaxFilter(3))
+    bbox = mascara.getbbox()
+    if not bbox:
+        return image
+
+    escala_x = image.width / miniatura.width
+    escala_y = image.height / miniatura.height
+    esquerda, topo, direita, base = (valor + 1 for valor in bbox)
+    return image.crop((int(esquerda * escala_x), int(topo * escala_y),
+                       math.ceil(direita * escala_x), math.ceil(base * escala_y)))
+
+
+def preparar_imagem(stream: BinaryIO, max_edge: int = PREPROCESS_MAX_EDGE) -> Image.Image:
+    """
+    Abre a imagem e aplica rotação EXIF, recorte do fundo, redução do maior lado para
+    `max_edge` e conversão para tons de cinza.
+    """
+    image = Image.open(stream)
+    image = ImageOps.exif_transpose(image)
+    image = recortar_fundo(image)
+
+    if max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    if PREPROCESS_GRAYSCALE:
+        image = image.convert("L")
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    return image
+
+
+def preprocessar_para_modelo(stream: BinaryIO, tamanho_original: int,
+                             content_type: str) -> tuple[bytes | None, str]:
+    """
+    Prepara a imagem para o modelo de visão e a recodifica em PREPROCESS_FORMAT.
+
+    Retorna (bytes, mime_type). Retorna (None, content_type) quando o pré-processamento
+    está desativado, a imagem não pode ser lida ou o resultado não é menor que o original.
+    """
+    if not PREPROCESS_ENABLED:
+        return None, content_type
+
+    try:
+        image = preparar_imagem(stream)
+    except (UnidentifiedImageError, OSError) as e:
+        logger.warning(f"Pré-processamento ignorado: {e}")
+        return None, content_type
+
+    formato = PREPROCESS_FORMAT if PREPROCESS_FORMAT in MIME_TYPES else "JPEG"
+    saida = io.BytesIO()
+    image.save(saida, format=formato, quality=PREPROCESS_QUALITY, optimize=True)
+    tamanho_final = saida.tell()
+
+    if tamanho_final >= tamanho_original:
+        preprocess_metrics.registrar(tamanho_original, tamanho_original)
+        return None, content_type
+
+    preprocess_metrics.registrar(tamanho_original, tamanho_final)
+    logger.info(
+        f"Imagem pré-processada: {tamanho_original} -> {tamanho_final} bytes "
+        f"({1 - tamanho_final / tamanho_original:.0%} menor, {image.size[0]}x{image.size[1]})")
+    return saida.getvalue(), MIME_TYPES[formato]
+
+
+def preprocessar_para_ocr(stream: BinaryIO) -> Image.Image:
+    """
+    Prepara a imagem para o Tesseract (sem recodificação).
+    """
+    if not PREPROCESS_ENABLED:
+        return Image.open(stream)
+    return preparar_imagem(stream, PREPROCESS_OCR_MAX_EDGE)
@@ -0,0 +1,124 @@
+import hashlib
+import io
+import os
+import tempfile
+from typing import BinaryIO
+
+from fastapi import HTTPException, UploadFile
+
+from app.hash_util import gerar_hash_imagem
+
+# Limites configuráveis via variáveis de ambiente
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+SPOOL_MAX_MEMORY_BYTES = int(
+    os.getenv("SPOOL_MAX_MEMORY_BYTES", str(1024 * 1024)))
+
+# Tamanho dos blocos lidos ao calcular o hash
+CHUNK_SIZE = 64 * 1024
+
+
+def _erro_tamanho(max_bytes: int) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"O arquivo excede o limite de {max_bytes / (1024 * 1024):.1f} MB.",
+    )
+
+
+class UploadSpool:
+    """
+    Documento recebido, guardado uma única vez (memória ou arquivo temporário),
+    com o hash MD5 calculado durante a leitura.
+
+    Leitores que aceitam streams (parser de NF-e, Pillow, zipfile) usam `abrir()`;
+    o conteúdo completo só é carregado em memória, uma vez, quando `conteudo()` é chamado.
+    """
+
+    def __init__(self, nome: str | None, content_type: str, stream: BinaryIO,
+                 tamanho: int, hash_value: str, proprio: bool = False):
+        self.nome = nome
+        self.content_type = content_type
+        self.tamanho = tamanho
+        self.hash = hash_value
+        self.phash: str | None = None  # hash perceptual, calculado na checagem de duplicidade
+        self._stream = stream
+        self._proprio = proprio
+        self._conteudo: bytes | None = None
+
+    @classmethod
+    def de_bytes(cls, nome: str | None, content_type: str, data: bytes) -> "UploadSpool":
+        spool = cls(nome, content_type, io.BytesIO(data), len(data),
+                    gerar_hash_imagem(data), proprio=True)
+        spool._conteudo = data
+        return spool
+
+    def abrir(self) -> BinaryIO:
+        self._stream.seek(0)
+        return self._stream
+
+    def conteudo(self) -> bytes:
+        if self._conteudo is None:
+            self._conteudo = self.abrir().read()
+        return self._conteudo
+
+    def texto(self) -> str:
+        return self.conteudo().decode("utf-8", errors="ignore")
+
+    def fechar(self):
+        self._conteudo = None
+        if self._proprio:
+            self._stream.close()
+
+
+def receber_stream(nome: str | None, content_type: str, stream: BinaryIO,
+                   max_bytes: int = MAX_UPLOAD_BYTES) -> UploadSpool:
+    """
+    Copia um stream (ex.: entrada de um .zip) em blocos para um arquivo temporário
+    próprio, calculando o hash e interrompendo a leitura ao exceder `max_bytes`.
+    """
+    md5_hash = hashlib.md5()
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY_BYTES)
+    tamanho = 0
+
+    while chunk := stream.read(CHUNK_SIZE):
+        tamanho += len(chunk)
+        if tamanho > max_bytes:
+            spool.close()
+            raise _erro_tamanho(max_bytes)
+        md5_hash.update(chunk)
+        spool.write(chunk)
+
+    return UploadSpool(nome, content_type, spool, tamanho, md5_hash.hexdigest(), proprio=True)
+
+
+async def receber_upload(file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES,
+                         manter: bool = False) -> UploadSpool:
+    """
+    Lê o UploadFile em blocos, atualizando o hash MD5 e validando o tamanho máximo.
+
+    Por padrão o documento continua no arquivo temporário do próprio upload (sem cópia).
+    Com `manter=True` os bytes são copiados para um spool próprio, que sobrevive ao
+    fechamento do upload pelo FastAPI (ex.: respostas em streaming).
+    """
+    content_type = (file.content_type or "").lower()
+    if file.size is not None and file.size > max_bytes:
+        raise _erro_tamanho(max_bytes)
+
+    await file.seek(0)
+    md5_hash = hashlib.md5()
+    spool = tempfile.SpooledTemporaryFile(
+        max_size=SPOOL_MAX_MEMORY_BYTES) if manter else None
+    tamanho = 0
+
+    while chunk := await file.read(CHUNK_SIZE):
+        tamanho += len(chunk)
+        if tamanho > max_bytes:
+            if spool:
+                spool.close()
+            raise _erro_tamanho(max_bytes)
+        md5_hash.update(chunk)
+        if spool:
+            spool.write(chunk)
+
+    if spool:
+        return UploadSpool(file.filename, content_type, spool, tamanho, md5_hash.hexdigest(), proprio=True)
+    return UploadSpool(file.filename, content_type, file.file, tamanho, md5_hash.hexdigest())
@@ -0,0 +1,132 @@
+import os
+
+from fastapi import HTTPException
+from sqlalchemy import delete, or_, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.dedupe import hash_index
+from app.invoice_query import filtrar_invoices
+from app.models import Invoice
+from app.schemas import InvoiceLoteRequest, InvoiceStatusRequest, InvoiceVersao
+
+STATUS_INVOICE = ("PENDENTE", "CHECKING", "PROCESSADO")
+
+# Ids por comando UPDATE/DELETE (limite de parâmetros por instrução do banco)
+INVOICES_LOTE_IDS = int(os.getenv("INVOICES_LOTE_IDS", "1000"))
+
+
+def validar_status(status: list[str]):
+    invalidos = [item for item in status if item not in STATUS_INVOICE]
+    if invalidos:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Status inválido: {', '.join(invalidos)}. Use {', '.join(STATUS_INVOICE)}.",
+        )
+
+
+def condicao_notas(notas: list[InvoiceVersao]):
+    """
+    `id IN (...)` para as notas sem versão e `(id, versao) IN (...)` para as demais:
+    uma nota alterada desde a leitura não é afetada.
+    """
+    sem_versao = [nota.id for nota in notas if nota.versao is None]
+    com_versao = [(nota.id, nota.versao) for nota in notas if nota.versao is not None]
+    condicoes = []
+    if sem_versao:
+        condicoes.append(Invoice.id.in_(sem_versao))
+    if com_versao:
+        condicoes.append(tuple_(Invoice.id, Invoice.versao).in_(com_versao))
+    return or_(*condicoes)
+
+
+def lotes_de_notas(pedido: InvoiceLoteRequest) -> list[list[InvoiceVersao]]:
+    if not pedido.notas and pedido.filtro is None:
+        raise HTTPException(status_code=400, detail="Informe `notas` ou `filtro`.")
+    if pedido.notas and pedido.filtro is not None:
+        raise HTTPException(status_code=400, detail="Informe `notas` ou `filtro`, não ambos.")
+    if pedido.filtro is not None:
+        if not pedido.filtro.model_dump(exclude_none=True):
+            raise HTTPException(status_code=400, detail="O filtro precisa de ao menos um campo.")
+        return []
+    # Id repetido: vale a última ocorrência
+    notas = list({nota.id: nota for nota in pedido.notas}.values())
+    return [notas[i:i + INVOICES_LOTE_IDS] for i in range(0, len(notas), INVOICES_LOTE_IDS)]
+
+
+async def executar_em_lote(session: AsyncSession, comando, pedido: InvoiceLoteRequest) -> dict:
+    """
+    Aplica o UPDATE/DELETE às notas do pedido, um comando por INVOICES_LOTE_IDS ids (ou
+    um só para o filtro), em uma transação. Retorna id -> (id, versao, imagem_hash) das
+    notas afetadas, lidos pelo RETURNING.
+    """
+    if pedido.origem:
+        validar_status(pedido.origem)
+        comando = comando.where(Invoice.status.in_(pedido.origem))
+    comando = comando.returning(Invoice.id, Invoice.versao, Invoice.imagem_hash)
+    comando = comando.execution_options(synchronize_session=False)
+
+    lotes = lotes_de_notas(pedido)
+    afetadas = {}
+    if pedido.filtro is not None:
+        filtrado = filtrar_invoices(comando, **pedido.filtro.model_dump())
+        for linha in await session.execute(filtrado):
+            afetadas[linha.id] = linha
+    for notas in lotes:
+        for linha in await session.execute(comando.where(condicao_notas(notas))):
+            afetadas[linha.id] = linha
+    await session.commit()
+    return afetadas
+
+
+async def responder_lote(session: AsyncSession, pedido: InvoiceLoteRequest, afetadas: dict,
+                         total: str, resultado: str) -> dict:
+    """
+    Resultado de cada nota: as afetadas e, para as pedidas por id que não foram, o motivo.
+    """
+    resultados = [{"id": id, "resultado": resultado, "versao": linha.versao}
+                  for id, linha in afetadas.items()]
+    for notas in lotes_de_notas(pedido):
+        resultados += await motivos_nao_afetadas(
+            session, [nota for nota in notas if nota.id not in afetadas], pedido.origem)
+    return {
+        total: len(afetadas),
+        "nao_afetadas": len(resultados) - len(afetadas),
+        "resultados": resultados,
+    }
+
+
+async def motivos_nao_afetadas(session: AsyncSession, notas: list[InvoiceVersao],
+                               origem: list[str] | None) -> list[dict]:
+    if not notas:
+        return []
+    atuais = {
+        linha.id: linha for linha in await session.execute(
+            select(Invoice.id, Invoice.status, Invoice.versao)
+            .where(Invoice.id.in_([nota.id for nota in notas])))
+    }
+    resultados = []
+    for nota in notas:
+        atual = atuais.get(nota.id)
+        if atual is None:
+            resultados.append({"id": nota.id, "resultado": "nao_encontrada"})
+        elif origem and atual.status not in origem:
+            resultados.append({"id": nota.id, "resultado": "status_invalido",
+                               "status": atual.status, "versao": atual.versao})
+        else:
+            resultados.append({"id": nota.id, "resultado": "conflito",
+                               "status": atual.status, "versao": atual.versao})
+    return resultados
+
+
+async def alterar_status(session: AsyncSession, pedido: InvoiceStatusRequest) -> dict:
+    validar_status([pedido.status])
+    comando = update(Invoice).values(status=pedido.status, versao=Invoice.versao + 1)
+    afetadas = await executar_em_lote(session, comando, pedido)
+    return await responder_lote(session, pedido, afetadas, "atualizadas", "atualizada")
+
+
+async def remover(session: AsyncSession, pedido: InvoiceLoteRequest) -> dict:
+    afetadas = await executar_em_lote(session, delete(Invoice), pedido)
+    for linha in afetadas.values():
+        hash_index.remover(linha.imagem_hash)
+    return await responder_lote(session, pedido, afetadas, "removidas", "removida")
@@ -0,0 +1,161 @@
+import csv
+import io
+import json
+import os
+from typing import AsyncIterator
+
+from fastapi import HTTPException
+from sqlalchemy import BigInteger, Date, Integer, Select
+
+from app.database import SessionLocal
+from app.models import Invoice
+
+# Linhas lidas do cursor do banco (yield_per) e escritas por pedaço da resposta
+EXPORT_LOTE = int(os.getenv("EXPORT_LOTE", "5000"))
+
+FORMATOS_EXPORTACAO = ("csv", "ndjson", "parquet")
+
+
+class ExportadorCsv:
+    media_type = "text/csv; charset=utf-8"
+
+    def __init__(self, campos: list[str]):
+        self.campos = campos
+
+    def _escrever(self, linhas) -> bytes:
+        saida = io.StringIO()
+        csv.writer(saida).writerows(linhas)
+        return saida.getvalue().encode("utf-8")
+
+    def inicio(self) -> bytes:
+        return self._escrever([self.campos])
+
+    def lote(self, linhas: list) -> bytes:
+        return self._escrever(linhas)
+
+    def fim(self) -> bytes:
+        return b""
+
+
+class ExportadorNdjson:
+    media_type = "application/x-ndjson"
+
+    def __init__(self, campos: list[str]):
+        self.campos = campos
+
+    def inicio(self) -> bytes:
+        return b""
+
+    def lote(self, linhas: list) -> bytes:
+        return "".join(
+            json.dumps(dict(zip(self.campos, linha)), ensure_ascii=False, default=str) + "\n"
+            for linha in linhas
+        ).encode("utf-8")
+
+    def fim(self) -> bytes:
+        return b""
+
+
+class _SaidaIncremental:
+    """
+    Arquivo somente de escrita para o ParquetWriter: guarda os bytes até `retirar()`
+    mantendo a posição absoluta (usada nos offsets do rodapé do Parquet).
+    """
+
+    def __init__(self):
+        self._partes: list[bytes] = []
+        self._posicao = 0
+        self.closed = False
+
+    def write(self, dados) -> int:
+        dados = bytes(dados)
+        self._partes.append(dados)
+        self._posicao += len(dados)
+        return len(dados)
+
+    def tell(self) -> int:
+        return self._posicao
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def retirar(self) -> bytes:
+        dados = b"".join(self._partes)
+        self._partes = []
+        return dados
+
+
+class ExportadorParquet:
+    """
+    Um row group por lote, enviado assim que é escrito; só o rodapé fica para o fim.
+    Requer o pacote `pyarrow`.
+    """
+    media_type = "application/vnd.apache.parquet"
+
+    def __init__(self, campos: list[str]):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise HTTPException(
+                status_code=400,
+                detail="Exportação em parquet requer o pacote pyarrow instalado no servidor.",
+            )
+        self.pa = pa
+        self.campos = campos
+        self.schema = pa.schema([(campo, self._tipo(campo)) for campo in campos])
+        self.saida = _SaidaIncremental()
+        self.writer = pq.ParquetWriter(self.saida, self.schema, compression="snappy")
+
+    def _tipo(self, campo: str):
+        tipo = Invoice.__table__.columns[campo].type
+        if isinstance(tipo, (Integer, BigInteger)):
+            return self.pa.int64()
+        if isinstance(tipo, Date):
+            return self.pa.date32()
+        return self.pa.string()
+
+    def inicio(self) -> bytes:
+        return self.saida.retirar()
+
+    def lote(self, linhas: list) -> bytes:
+        colunas = list(zip(*linhas))
+        self.writer.write_table(self.pa.Table.from_arrays(
+            [self.pa.array(coluna, type=self.schema.field(i).type) for i, coluna in enumerate(colunas)],
+            schema=self.schema,
+        ))
+        return self.saida.retirar()
+
+    def fim(self) -> bytes:
+        self.writer.close()
+        return self.saida.retirar()
+
+
+EXPORTADORES = {
+    "csv": ExportadorCsv,
+    "ndjson": ExportadorNdjson,
+    "parquet": ExportadorParquet,
+}
+
+
+async def exportar_invoices(query: Select, exportador) -> AsyncIterator[bytes]:
+    """
+    Lê as notas com um cursor no servidor, EXPORT_LOTE linhas por vez, e devolve cada
+    lote já formatado: a memória usada não depende do total de linhas.
+    """
+    # A sessão da dependência é encerrada antes do streaming; o gerador usa a sua própria
+    async with SessionLocal() as session:
+        inicio = exportador.inicio()
+        if inicio:
+            yield inicio
+        resultado = await session.stream(query.execution_options(yield_per=EXPORT_LOTE))
+        async for linhas in resultado.partitions():
+            dados = exportador.lote([tuple(linha) for linha in linhas])
+            if dados:
+                yield dados
+        fim = exportador.fim()
+        if fim:
+            yield fim
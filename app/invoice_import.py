@@ -0,0 +1,196 @@
+import json
+import os
+from typing import AsyncIterator
+
+from fastapi import HTTPException, Request
+from pydantic import ValidationError
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.dedupe import hash_index
+from app.models import Invoice
+from app.normalize import formatar_data, normalizar_data, normalizar_valor
+from app.schemas import InvoiceRequest
+
+# Linhas gravadas por INSERT (executemany) e por commit
+BULK_LOTE = int(os.getenv("BULK_LOTE", "1000"))
+# Quantidade máxima de erros de validação detalhados na resposta
+BULK_MAX_ERROS = int(os.getenv("BULK_MAX_ERROS", "100"))
+
+TIPOS_NDJSON = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+# Campos do registro que uma nota existente recebe no upsert, com as colunas derivadas
+CAMPOS_ATUALIZADOS = {
+    "tipo_despesa": ("tipo_despesa",),
+    "cnpj": ("cnpj",),
+    "data_emissao": ("data_emissao", "emissao"),
+    "valor_total": ("valor_total", "valor_centavos"),
+    "status": ("status",),
+}
+
+
+def linha_invoice(invoice: InvoiceRequest) -> dict:
+    """
+    Colunas da nota como os validadores do modelo gravariam (o INSERT em lote não
+    passa pelo ORM): valor e data padronizados e as cópias tipadas preenchidas.
+    """
+    valor = normalizar_valor(invoice.valor_total)
+    emissao = normalizar_data(invoice.data_emissao)
+    return {
+        "tipo_despesa": invoice.tipo_despesa,
+        "cnpj": invoice.cnpj,
+        "data_emissao": formatar_data(emissao) or invoice.data_emissao,
+        "valor_total": str(valor) if valor is not None else None,
+        "valor_centavos": int(valor * 100) if valor is not None else None,
+        "emissao": emissao,
+        "status": invoice.status or "PROCESSADO",
+        "imagem_hash": invoice.imagem_hash or None,
+        "versao": 1,
+    }
+
+
+async def ler_registros(request: Request) -> AsyncIterator[dict]:
+    """
+    Registros do corpo: array JSON ou NDJSON (um objeto por linha, lido em streaming).
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type not in TIPOS_NDJSON:
+        try:
+            registros = json.loads(await request.body())
+        except json.JSONDecodeError as e:
+            raise HTTPException(status_code=400, detail=f"JSON inválido: {e}")
+        if not isinstance(registros, list):
+            raise HTTPException(status_code=400, detail="Envie um array JSON de notas.")
+        for registro in registros:
+            yield registro
+        return
+
+    resto = b""
+    async for pedaco in request.stream():
+        linhas = (resto + pedaco).split(b"\n")
+        resto = linhas.pop()
+        for linha in linhas:
+            if linha.strip():
+                yield _decodificar_linha(linha)
+    if resto.strip():
+        yield _decodificar_linha(resto)
+
+
+def _decodificar_linha(linha: bytes):
+    try:
+        return json.loads(linha)
+    except json.JSONDecodeError:
+        # Linha inválida vira erro de validação do registro, sem abortar a importação
+        return linha.decode("utf-8", errors="replace")
+
+
+def campos_enviados(invoice: InvoiceRequest) -> frozenset:
+    return frozenset(campo for campo in CAMPOS_ATUALIZADOS if campo in invoice.model_fields_set)
+
+
+def comando_insert(dialeto: str, atualizar: frozenset | None):
+    """
+    INSERT ... ON CONFLICT(imagem_hash) do banco em uso: DO UPDATE só dos campos em
+    `atualizar` (os enviados no registro) ou DO NOTHING quando `atualizar` é None.
+    """
+    insert = postgresql.insert if dialeto == "postgresql" else sqlite.insert
+    comando = insert(Invoice)
+    colunas = [coluna for campo in sorted(atualizar or ()) for coluna in CAMPOS_ATUALIZADOS[campo]]
+    if colunas:
+        comando = comando.on_conflict_do_update(
+            index_elements=[Invoice.imagem_hash],
+            set_={**{coluna: comando.excluded[coluna] for coluna in colunas},
+                  "versao": Invoice.versao + 1},
+        )
+    else:
+        comando = comando.on_conflict_do_nothing(index_elements=[Invoice.imagem_hash])
+    return comando.returning(Invoice.id, Invoice.imagem_hash)
+
+
+class ImportacaoInvoices:
+    """
+    Importação em lote: acumula BULK_LOTE linhas válidas e grava cada lote com um único
+    INSERT executemany e um commit, sem carregar objetos do ORM.
+    """
+
+    def __init__(self, session: AsyncSession, atualizar: bool = True):
+        self.session = session
+        self.atualizar = atualizar
+        self.dialeto = session.get_bind().dialect.name
+        self._comandos = {}
+        self.recebidos = 0
+        self.ids: list[int] = []
+        self.atualizados = 0
+        self.ignorados = 0
+        self.invalidos = 0
+        self.erros: list[dict] = []
+        self._lote: list[tuple[frozenset, dict]] = []
+
+    async def adicionar(self, registro):
+        self.recebidos += 1
+        try:
+            invoice = InvoiceRequest.model_validate(registro)
+        except ValidationError as e:
+            self.invalidos += 1
+            if len(self.erros) < BULK_MAX_ERROS:
+                self.erros.append({"registro": self.recebidos, "erro": e.errors(
+                    include_url=False, include_context=False)})
+            return
+        self._lote.append((campos_enviados(invoice), linha_invoice(invoice)))
+        if len(self._lote) >= BULK_LOTE:
+            await self.gravar()
+
+    async def gravar(self):
+        if not self._lote:
+            return
+        lote, self._lote = self._lote, []
+
+        # Repetido no mesmo lote: vale o último (um INSERT não pode alterar a mesma linha duas vezes)
+        por_hash = {}
+        sem_hash = []
+        for campos, linha in lote:
+            if linha["imagem_hash"]:
+                por_hash[linha["imagem_hash"]] = (campos, linha)
+            else:
+                sem_hash.append((campos, linha))
+        self.ignorados += len(lote) - len(por_hash) - len(sem_hash)
+
+        existentes = set()
+        if por_hash:
+            existentes = set(await self.session.scalars(
+                select(Invoice.imagem_hash).where(Invoice.imagem_hash.in_(por_hash))))
+
+        # Um INSERT executemany por conjunto de campos enviados (em geral, um só)
+        grupos: dict[frozenset, list[dict]] = {}
+        for campos, linha in sem_hash + list(por_hash.values()):
+            grupos.setdefault(campos, []).append(linha)
+
+        gravadas = []
+        for campos, linhas in grupos.items():
+            gravadas += (await self.session.execute(self._comando(campos), linhas)).all()
+        await self.session.commit()
+
+        for id, hash_value in gravadas:
+            if hash_value in existentes:
+                self.atualizados += 1
+            else:
+                self.ids.append(id)
+            hash_index.registrar(hash_value, id)
+        self.ignorados += len(sem_hash) + len(por_hash) - len(gravadas)
+
+    def _comando(self, campos: frozenset):
+        chave = campos if self.atualizar else None
+        if chave not in self._comandos:
+            self._comandos[chave] = comando_insert(self.dialeto, chave)
+        return self._comandos[chave]
+
+    def resumo(self) -> dict:
+        return {
+            "recebidos": self.recebidos,
+            "criados": len(self.ids),
+            "atualizados": self.atualizados,
+            "ignorados": self.ignorados,
+            "invalidos": self.invalidos,
+            "ids": self.ids,
+            "erros": self.erros,
+        }
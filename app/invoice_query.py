@@ -0,0 +1,139 @@
+import hashlib
+import os
+from datetime import date
+from decimal import ROUND_HALF_UP, Decimal
+
+from fastapi import HTTPException
+from pydantic import TypeAdapter
+from sqlalchemy import Select, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Invoice
+from app.normalize import valor_em_centavos
+from app.schemas import InvoiceResponse
+
+INVOICES_PAGE_SIZE = int(os.getenv("INVOICES_PAGE_SIZE", "100"))
+INVOICES_MAX_PAGE_SIZE = int(os.getenv("INVOICES_MAX_PAGE_SIZE", "1000"))
+
+CAMPOS_INVOICE = [coluna.name for coluna in Invoice.__table__.columns]
+AGRUPAMENTOS = ("tipo_despesa", "cnpj", "mes")
+
+LISTA_INVOICES = TypeAdapter(list[InvoiceResponse])
+
+
+def colunas_projecao(fields: str | None) -> list:
+    """
+    Colunas pedidas em `fields` (separadas por vírgula); o id sempre vem, pois é o cursor.
+    """
+    if not fields:
+        return [getattr(Invoice, campo) for campo in CAMPOS_INVOICE]
+
+    campos = [campo.strip() for campo in fields.split(",") if campo.strip()]
+    invalidos = [campo for campo in campos if campo not in CAMPOS_INVOICE]
+    if invalidos:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Campos inválidos: {', '.join(invalidos)}. Use {', '.join(CAMPOS_INVOICE)}.",
+        )
+    if "id" not in campos:
+        campos.insert(0, "id")
+    return [getattr(Invoice, campo) for campo in campos]
+
+
+def filtrar_invoices(query: Select, status: str | None = None, cnpj: str | None = None,
+                     tipo_despesa: str | None = None, data_inicio: date | None = None,
+                     data_fim: date | None = None, valor_min: Decimal | None = None,
+                     valor_max: Decimal | None = None) -> Select:
+    if status:
+        query = query.filter(Invoice.status == status)
+    if cnpj:
+        query = query.filter(Invoice.cnpj == cnpj)
+    if tipo_despesa:
+        query = query.filter(Invoice.tipo_despesa == tipo_despesa)
+    if data_inicio:
+        query = query.filter(Invoice.emissao >= data_inicio)
+    if data_fim:
+        query = query.filter(Invoice.emissao <= data_fim)
+    if valor_min is not None:
+        query = query.filter(Invoice.valor_centavos >= valor_em_centavos(valor_min))
+    if valor_max is not None:
+        query = query.filter(Invoice.valor_centavos <= valor_em_centavos(valor_max))
+    return query
+
+
+def paginar(query: Select, limit: int, cursor: int | None, desc: bool = False) -> Select:
+    """
+    Paginação por id (keyset): a página seguinte começa depois do último id recebido,
+    sem OFFSET, então o custo não cresce com a profundidade da página.
+    """
+    if cursor is not None:
+        query = query.filter(Invoice.id < cursor if desc else Invoice.id > cursor)
+    ordem = Invoice.id.desc() if desc else Invoice.id.asc()
+    return query.order_by(ordem).limit(limit)
+
+
+def expressao_mes(dialeto: str):
+    """
+    Mês da emissão como AAAA-MM, calculado no banco.
+    """
+    if dialeto == "postgresql":
+        return func.to_char(Invoice.emissao, "YYYY-MM")
+    return func.strftime("%Y-%m", Invoice.emissao)
+
+
+def colunas_agrupamento(agrupar: str, dialeto: str) -> list:
+    campos = [campo.strip() for campo in agrupar.split(",") if campo.strip()]
+    invalidos = [campo for campo in campos if campo not in AGRUPAMENTOS]
+    if not campos or invalidos:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Agrupamento inválido: {agrupar}. Use {', '.join(AGRUPAMENTOS)}.",
+        )
+    colunas = []
+    for campo in dict.fromkeys(campos):
+        coluna = expressao_mes(dialeto) if campo == "mes" else getattr(Invoice, campo)
+        colunas.append(coluna.label(campo))
+    return colunas
+
+
+def em_reais(centavos) -> str | None:
+    if centavos is None:
+        return None
+    return str((Decimal(centavos) / 100).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP))
+
+
+async def resumir_invoices(session: AsyncSession, agrupar: str, **filtros) -> list[dict]:
+    """
+    Totais por grupo (GROUP BY no banco) sobre valor_centavos: quantidade de notas,
+    soma, média, mínimo e máximo. Notas sem valor entram só na quantidade.
+    """
+    grupos = colunas_agrupamento(agrupar, session.get_bind().dialect.name)
+    query = select(
+        *grupos,
+        func.count().label("quantidade"),
+        func.sum(Invoice.valor_centavos).label("total"),
+        func.avg(Invoice.valor_centavos).label("media"),
+        func.min(Invoice.valor_centavos).label("minimo"),
+        func.max(Invoice.valor_centavos).label("maximo"),
+    )
+    query = filtrar_invoices(query, **filtros).group_by(*grupos).order_by(*grupos)
+
+    resumo = []
+    for linha in await session.execute(query):
+        item = dict(linha._mapping)
+        for campo in ("total", "media", "minimo", "maximo"):
+            item[campo] = em_reais(item[campo])
+        resumo.append(item)
+    return resumo
+
+
+def etag(corpo: bytes) -> str:
+    return f'W/"{hashlib.md5(corpo).hexdigest()}"'
+
+
+def serializar(linhas: list[dict]) -> bytes:
+    """
+    JSON das linhas pelo InvoiceResponse (ex.: valor_total como número). Só os campos
+    projetados entram, de modo que com `fields` cada item traz apenas as chaves pedidas.
+    """
+    return LISTA_INVOICES.dump_json(LISTA_INVOICES.validate_python(linhas), exclude_unset=True)
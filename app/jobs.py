@@ -0,0 +1,311 @@
+import asyncio
+import os
+import time
+
+import httpx
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import SessionLocal, engine
+from app.ingest import UploadSpool
+from app.log_config import logger
+from app.migrations import migrar
+from app.models import ExtractionJob
+from app.providers import provider_clients
+
+# Configuração dos workers (JOB_WORKERS=0 desativa os workers dentro da API)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "2"))
+# Um job em CHECKING tem o horário renovado a cada JOB_HEARTBEAT_SECONDS pelo worker que o
+# executa; sem renovação por JOB_LEASE_SECONDS (worker encerrado) volta para a fila
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "15"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_TENTATIVAS = int(os.getenv("JOB_MAX_TENTATIVAS", "3"))
+
+# Status do job: PENDENTE (na fila) -> CHECKING (em extração) -> PROCESSADO ou ERRO
+STATUS_ATIVOS = ("PENDENTE", "CHECKING")
+
+
+def job_to_dict(job: ExtractionJob) -> dict:
+    return {
+        "id": job.id,
+        "status": job.status,
+        "arquivo": job.arquivo,
+        "imagem_hash": job.imagem_hash,
+        "invoice_id": job.invoice_id,
+        "erro": job.erro,
+        "tentativas": job.tentativas,
+        "callback_url": job.callback_url,
+    }
+
+
+async def enfileirar(session: AsyncSession, documento: UploadSpool,
+               callback_url: str | None = None, provedor: str | None = None) -> ExtractionJob:
+    """
+    Grava o upload em um job PENDENTE. Um job ativo para o mesmo conteúdo é reaproveitado.
+    """
+    ativo = await session.scalar(select(ExtractionJob).filter(
+        ExtractionJob.imagem_hash == documento.hash,
+        ExtractionJob.status.in_(STATUS_ATIVOS),
+    ).limit(1))
+    if ativo:
+        return ativo
+
+    agora = time.time()
+    job = ExtractionJob(
+        status="PENDENTE",
+        arquivo=documento.nome,
+        content_type=documento.content_type,
+        imagem_hash=documento.hash,
+        conteudo=documento.conteudo(),
+        callback_url=callback_url,
+        provedor=provedor,
+        tentativas=0,
+        criado_em=agora,
+        atualizado_em=agora,
+    )
+    session.add(job)
+    await session.commit()
+    await session.refresh(job)
+    return job
+
+
+async def reservar_proximo(session: AsyncSession) -> ExtractionJob | None:
+    """
+    Move o job PENDENTE mais antigo para CHECKING. O UPDATE condicional garante que dois
+    workers (no mesmo processo ou em processos diferentes) nunca peguem o mesmo job.
+    """
+    while True:
+        candidato = (await session.execute(select(ExtractionJob.id).filter_by(
+            status="PENDENTE").order_by(ExtractionJob.id).limit(1))).first()
+        if candidato is None:
+            return None
+
+        resultado = await session.execute(
+            update(ExtractionJob)
+            .where(ExtractionJob.id == candidato.id, ExtractionJob.status == "PENDENTE")
+            .values(status="CHECKING", atualizado_em=time.time(),
+                    tentativas=ExtractionJob.tentativas + 1)
+        )
+        await session.commit()
+        if resultado.rowcount == 1:
+            return await session.get(ExtractionJob, candidato.id)
+
+
+async def recuperar_orfaos(session: AsyncSession) -> int:
+    """
+    Devolve à fila os jobs em CHECKING sem heartbeat há mais de JOB_LEASE_SECONDS (o
+    worker parou, ex.: redeploy). Após JOB_MAX_TENTATIVAS o job é marcado como ERRO.
+    """
+    limite = time.time() - JOB_LEASE_SECONDS
+    filtro = (ExtractionJob.status == "CHECKING",
+              ExtractionJob.atualizado_em < limite)
+
+    await session.execute(
+        update(ExtractionJob)
+        .where(*filtro, ExtractionJob.tentativas >= JOB_MAX_TENTATIVAS)
+        .values(status="ERRO", erro="Número máximo de tentativas excedido.", conteudo=None)
+    )
+    resultado = await session.execute(
+        update(ExtractionJob).where(*filtro).values(
+            status="PENDENTE", atualizado_em=time.time())
+    )
+    await session.commit()
+    return resultado.rowcount
+
+
+async def renovar_lease(job_id: int):
+    """
+    Heartbeat do job em execução: renova `atualizado_em` até ser cancelado. Usa uma sessão
+    própria, pois a do job fica ocupada durante a extração.
+    """
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+        try:
+            async with SessionLocal() as session:
+                await session.execute(
+                    update(ExtractionJob)
+                    .where(ExtractionJob.id == job_id, ExtractionJob.status == "CHECKING")
+                    .values(atualizado_em=time.time()))
+                await session.commit()
+        except Exception as e:
+            logger.warning(f"Falha ao renovar o job {job_id}: {e}")
+
+
+async def devolver_para_fila(job_ids: list[int]):
+    """
+    Devolve à fila, sem esperar o lease, os jobs interrompidos pelo encerramento do worker.
+    """
+    async with SessionLocal() as session:
+        await session.execute(
+            update(ExtractionJob)
+            .where(ExtractionJob.id.in_(job_ids), ExtractionJob.status == "CHECKING")
+            .values(status="PENDENTE", atualizado_em=time.time()))
+        await session.commit()
+
+
+async def processar_job(session: AsyncSession, job: ExtractionJob):
+    """
+    Executa a extração do job e grava a nota fiscal como PENDENTE.
+    """
+    # Import tardio: app.main importa este módulo
+    from app.dedupe import buscar_duplicada, buscar_semelhante, registrar_invoice
+    from app.main import extrair_dados_nota, nova_invoice
+    from app.provider_router import usar_provedor
+    from app.scheduler import PRIORIDADE_JOB, usar_prioridade
+    from fastapi import HTTPException
+
+    invoice = None
+    try:
+        documento = UploadSpool.de_bytes(
+            job.arquivo, job.content_type, job.conteudo)
+        existente = await buscar_duplicada(session, documento)
+        if existente:
+            job.status = "ERRO"
+            job.invoice_id = existente.id
+            job.erro = "O arquivo já foi cadastrado anteriormente."
+        else:
+            semelhante = await buscar_semelhante(session, documento)
+            with usar_provedor(job.provedor), usar_prioridade(PRIORIDADE_JOB):
+                json_data = await extrair_dados_nota(documento, session)
+            invoice = nova_invoice(json_data, job.imagem_hash, "PENDENTE", documento.phash,
+                                   semelhante.id if semelhante else None)
+            session.add(invoice)
+            await session.flush()
+            job.status = "PROCESSADO"
+            job.invoice_id = invoice.id
+    except IntegrityError:
+        await session.rollback()
+        job.status = "ERRO"
+        job.erro = "O arquivo já foi cadastrado anteriormente."
+    except HTTPException as e:
+        await session.rollback()
+        job.status = "ERRO"
+        job.erro = str(e.detail)
+    except Exception as e:
+        await session.rollback()
+        job.status = "ERRO"
+        job.erro = f"Erro ao processar nota fiscal: {str(e)}"
+
+    job.conteudo = None
+    job.atualizado_em = time.time()
+    await session.commit()
+
+    if job.status == "PROCESSADO":
+        registrar_invoice(invoice)
+
+    if job.callback_url:
+        await notificar(job)
+
+
+async def notificar(job: ExtractionJob):
+    """
+    Envia o estado final do job para a URL de callback informada no envio.
+    """
+    try:
+        client = provider_clients.http("callback")
+        resp = await client.post(job.callback_url, json=job_to_dict(job))
+        resp.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.warning(f"Falha ao notificar callback do job {job.id}: {e}")
+
+
+class JobWorkerPool:
+    """
+    Workers assíncronos que consomem a tabela `extraction_jobs`.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = workers
+        self._tarefas: list[asyncio.Task] = []
+        self._novo_job = asyncio.Event()
+        self._parar = False
+        self._em_execucao: set[int] = set()
+
+    async def start(self):
+        if self.workers <= 0 or self._tarefas:
+            return
+        self._parar = False
+        async with SessionLocal() as session:
+            await recuperar_orfaos(session)
+        self._tarefas = [asyncio.create_task(self._loop())
+                         for _ in range(self.workers)]
+
+    async def stop(self):
+        self._parar = True
+        self._novo_job.set()
+        for tarefa in self._tarefas:
+            tarefa.cancel()
+        await asyncio.gather(*self._tarefas, return_exceptions=True)
+        self._tarefas = []
+        if self._em_execucao:
+            try:
+                await devolver_para_fila(list(self._em_execucao))
+            except Exception as e:
+                logger.error(f"Erro ao devolver jobs interrompidos para a fila: {e}")
+            self._em_execucao.clear()
+
+    def notify(self):
+        """
+        Acorda os workers sem esperar o próximo ciclo de polling.
+        """
+        self._novo_job.set()
+
+    async def _executar(self, session: AsyncSession, job: ExtractionJob):
+        self._em_execucao.add(job.id)
+        heartbeat = asyncio.create_task(renovar_lease(job.id))
+        interrompido = False
+        try:
+            await processar_job(session, job)
+        except asyncio.CancelledError:
+            # Encerramento do worker: stop() devolve o job à fila
+            interrompido = True
+            raise
+        finally:
+            heartbeat.cancel()
+            if not interrompido:
+                self._em_execucao.discard(job.id)
+
+    async def _loop(self):
+        while not self._parar:
+            try:
+                async with SessionLocal() as session:
+                    job = await reservar_proximo(session)
+                    if job is not None:
+                        await self._executar(session, job)
+                        continue
+                    await recuperar_orfaos(session)
+            except Exception as e:
+                logger.error(f"Erro no worker de jobs: {e}")
+
+            self._novo_job.clear()
+            try:
+                await asyncio.wait_for(self._novo_job.wait(), JOB_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+
+job_workers = JobWorkerPool()
+
+
+async def main():
+    """
+    Worker separado da API: `python -m app.jobs` (use JOB_WORKERS=0 na API).
+    """
+    import app.main  # noqa: F401  (configura o Gemini)
+
+    await migrar(engine)
+    pool = JobWorkerPool(max(JOB_WORKERS, 1))
+    await pool.start()
+    logger.info(f"Worker de jobs iniciado com {pool.workers} tarefas")
+    try:
+        await asyncio.gather(*pool._tarefas)
+    finally:
+        await pool.stop()
+        await provider_clients.fechar()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
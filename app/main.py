@@ -1,23 +1,49 @@
-import io
+import asyncio
+import mimetypes
 import os
+import zipfile
+from contextlib import asynccontextmanager
+from datetime import date
+from decimal import Decimal
 from dotenv import load_dotenv
 import json
-from fastapi import Depends, FastAPI, HTTPException, UploadFile, File, Form
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response, UploadFile, File, Form
+from fastapi.responses import JSONResponse, StreamingResponse
 import google.generativeai as genai
-from app.database import Base, engine, SessionLocal
-from sqlalchemy.orm import Session
-from app.schemas import ChatRequest, ChatResponse, ConfigurationRequest, ConfigurationResponse, InvoiceRequest, InvoiceResponse, PromptRequest
-from app.models import Configurations, Invoice
+from app.database import engine, SessionLocal
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List
+from app.schemas import ChatRequest, ChatResponse, ConfigurationRequest, ConfigurationResponse, InvoiceLoteRequest, InvoiceRequest, InvoiceResponse, InvoiceStatusRequest, InvoiceSummaryResponse, JobResponse, PromptRequest
+from app.models import ExtractionJob, Invoice
 import logging
-from app.hash_util import gerar_hash_imagem  # <-- Import logging
+from app.ingest import MAX_UPLOAD_BYTES, UploadSpool, receber_stream, receber_upload
+from app.dedupe import (buscar_duplicada, buscar_semelhante, hash_index, perceptual_index,
+                         registrar_invoice)
+from app.config_cache import TIPOS_DOCUMENTO, config_cache, tipo_do_documento
+from app.migrations import migrar
+from app.extraction_cache import extraction_cache, gerar_chave
+from app.normalize import normalizar_resultado
+from app.invoice_batch import alterar_status, remover
+from app.invoice_export import EXPORTADORES, exportar_invoices
+from app.invoice_import import ImportacaoInvoices, ler_registros
+from app.invoice_query import INVOICES_MAX_PAGE_SIZE, INVOICES_PAGE_SIZE, colunas_projecao, etag, filtrar_invoices, paginar, resumir_invoices, serializar
+from app.jobs import enfileirar, job_to_dict, job_workers
+from app.nfe_parser import extrair_nfe, inferir_tipo_despesa
+from app.pdf_engine import PDF_MIN_CARACTERES_TEXTO, PDF_PAGINAS_POR_RODADA, PdfDocumento, campos_completos, mesclar_resultado, ordem_paginas
 from fastapi.middleware.cors import CORSMiddleware
-import requests  # Certo!
-from requests.exceptions import RequestException  # Importa a exceção corretamente
-from PIL import Image
-import pytesseract
-import xml.etree.ElementTree as ET
-from PIL import Image, ImageDraw, ImageFont
+import httpx
+from app.executor import executor_metrics, gemini_limiter, image_pool, mistral_limiter
+from app.providers import provider_clients
+from app.provider_router import anotar_modelo, coletar_modelos, provider_router, usar_provedor
+from app.response_parser import decodificar_json, pedacos_gemini, pedacos_mistral, texto_resposta
+from app.progress import Acompanhamento, acompanhar, evento_sse, reportar, resposta_sse
+from app.scheduler import PRIORIDADE_LOTE, estimar_tokens, extracoes_em_andamento, gemini_scheduler, mistral_scheduler, scheduler_metrics, usar_prioridade
+from app.ocr_engine import OCR_AQUECER, ocr_engine
+from app.hybrid import HIBRIDO_CONFIANCA_MINIMA, HIBRIDO_ENABLED, campos_faltando, extrair_campos, hybrid_metrics
+from app.image_preprocess import preprocess_metrics, preprocessar_para_modelo, preprocessar_para_ocr
 
 
 # --- Logging Setup ---
@@ -44,15 +70,39 @@ GEMINI_MODEL = "models/gemini-2.5-flash"
 # Modelo para processamento de imagem
 GEMINI_PRO_VISION_MODEL = "models/gemini-2.5-flash"
 
-Base.metadata.create_all(engine)
+# Extração em lote
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "500"))
+# Soma dos tamanhos dos documentos do lote (após expandir os .zip)
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(500 * 1024 * 1024)))
 
 
-def get_session():
-    session = SessionLocal()
-    try:
+async def get_session():
+    async with SessionLocal() as session:
         yield session
-    finally:
-        session.close()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await migrar(engine)
+    async with SessionLocal() as session:
+        await config_cache.carregar(session)
+        await perceptual_index.atualizar(session)
+    provider_clients.iniciar([GEMINI_MODEL, GEMINI_PRO_VISION_MODEL])
+    await job_workers.start()
+    if OCR_AQUECER:
+        try:
+            await ocr_engine.aquecer()
+        except Exception as e:
+            # A API sobe mesmo sem OCR: o modo híbrido e o Mistral tratam a falha por requisição
+            logger.error(f"Falha ao aquecer o OCR, usando o Tesseract por chamada: {e}")
+            ocr_engine.desativar_pool()
+    yield
+    await job_workers.stop()
+    await provider_clients.fechar()
+    ocr_engine.shutdown()
+    image_pool.shutdown()
+    await engine.dispose()
 
 
 origins = [
@@ -63,6 +113,7 @@ app = FastAPI(
     title="API METAMIND - Extração Inteligente ",
     description="Extração inteligente de dados.",
     version="1.0.0",
+    lifespan=lifespan,
     openapi_tags=[
         {
             "name": "Interação com LLM",
@@ -71,6 +122,14 @@ app = FastAPI(
         {
             "name": "Crud",
             "description": "Operações de CRUD.",
+        },
+        {
+            "name": "Jobs",
+            "description": "Extração assíncrona em segundo plano.",
+        },
+        {
+            "name": "Monitoramento",
+            "description": "Métricas internas da API.",
         }]
 )
 
@@ -80,13 +139,43 @@ app.add_middleware(
     # allow_credentials=True,
     allow_methods=["*"],  # Allows all HTTP methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Next-Cursor", "ETag"],  # Paginação e cache de GET /invoices
 )
 
 # --- Endpoint da API ---
 
 
+async def _reservar_mistral(payload: dict):
+    await mistral_scheduler.reservar(estimar_tokens(
+        [message.get("content") or "" for message in payload.get("messages", [])]))
+
+
+async def _post_mistral(url: str, headers: dict, payload: dict) -> httpx.Response:
+    await _reservar_mistral(payload)
+    client = provider_clients.http("mistral")
+    return await client.post(url, headers=headers, json=payload)
+
+
+async def _stream_mistral(url: str, headers: dict, payload: dict):
+    """
+    Repassa os tokens do Mistral como eventos SSE (`token`, `fim` ou `erro`).
+    """
+    client = provider_clients.http("mistral")
+    try:
+        async with mistral_limiter.vaga():
+            async with client.stream("POST", url, headers=headers, json=payload) as resp:
+                if resp.status_code >= 400:
+                    await resp.aread()
+                    resp.raise_for_status()
+                async for pedaco in pedacos_mistral(resp.aiter_lines()):
+                    yield evento_sse("token", {"texto": pedaco})
+        yield evento_sse("fim", {})
+    except httpx.HTTPError as e:
+        yield evento_sse("erro", {"detalhe": f"Erro na requisição para a API do Mistral: {e}"})
+
+
 @app.post("/chat/mistral", response_model=ChatResponse, tags=["Interação com LLM"])
-def chat_with_mistral(request_data: ChatRequest):
+async def chat_with_mistral(request_data: ChatRequest):
     """
     Endpoint que recebe uma requisição de chat e encaminha para a API do Mistral. (https://mistral.ai/)
 
@@ -110,6 +199,8 @@ def chat_with_mistral(request_data: ChatRequest):
             "stream": false
         }
 
+    Com `"stream": true` a resposta é text/event-stream: um evento `token` por trecho gerado
+    e, ao final, `fim` (ou `erro`).
     """
     url = MISTRAL_API_URL
     headers = {
@@ -118,10 +209,14 @@ def chat_with_mistral(request_data: ChatRequest):
     }
     payload = request_data.dict()
 
+    if request_data.stream:
+        await _reservar_mistral(payload)
+        return resposta_sse(_stream_mistral(url, headers, payload))
+
     try:
-        resp = requests.post(url, headers=headers, json=payload)
+        resp = await mistral_limiter.run(_post_mistral, url, headers, payload)
         resp.raise_for_status()
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         raise HTTPException(
             status_code=500, detail=f"Erro na requisição para a API do Mistral: {e}")
 
@@ -129,139 +224,42 @@ def chat_with_mistral(request_data: ChatRequest):
     return ChatResponse(response=data)
 
 
-# , response_model=InvoiceResponse
 @app.post("/invoices/extract/mistral", tags=["Interação com LLM"])
 async def extract_invoice_data_with_mistral(
     file: UploadFile = File(...),
+    stream: bool = False,
+    session=Depends(get_session),
 ):
     """
-    Recebe uma imagem de nota fiscal, extrai CNPJ, data e valor total e grava na base de notas.
+    Atalho para /invoices/extract/check com `provedor=mistral` (OCR local + Mistral).
     """
-    # Salvar temporariamente
-    temp_path = f"temp_{file.filename}"
-    with open(temp_path, "wb") as f:
-        f.write(await file.read())
-
-    # Abrir imagem com Pillow e extrair texto via pytesseract
-    image = Image.open(temp_path)
-
-    logger.warning(">>> Salvou  imagem")
-
-    texto_ocr = pytesseract.image_to_string(image, lang="por")
-
-    # gera hash imagem
-    # hash = gerar_hash_imagem(image)
-
-    os.remove(temp_path)
-
-    logger.warning(">>> Feito OCR")
-
-    # Prompt para LLM
-    prompt = f"""
-        Você é um assistente para extração de dados de notas fiscais brasileiras.
-
-        Texto extraído via OCR:
-        ---
-        {texto_ocr}
-        ---
-
-        Extraia os seguintes campos em formato JSON:
-
-        {{
-        "cnpj": "somente números",
-        "data": "DD/MM/AAAA",
-        "valor": número decimal com ponto (ex: 123.45)
-        }}
-
-        Se um campo não for encontrado, use null. Retorne apenas o JSON.
-        """
-
-    payload = {
-        "model": "mistral-medium",
-        "messages": [
-            {"role": "user", "content": prompt}
-        ],
-        "temperature": 0.3,
-        "max_tokens": 400
-    }
-
-    headers = {
-        "Authorization": f"Bearer {MISTRAL_API_KEY}",
-        "Content-Type": "application/json"
-    }
-
-    response = requests.post(MISTRAL_API_URL, headers=headers, json=payload)
-
-    if response.status_code != 200:
-        return JSONResponse(status_code=500, content={"erro": "Falha no modelo", "detalhe": response.text})
-
-    content = response.json()["choices"][0]["message"]["content"]
-
-    # Tenta extrair o JSON da resposta do LLM
-    json_data = {}
-    raw_llm_response = content
-    try:
-        # Tenta encontrar o bloco JSON na resposta
-        start_index = raw_llm_response.find("```json")
-        end_index = raw_llm_response.find("```", start_index + 1)
-
-        if start_index != -1 and end_index != -1:
-            json_string = raw_llm_response[start_index +
-                                           len("```json"):end_index].strip()
-            json_data = json.loads(json_string)
-        else:
-            # Se não encontrar o bloco ```json```, tenta parsear a resposta completa
-            json_data = json.loads(raw_llm_response.strip())
-
-    except json.JSONDecodeError as e:
-        print(
-            f"Não foi possível parsear o JSON da resposta do LLM: {raw_llm_response}. Erro: {e}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Erro ao parsear a resposta do modelo. Resposta recebida: {raw_llm_response.strip()}"
-        )
-
-    # Converte o valor para float se não for nulo
-    if 'valor' in json_data and json_data['valor'] is not None:
-        try:
-            json_data['valor'] = float(json_data['valor'])
-        except ValueError:
-            # Ou manter como string se a conversão falhar
-            json_data['valor'] = None
-
-    invoiceNew = Invoice(
-        cnpj=json_data.get('cnpj'),
-        data_emissao=json_data.get('data'),
-        valor_total=json_data.get('valor'),
-        # imagem_hash=hash,
-        status="CHECKING"
-    )
-
-    return invoiceNew
-
-    # try:
-    #     return JSONResponse(content=eval(content))
-    # except Exception:
-    #     return {"resposta_nao_tratada": content}
+    if stream:
+        return await extract_invoice_data_stream(file, False, "mistral")
+    return await extract_invoice_data(file, False, session, provedor="mistral")
 
 
 @app.post("/chat/gemini", tags=["Interação com LLM"])
 async def chat_with_gemini(request: PromptRequest):
     """
     Recebe um prompt de texto, interage com o modelo Google Gemini e retorna a resposta.
+
+    Com `"stream": true` a resposta é text/event-stream: um evento `token` por trecho gerado
+    e, ao final, `fim` (ou `erro`).
     """
+    await gemini_scheduler.reservar(estimar_tokens([request.prompt]))
+    if request.stream:
+        return resposta_sse(_stream_gemini(request.prompt))
     try:
-        model = genai.GenerativeModel(GEMINI_MODEL)
+        model = provider_clients.gemini(GEMINI_MODEL)
 
         # Gera o conteúdo usando o modelo
-        response = model.generate_content(request.prompt)
+        response = await gemini_limiter.run(
+            model.generate_content_async, request.prompt,
+            request_options=provider_clients.gemini_options)
 
         # Verifica se a resposta contém texto
         if response.parts:
-            # Concatena todas as partes da resposta
-            full_response_text = "".join(
-                [part.text for part in response.parts if hasattr(part, 'text')])
-            return {"response": full_response_text}
+            return {"response": texto_resposta(response)}
         else:
             # Lida com casos onde a resposta pode ser vazia ou não ter texto
             return {"response": "Não foi possível gerar uma resposta para o prompt."}
@@ -273,750 +271,716 @@ async def chat_with_gemini(request: PromptRequest):
             detail=f"Erro ao interagir com o modelo Gemini: {str(e)}"
         )
 
+
+async def _stream_gemini(prompt: str):
+    """
+    Repassa os tokens do Gemini como eventos SSE (`token`, `fim` ou `erro`).
+    """
+    try:
+        async with gemini_limiter.vaga():
+            model = provider_clients.gemini(GEMINI_MODEL)
+            response = await model.generate_content_async(
+                prompt, stream=True, request_options=provider_clients.gemini_options)
+            async for pedaco in pedacos_gemini(response):
+                if pedaco:
+                    yield evento_sse("token", {"texto": pedaco})
+        yield evento_sse("fim", {})
+    except Exception as e:
+        yield evento_sse("erro", {"detalhe": f"Erro ao interagir com o modelo Gemini: {str(e)}"})
+
 # --- Endpoint da API ---
 
 
 # , response_model=InvoiceResponse
 @app.post("/invoices/extract/save", tags=["Interação com LLM"])
-async def extract_invoice_data_with_gemini_and_save(file: UploadFile = File(...), session=Depends(get_session)):
+async def extract_invoice_data_with_gemini_and_save(
+    file: UploadFile = File(...),
+    background: bool = False,
+    callback_url: str | None = None,
+    provedor: str | None = None,
+    stream: bool = False,
+    session=Depends(get_session),
+):
     """
     Recebe uma imagem de nota fiscal, extrai CNPJ, data e valor total e grava na base de notas.
-    """
-    return await extract_invoice_data(file, True, session)
 
+    Com `background=true` o arquivo é enfileirado e a resposta (202) traz o id do job, que pode ser
+    consultado em GET /jobs/{id}. Se `callback_url` for informado, o resultado final é enviado por POST.
 
-# , response_model=InvoiceResponse
-@app.post("/invoices/extract/check", tags=["Interação com LLM"])
-async def extract_invoice_data_with_gemini_for_checking(file: UploadFile = File(...), session=Depends(get_session)):
-    """
-    Recebe uma imagem de nota fiscal, extrai CNPJ, data e valor total. Não grava em base de dados.
+    Por padrão os provedores são usados na ordem de PROVEDORES, com failover; `provedor`
+    (gemini, mistral, stub) força um único provedor.
+
+    Com `stream=true` a resposta é text/event-stream com as etapas da extração (received,
+    hashed, near_duplicate, cache_hit, ocr_done, llm_first_token, persisted) e, ao final, `resultado` ou `erro`.
     """
-    return await extract_invoice_data(file, False, session)
+    if background:
+        return await enqueue_invoice_extraction(file, callback_url, session, provedor)
+    if stream:
+        return await extract_invoice_data_stream(file, True, provedor)
+    return await extract_invoice_data(file, True, session, provedor)
 
 
-async def extract_invoice_data_old(file: UploadFile, save: bool, session):
+async def enqueue_invoice_extraction(file: UploadFile, callback_url: str | None, session: AsyncSession,
+                                     provedor: str | None = None):
     """
-    Recebe uma imagem de nota fiscal, extrai CNPJ, data e valor total.
+    Grava o upload como job PENDENTE e retorna 202 sem aguardar o modelo.
     """
-    if not file.content_type.startswith("image/"):
+    content_type = file.content_type.lower()
+    if not tipo_suportado(content_type):
         raise HTTPException(
-            status_code=400, detail="O arquivo enviado não é uma imagem.")
-
-    try:
-        # Carrega a imagem para o formato que o Gemini espera
-        image_data = await file.read()
-        image_parts = [
-            {
-                "mime_type": file.content_type,
-                "data": image_data
-            }
-        ]
-
-        # Prepara o modelo Gemini Vision
-        model_vision = genai.GenerativeModel(GEMINI_PRO_VISION_MODEL)
-
-        # Prompt de engenharia para extração de dados em JSON
-        # É crucial pedir o formato JSON e instruir para usar 'null' se o dado não for encontrado.
-
-        itemObject = session.query(Configurations).first()
-
-        prompt = ""
-        if itemObject and itemObject.prompt:
-            logger.warning("usando config...")
-            prompt = itemObject.prompt
-        else:
-            prompt = "Analise esta imagem de nota fiscal. Extraia as seguintes informações e formate-as como um objeto JSON. Se um dado não for encontrado, use `null`. Não adicione nenhum texto antes ou depois do JSON. Certifique-se de que o JSON é válido: {\"cnpj\":[CNPJ ou NPJ ou IPJ ou PJ ou P depois do :, com 14 números ou mais], \"data\":[Data da emissão no formato DD/MM/AAAA], \"valor\":[Valor total pago da nota fiscal, em formato numérico com ponto como separador decimal, ex: 123.45]} "
-            logger.warning("usando default...")
+            status_code=400,
+            detail="Tipo de arquivo não suportado. Envie imagem, PDF ou XML.",
+        )
 
-        prompt_parts = [prompt, "Imagem:", image_parts[0]]
+    provedor = provider_router.validar(provedor)
+    documento = await receber_upload(file)
 
-        # Gera o conteúdo
-        response = model_vision.generate_content(prompt_parts)
+    existente = await buscar_duplicada(session, documento)
+    if existente:
+        raise HTTPException(
+            status_code=400,
+            detail="O arquivo já foi cadastrado anteriormente."
+        )
 
-        # O Gemini pode retornar texto em partes. Juntamos tudo.
-        raw_llm_response = "".join(
-            [part.text for part in response.parts if hasattr(part, 'text')])
+    job = await enfileirar(session, documento, callback_url, provedor)
+    job_workers.notify()
 
-        # Tenta extrair o JSON da resposta do LLM
-        json_data = {}
-        try:
-            # Tenta encontrar o bloco JSON na resposta
-            start_index = raw_llm_response.find("```json")
-            end_index = raw_llm_response.find("```", start_index + 1)
-
-            if start_index != -1 and end_index != -1:
-                json_string = raw_llm_response[start_index +
-                                               len("```json"):end_index].strip()
-                json_data = json.loads(json_string)
-            else:
-                # Se não encontrar o bloco ```json```, tenta parsear a resposta completa
-                json_data = json.loads(raw_llm_response.strip())
+    return JSONResponse(status_code=202, content=job_to_dict(job))
 
-        except json.JSONDecodeError as e:
-            print(
-                f"Não foi possível parsear o JSON da resposta do LLM: {raw_llm_response}. Erro: {e}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Erro ao parsear a resposta do modelo. Resposta recebida: {raw_llm_response.strip()}"
-            )
 
-        # Converte o valor para float se não for nulo
-        if 'valor' in json_data and json_data['valor'] is not None:
-            try:
-                json_data['valor'] = float(json_data['valor'])
-            except ValueError:
-                # Ou manter como string se a conversão falhar
-                json_data['valor'] = None
+@app.get("/jobs/{id}", tags=["Jobs"], response_model=JobResponse)
+async def get_job(id: int, session: AsyncSession = Depends(get_session)):
+    """
+    Retorna o status de um job de extração: PENDENTE, CHECKING, PROCESSADO ou ERRO.
+    """
+    job = await session.get(ExtractionJob, id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado.")
+    return job_to_dict(job)
 
-        if 'tipo_despesa' not in json_data:
-            json_data['tipo_despesa'] = ''
 
-        # gera hash imagem
-        hash = gerar_hash_imagem(image_data)
+# , response_model=InvoiceResponse
+@app.post("/invoices/extract/check", tags=["Interação com LLM"])
+async def extract_invoice_data_with_gemini_for_checking(
+    file: UploadFile = File(...),
+    provedor: str | None = None,
+    stream: bool = False,
+    session=Depends(get_session),
+):
+    """
+    Recebe uma imagem de nota fiscal, extrai CNPJ, data e valor total. Não grava em base de dados.
+    Com `stream=true` as etapas da extração são enviadas como eventos SSE.
+    """
+    if stream:
+        return await extract_invoice_data_stream(file, False, provedor)
+    return await extract_invoice_data(file, False, session, provedor)
 
-        # persistência
 
-        # logger.warning("Verificando Hash existe: "+hash)
-        encontrou = session.query(Invoice).filter_by(imagem_hash=hash).all()
-        # logger.warning(encontrou)
+@app.post("/invoices/extract/batch", tags=["Interação com LLM"])
+async def extract_invoice_data_batch(
+    files: List[UploadFile] = File(...),
+    stream: bool = False,
+    session=Depends(get_session),
+):
+    """
+    Recebe várias notas fiscais (imagens, PDFs, XMLs ou arquivos .zip com elas), extrai os dados
+    com concorrência limitada e grava todas as notas novas em uma única transação.
 
-        status = "CHECKING"
+    Retorna o resultado de cada arquivo: cadastrado, ja_cadastrado, duplicado_no_lote ou erro.
+    Notas cadastradas com imagem semelhante à de outra trazem o id dela em `possivel_duplicada`.
+    Com `stream=true` a resposta é NDJSON, com uma linha por evento à medida que as extrações terminam.
+    """
+    documentos = await ler_documentos_lote(files, manter=stream)
 
-        if encontrou:
-            status = encontrou[0].status
-        else:
-            if save:
-                status = "PEDENTE"
+    if stream:
+        return StreamingResponse(processar_lote_ndjson(documentos), media_type="application/x-ndjson")
 
-        if save and encontrou:
-            raise HTTPException(
-                status_code=400, detail="O arquivo enviado já está cadastrado.")
-
-        invoiceNew = Invoice(
-            tipo_despesa=json_data.get('tipo_despesa'),
-            cnpj=json_data.get('cnpj'),
-            data_emissao=json_data.get('data'),
-            valor_total=json_data.get('valor'),
-            imagem_hash=hash,
-            status=status
-        )
+    resultados = {}
+    try:
+        async for indice, evento in processar_lote(documentos, session):
+            resultados[indice] = evento
+    finally:
+        for documento in documentos:
+            documento.fechar()
+    return [resultados[indice] for indice in sorted(resultados)]
 
-        if save:
-            session.add(invoiceNew)
-            session.commit()
-            session.refresh(invoiceNew)
 
-        return invoiceNew
+async def ler_documentos_lote(files: List[UploadFile], manter: bool = False) -> list[UploadSpool]:
+    """
+    Lê os uploads do lote (expandindo arquivos .zip) e calcula o hash de cada documento.
 
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Erro ao processar a imagem da nota fiscal: {str(e)}"
-        )
+    Os limites de quantidade (BATCH_MAX_FILES) e de tamanho total (BATCH_MAX_BYTES) são
+    verificados a cada entrada lida: um .zip grande é recusado sem ser expandido até o fim.
+    """
+    documentos = []
+    total_bytes = 0
 
+    def verificar_quantidade():
+        if len(documentos) >= BATCH_MAX_FILES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"O lote excede o limite de {BATCH_MAX_FILES} arquivos.")
 
-async def extract_invoice_data_old_2(file: UploadFile, save: bool, session: Session):
-    """
-    Recebe uma nota fiscal (imagem, XML ou PDF), extrai CNPJ, data e valor total.
-    """
-    content_type = file.content_type.lower()
+    def erro_tamanho_lote():
+        return HTTPException(
+            status_code=413,
+            detail=f"O lote excede o limite de {BATCH_MAX_BYTES / (1024 * 1024):.1f} MB.")
 
     try:
-        # ============================================================
-        # CASO 1 - XML
-        # ============================================================
-        if content_type in ["text/xml", "application/xml"]:
-            xml_bytes = await file.read()
-            try:
-                root = ET.fromstring(xml_bytes)
-            except ET.ParseError as e:
-                raise HTTPException(
-                    status_code=400, detail=f"XML inválido: {e}")
+        for file in files:
+            documento = await receber_upload(file, manter=manter)
 
-            ns = {"nfe": "http://www.portalfiscal.inf.br/nfe"}
+            if documento.content_type in ["application/zip", "application/x-zip-compressed"] or \
+                    (file.filename or "").lower().endswith(".zip"):
+                try:
+                    with zipfile.ZipFile(documento.abrir()) as zf:
+                        for info in zf.infolist():
+                            if info.is_dir():
+                                continue
+                            verificar_quantidade()
+                            restante = BATCH_MAX_BYTES - total_bytes
+                            if info.file_size > restante:
+                                raise erro_tamanho_lote()
+                            with zf.open(info) as entrada:
+                                try:
+                                    entrada_spool = receber_stream(
+                                        f"{file.filename}/{info.filename}",
+                                        mimetypes.guess_type(info.filename)[0] or "application/octet-stream",
+                                        entrada,
+                                        max_bytes=min(MAX_UPLOAD_BYTES, restante),
+                                    )
+                                except HTTPException:
+                                    # Tamanho declarado no .zip menor que o real
+                                    if restante < MAX_UPLOAD_BYTES:
+                                        raise erro_tamanho_lote()
+                                    raise
+                            documentos.append(entrada_spool)
+                            total_bytes += entrada_spool.tamanho
+                except zipfile.BadZipFile as e:
+                    raise HTTPException(
+                        status_code=400, detail=f"ZIP inválido ({file.filename}): {e}")
+                finally:
+                    documento.fechar()
+            else:
+                try:
+                    verificar_quantidade()
+                    if total_bytes + documento.tamanho > BATCH_MAX_BYTES:
+                        raise erro_tamanho_lote()
+                except HTTPException:
+                    documento.fechar()
+                    raise
+                documentos.append(documento)
+                total_bytes += documento.tamanho
+    except Exception:
+        for documento in documentos:
+            documento.fechar()
+        raise
 
-            def find_text(*paths):
-                for path in paths:
-                    el = root.find(path, ns)
-                    if el is not None and el.text:
-                        return el.text.strip()
-                return None
+    return documentos
 
-            cnpj = find_text(".//nfe:emit/nfe:CNPJ", ".//emit/CNPJ")
-            data_emissao = find_text(".//nfe:ide/nfe:dhEmi", ".//ide/dhEmi")
-            valor_total = find_text(".//nfe:ICMSTot/nfe:vNF", ".//ICMSTot/vNF")
 
-            # Normaliza data ISO → DD/MM/AAAA
-            if data_emissao and "T" in data_emissao:
-                data_emissao = data_emissao.split("T")[0]
-            if data_emissao and "-" in data_emissao:
-                partes = data_emissao.split("-")
-                if len(partes) == 3:
-                    data_emissao = f"{partes[2]}/{partes[1]}/{partes[0]}"
+async def processar_lote(documentos: list[UploadSpool], session: AsyncSession):
+    """
+    Processa o lote e gera eventos (indice, resultado) à medida que cada arquivo avança.
 
-            try:
-                valor_total = float(valor_total.replace(
-                    ",", ".")) if valor_total else None
-            except Exception:
-                valor_total = None
+    Arquivos repetidos dentro do lote e já cadastrados não chegam ao modelo. As notas
+    extraídas são gravadas juntas, em um único commit, ao final. Cada extração em
+    paralelo usa a sua própria sessão (uma AsyncSession não aceita operações simultâneas).
+    """
+    primeiro_por_hash = {}
+    pendentes = []
+    semelhantes = {}
 
-            json_data = {
-                "cnpj": cnpj,
-                "data": data_emissao,
-                "valor": valor_total,
-                "tipo_despesa": ""
-            }
+    for indice, doc in enumerate(documentos):
+        base = {"arquivo": doc.nome, "imagem_hash": doc.hash}
 
-            hash_value = gerar_hash_imagem(xml_bytes)
+        if doc.hash in primeiro_por_hash:
+            yield indice, {**base, "resultado": "duplicado_no_lote",
+                           "detalhe": f"Mesmo conteúdo de {primeiro_por_hash[doc.hash]}."}
+            continue
+        primeiro_por_hash[doc.hash] = doc.nome
 
-        # ============================================================
-        # CASO 2 - IMAGEM (via Gemini Vision)
-        # ============================================================
-        elif content_type.startswith("image/"):
-            image_data = await file.read()
-            image_parts = [{"mime_type": content_type, "data": image_data}]
-
-            itemObject = session.query(Configurations).first()
-            prompt = (
-                itemObject.prompt
-                if itemObject and itemObject.prompt
-                else (
-                    "Analise esta imagem de nota fiscal e extraia CNPJ, data e valor total. "
-                    "Responda em JSON estrito. Use null quando não encontrar. "
-                    '{"cnpj":"...", "data":"DD/MM/AAAA", "valor":123.45}'
-                )
-            )
+        existente = await buscar_duplicada(session, doc)
+        if existente:
+            yield indice, {**base, "resultado": "ja_cadastrado", "id": existente.id}
+            continue
 
-            model_vision = genai.GenerativeModel(GEMINI_PRO_VISION_MODEL)
-            response = model_vision.generate_content(
-                [prompt, "Imagem:", image_parts[0]])
+        semelhante = await buscar_semelhante(session, doc)
+        if semelhante:
+            semelhantes[indice] = semelhante.id
+        pendentes.append(indice)
 
-            raw_response = "".join(
-                [part.text for part in response.parts if hasattr(part, "text")]
-            ).strip()
+    semaforo = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
 
+    async def extrair(indice: int):
+        doc = documentos[indice]
+        async with semaforo, SessionLocal() as sessao_extracao:
             try:
-                if "```json" in raw_response:
-                    json_text = raw_response.split(
-                        "```json")[1].split("```")[0].strip()
-                    json_data = json.loads(json_text)
-                else:
-                    json_data = json.loads(raw_response)
-            except json.JSONDecodeError:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Erro ao decodificar JSON da resposta: {raw_response}",
-                )
-
-            if "valor" in json_data and json_data["valor"] is not None:
-                try:
-                    json_data["valor"] = float(json_data["valor"])
-                except ValueError:
-                    json_data["valor"] = None
-
-            if "tipo_despesa" not in json_data:
-                json_data["tipo_despesa"] = ""
-
-            hash_value = gerar_hash_imagem(image_data)
-
-        # ============================================================
-        # CASO 3 - PDF (OCR via Gemini Vision)
-        # ============================================================
-        elif content_type == "application/pdf":
-            pdf_data = await file.read()
-            pdf_parts = [{"mime_type": content_type, "data": pdf_data}]
-
-            itemObject = session.query(Configurations).first()
-            prompt = (
-                itemObject.prompt
-                if itemObject and itemObject.prompt
-                else (
-                    "Leia este PDF de nota fiscal (OCR) e extraia CNPJ, data de emissão "
-                    "e valor total pago. Retorne **somente** JSON válido no formato: "
-                    '{"cnpj":"...", "data":"DD/MM/AAAA", "valor":123.45}'
-                )
-            )
-
-            model_vision = genai.GenerativeModel(GEMINI_PRO_VISION_MODEL)
-            response = model_vision.generate_content(
-                [prompt, "Documento:", pdf_parts[0]])
-
-            raw_response = "".join(
-                [part.text for part in response.parts if hasattr(part, "text")]
-            ).strip()
+                with usar_prioridade(PRIORIDADE_LOTE):
+                    return indice, await extrair_dados_nota(doc, sessao_extracao), None
+            except HTTPException as e:
+                return indice, None, e.detail
+            except Exception as e:
+                return indice, None, f"Erro ao processar nota fiscal: {str(e)}"
+
+    novas = {}
+    for tarefa in asyncio.as_completed([extrair(indice) for indice in pendentes]):
+        indice, json_data, erro = await tarefa
+        base = {"arquivo": documentos[indice].nome,
+                "imagem_hash": documentos[indice].hash}
+        if erro:
+            yield indice, {**base, "resultado": "erro", "detalhe": erro}
+            continue
+        novas[indice] = nova_invoice(json_data, base["imagem_hash"], "PENDENTE",
+                                     documentos[indice].phash, semelhantes.get(indice))
+        yield indice, {**base, "resultado": "extraido", "dados": json_data}
+
+    # ============================================================
+    # PERSISTÊNCIA (uma única transação para o lote)
+    # ============================================================
+    if not novas:
+        return
+
+    hashes = [invoice.imagem_hash for invoice in novas.values()]
+    ja_gravadas = {
+        invoice.imagem_hash: invoice.id
+        for invoice in await session.scalars(
+            select(Invoice).filter(Invoice.imagem_hash.in_(hashes)))
+    }
 
+    gravar = {indice: invoice for indice, invoice in novas.items()
+              if invoice.imagem_hash not in ja_gravadas}
+    session.add_all(gravar.values())
+    try:
+        await session.commit()
+    except IntegrityError:
+        # Concorrência com outra requisição: grava nota a nota para isolar o conflito
+        await session.rollback()
+        for indice, invoice in list(gravar.items()):
+            session.add(invoice)
             try:
-                if "```json" in raw_response:
-                    json_text = raw_response.split(
-                        "```json")[1].split("```")[0].strip()
-                    json_data = json.loads(json_text)
-                else:
-                    json_data = json.loads(raw_response)
-            except json.JSONDecodeError:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Erro ao decodificar JSON da resposta OCR: {raw_response}",
-                )
-
-            if "valor" in json_data and json_data["valor"] is not None:
-                try:
-                    json_data["valor"] = float(json_data["valor"])
-                except ValueError:
-                    json_data["valor"] = None
-
-            if "tipo_despesa" not in json_data:
-                json_data["tipo_despesa"] = ""
-
-            hash_value = gerar_hash_imagem(pdf_data)
-
-        # ============================================================
-        # OUTROS FORMATOS
-        # ============================================================
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                del gravar[indice]
+                ja_gravadas[invoice.imagem_hash] = None
+
+    for indice, invoice in novas.items():
+        base = {"arquivo": documentos[indice].nome,
+                "imagem_hash": invoice.imagem_hash}
+        if indice in gravar:
+            registrar_invoice(invoice)
+            yield indice, {**base, "resultado": "cadastrado", "id": invoice.id, "status": invoice.status,
+                           "possivel_duplicada": invoice.possivel_duplicada}
         else:
-            raise HTTPException(
-                status_code=400,
-                detail="Tipo de arquivo não suportado. Envie imagem, PDF ou XML.",
-            )
+            yield indice, {**base, "resultado": "ja_cadastrado", "id": ja_gravadas[invoice.imagem_hash]}
 
-        # ============================================================
-        # PERSISTÊNCIA E DUPLICIDADE
-        # ============================================================
-        existente = session.query(Invoice).filter_by(
-            imagem_hash=hash_value).first()
-        if existente:
-            if save:
-                raise HTTPException(
-                    status_code=400, detail="O arquivo já foi cadastrado anteriormente."
-                )
-            else:
-                return existente
 
-        status = "PENDENTE" if save else "CHECKING"
+async def processar_lote_ndjson(documentos: list[UploadSpool]):
+    # A sessão da dependência é encerrada antes do streaming; o gerador usa a sua própria
+    try:
+        async with SessionLocal() as session:
+            async for _, evento in processar_lote(documentos, session):
+                yield json.dumps(evento, ensure_ascii=False) + "\n"
+    finally:
+        for documento in documentos:
+            documento.fechar()
 
-        invoice = Invoice(
-            tipo_despesa=json_data.get("tipo_despesa", ""),
-            cnpj=json_data.get("cnpj"),
-            data_emissao=json_data.get("data"),
-            valor_total=json_data.get("valor"),
-            imagem_hash=hash_value,
-            status=status,
-        )
 
-        if save:
-            session.add(invoice)
-            session.commit()
-            session.refresh(invoice)
+def tipo_suportado(content_type: str) -> bool:
+    return content_type in ["text/xml", "application/xml", "application/pdf"] or \
+        content_type.startswith("image/")
 
-        return invoice
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(
-            status_code=500, detail=f"Erro ao processar nota fiscal: {str(e)}"
+def montar_prompt_extracao(content_type: str, prompt_configurado: str | None):
+    """
+    Escolhe o prompt (configurado ou padrão por tipo de documento).
+    Retorna (prompt, rotulo, origem); o rótulo precede o documento nas partes enviadas ao modelo.
+    """
+    # ============================================================
+    # CASO 1 - XML (extração e classificação via LLM)
+    # ============================================================
+    if content_type in ["text/xml", "application/xml"]:
+        # Prompt consistente com IMAGEM e PDF
+        prompt = (
+            prompt_configurado
+            or (
+                "Analise o conteúdo a seguir (nota fiscal em formato XML) e extraia: "
+                "CNPJ do emissor, data de emissão, valor total e classifique a despesa "
+                "entre ALIMENTACAO, VEICULO ou ESCRITORIO. "
+                "Responda SOMENTE em JSON estrito no formato:\n\n"
+                '{"cnpj":"...", "data":"DD/MM/AAAA", "valor":123.45, "tipo_despesa":"...", "explicacao":"..."}'
+            )
         )
+        return prompt, "XML:", "LLM (XML)"
+
+    # ============================================================
+    # CASO 2 - IMAGEM (via Gemini Vision)
+    # ============================================================
+    if content_type.startswith("image/"):
+        prompt = (
+            prompt_configurado
+            or (
+                "Analise esta imagem de nota fiscal e extraia CNPJ, data, valor total "
+                "e tipo de despesa (ALIMENTACAO, VEICULO, ESCRITORIO). "
+                "Responda somente em JSON estrito. "
+                '{"cnpj":"...", "data":"DD/MM/AAAA", "valor":123.45, "tipo_despesa":"...", "explicacao":"..."}'
+            )
+        )
+        return prompt, "Imagem:", "Vision"
+
+    # ============================================================
+    # CASO 3 - PDF (OCR via Gemini Vision)
+    # ============================================================
+    if content_type == "application/pdf":
+        prompt = (
+            prompt_configurado
+            or (
+                "Leia este PDF de nota fiscal e extraia CNPJ, data de emissão, valor total "
+                "e tipo de despesa (ALIMENTACAO, VEICULO, ESCRITORIO). "
+                "Responda somente em JSON estrito. "
+                '{"cnpj":"...", "data":"DD/MM/AAAA", "valor":123.45, "tipo_despesa":"...", "explicacao":"..."}'
+            )
+        )
+        return prompt, "Documento:", "OCR"
+
+    # ============================================================
+    # OUTROS FORMATOS
+    # ============================================================
+    raise HTTPException(
+        status_code=400,
+        detail="Tipo de arquivo não suportado. Envie imagem, PDF ou XML.",
+    )
 
 
-async def extract_invoice_data3(file: UploadFile, save: bool, session: Session):
+async def chamar_modelo_json(prompt_parts: list, origem: str) -> dict:
     """
-    Recebe uma nota fiscal (imagem, XML ou PDF), converte XML em imagem e extrai
-    CNPJ, data, valor total e tipo_despesa via Gemini Vision.
+    Envia o prompt pelo roteador de provedores e decodifica o JSON da resposta.
     """
-    content_type = file.content_type.lower()
+    raw_response, provedor = await provider_router.gerar(prompt_parts)
+    anotar_modelo(provedor)
+    return decodificar_json(raw_response, origem)
 
-    try:
-        # ============================================================
-        # CASO 1 - XML → renderiza em imagem e usa lógica de IMAGEM
-        # ============================================================
-        if content_type in ["text/xml", "application/xml"]:
-            logger.info(">>>image/png from XML inicio")
-            xml_bytes = await file.read()
-            logger.info(">>>image/png from XML read file")
-
-            try:
-                # Valida o XML antes
-                root = ET.fromstring(xml_bytes)
-            except ET.ParseError as e:
-                raise HTTPException(
-                    status_code=400, detail=f"XML inválido: {e}")
-
-            # Renderiza texto XML em imagem (para Gemini Vision)
-            xml_text = xml_bytes.decode("utf-8", errors="ignore")
-            lines = xml_text.splitlines()
-            max_width = 1200
-            line_height = 25
-
-            # Gera imagem branca
-            img_height = max(800, len(lines) * line_height)
-            img = Image.new("RGB", (max_width, img_height), "white")
-            draw = ImageDraw.Draw(img)
-            logger.info(">>>image/png ImageDraw criado")
 
-            try:
-                # Fonte padrão (sem precisar do TTF local)
-                font = ImageFont.load_default()
-            except Exception:
-                font = None
+async def extrair_dados_nfe(documento: UploadSpool, session: AsyncSession) -> dict | None:
+    """
+    Caminho rápido para XML de NF-e/NFC-e: os campos são lidos diretamente do XML e o
+    LLM só é chamado, com a lista de itens, se o NCM/CFOP não bastar para classificar a
+    despesa. Retorna None se o XML não for uma NF-e reconhecível.
+    """
+    dados = extrair_nfe(documento.abrir())
+    if dados is None:
+        return None
 
-            y = 10
-            for line in lines[:200]:  # limita linhas longas
-                draw.text((10, y), line[:200], fill="black", font=font)
-                y += line_height
+    tipo_despesa, explicacao = inferir_tipo_despesa(dados["itens"])
 
-            img_bytes = io.BytesIO()
-            img.save(img_bytes, format="PNG")
-            image_data = img_bytes.getvalue()
-            content_type = "image/png"
+    if tipo_despesa is None:
+        itens = "\n".join(
+            f"- {item.get('descricao') or ''} (NCM {item.get('ncm') or '-'}, CFOP {item.get('cfop') or '-'})"
+            for item in dados["itens"][:50]
+        )
+        prompt = (
+            "Classifique a despesa desta nota fiscal entre ALIMENTACAO, VEICULO ou ESCRITORIO "
+            "com base nos itens abaixo. Responda somente em JSON estrito: "
+            '{"tipo_despesa":"...", "explicacao":"..."}'
+        )
+        classificacao = await extraction_cache.buscar(
+            session, documento.hash, prompt, provider_router.modelo())
+        if classificacao is None:
+            with coletar_modelos() as modelos:
+                classificacao = await chamar_modelo_json([prompt, "Itens:", itens], "LLM (classificação NF-e)")
+            await extraction_cache.gravar(
+                session, documento.hash, prompt, modelos.pop(), classificacao)
+        tipo_despesa = classificacao.get("tipo_despesa") or ""
+        explicacao = classificacao.get("explicacao") or explicacao
+
+    return {
+        "cnpj": dados["cnpj"],
+        "data": dados["data"],
+        "valor": dados["valor"],
+        "tipo_despesa": tipo_despesa,
+        "explicacao": explicacao,
+    }
 
-            logger.info(">>>image/png from XML criada")
 
-        # ============================================================
-        # CASO 2 - IMAGEM (via Gemini Vision)
-        # ============================================================
-        elif content_type.startswith("image/"):
-            image_data = await file.read()
+async def extrair_pagina_pdf(pdf: PdfDocumento, indice: int, prompt: str) -> dict:
+    """
+    Extrai uma página do PDF: pelo texto embutido quando existe, senão pela imagem renderizada.
+    """
+    texto = await image_pool.run(pdf.texto, indice)
+    if len(texto.strip()) >= PDF_MIN_CARACTERES_TEXTO:
+        return await chamar_modelo_json(
+            [prompt, f"Texto da página {indice + 1}:", texto], "PDF (texto)")
 
-        # ============================================================
-        # CASO 3 - PDF (OCR via Gemini Vision)
-        # ============================================================
-        elif content_type == "application/pdf":
-            pdf_data = await file.read()
-            pdf_parts = [{"mime_type": content_type, "data": pdf_data}]
-
-            itemObject = session.query(Configurations).first()
-            prompt = (
-                itemObject.prompt
-                if itemObject and itemObject.prompt
-                else (
-                    "Leia este PDF de nota fiscal (OCR) e extraia CNPJ, data de emissão, "
-                    "valor total e tipo de despesa (ex: combustível, alimentação, hospedagem). "
-                    "Responda somente em JSON: "
-                    '{"cnpj":"...", "data":"DD/MM/AAAA", "valor":123.45, "tipo_despesa":"..."}'
-                )
-            )
+    imagem = await image_pool.run(pdf.renderizar, indice)
+    return await chamar_modelo_json(
+        [prompt, f"Página {indice + 1}:", {"mime_type": "image/jpeg", "data": imagem}], "PDF (página)")
 
-            model_vision = genai.GenerativeModel(GEMINI_PRO_VISION_MODEL)
-            response = model_vision.generate_content(
-                [prompt, "Documento:", pdf_parts[0]])
 
-            raw_response = "".join(
-                [part.text for part in response.parts if hasattr(part, "text")]
-            ).strip()
+async def extrair_dados_pdf(documento: UploadSpool, prompt: str) -> dict | None:
+    """
+    Extrai um PDF página a página, em rodadas de PDF_PAGINAS_POR_RODADA páginas em paralelo,
+    começando pelas páginas mais prováveis. A leitura para assim que CNPJ, data e valor
+    estiverem preenchidos; se as páginas terminarem sem eles, o resultado parcial é
+    devolvido (veja `extrair_dados_modelo`). Retorna None se o PDF não puder ser aberto
+    pelo pdfium.
+    """
+    pdf = await image_pool.run(PdfDocumento.abrir, documento.abrir())
+    if pdf is None:
+        return None
 
+    resultado = {}
+    try:
+        ordem = ordem_paginas(pdf.total_paginas)
+        for inicio in range(0, len(ordem), PDF_PAGINAS_POR_RODADA):
+            tarefas = [asyncio.create_task(extrair_pagina_pdf(pdf, indice, prompt))
+                       for indice in ordem[inicio:inicio + PDF_PAGINAS_POR_RODADA]]
             try:
-                if "```json" in raw_response:
-                    json_text = raw_response.split(
-                        "```json")[1].split("```")[0].strip()
-                    json_data = json.loads(json_text)
-                else:
-                    json_data = json.loads(raw_response)
-            except json.JSONDecodeError:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Erro ao decodificar JSON da resposta OCR: {raw_response}",
-                )
-
-            if "valor" in json_data and json_data["valor"] is not None:
-                try:
-                    json_data["valor"] = float(json_data["valor"])
-                except ValueError:
-                    json_data["valor"] = None
+                for tarefa in asyncio.as_completed(tarefas):
+                    mesclar_resultado(resultado, await tarefa)
+                    if campos_completos(resultado):
+                        return resultado
+            finally:
+                for tarefa in tarefas:
+                    tarefa.cancel()
+                await asyncio.gather(*tarefas, return_exceptions=True)
+        return resultado
+    finally:
+        await image_pool.run(pdf.fechar)
 
-            if "tipo_despesa" not in json_data:
-                json_data["tipo_despesa"] = ""
 
-            hash_value = gerar_hash_imagem(pdf_data)
-            # vai direto pro fim
-            invoice_data = json_data
+async def montar_parte_documento(documento: UploadSpool):
+    """
+    Monta a parte do documento enviada ao modelo. Os bytes só são carregados em memória
+    aqui, depois da checagem de duplicidade e do cache.
+    """
+    content_type = documento.content_type
+    if content_type in ["text/xml", "application/xml"]:
+        return documento.texto()
 
-        # ============================================================
-        # IMAGEM (ou XML convertido em imagem)
-        # ============================================================
-        if content_type.startswith("image/"):
+    if content_type.startswith("image/"):
+        image_data, mime_type = await image_pool.run(
+            preprocessar_para_modelo, documento.abrir(), documento.tamanho, content_type)
+        return {"mime_type": mime_type, "data": image_data or documento.conteudo()}
 
-            logger.info(">>>image/png from IMAGEM inicio")
+    return {"mime_type": content_type, "data": documento.conteudo()}
 
-            image_parts = [{"mime_type": content_type, "data": image_data}]
 
-            itemObject = session.query(Configurations).first()
-            prompt = (
-                itemObject.prompt
-                if itemObject and itemObject.prompt
-                else (
-                    "Analise esta imagem de nota fiscal e extraia CNPJ, data de emissão, "
-                    "valor total e tipo de despesa (ex: combustível, alimentação, hospedagem). "
-                    "Responda **somente** com JSON: "
-                    '{"cnpj":"...", "data":"DD/MM/AAAA", "valor":123.45, "tipo_despesa":"..."}'
-                )
-            )
+async def extrair_dados_imagem_hibrido(documento: UploadSpool, prompt: str, rotulo: str, origem: str) -> dict:
+    """
+    Extração de imagem em etapas, cada uma só executada se a anterior deixar campos faltando:
+    OCR local + regras, LLM apenas com o texto do OCR e, por fim, o modelo de visão.
+    """
+    parcial = {}
+    texto = None
+    try:
+        image = await image_pool.run(preprocessar_para_ocr, documento.abrir())
+        texto = await ocr_engine.reconhecer(image)
+    except Exception as e:
+        hybrid_metrics.falhas_ocr += 1
+        logger.warning(f"OCR local indisponível, seguindo para o modelo: {e}")
+
+    if texto and texto.strip():
+        parcial, confianca = extrair_campos(texto)
+        reportar("ocr_done", caracteres=len(texto), confianca=round(confianca, 2))
+        if confianca >= HIBRIDO_CONFIANCA_MINIMA and not campos_faltando(parcial):
+            hybrid_metrics.registrar("ocr_regras")
+            return parcial
+
+        # Os campos achados pelas regras (CNPJ com dígito válido, valor rotulado) prevalecem
+        parcial.pop("explicacao", None)
+        prompt_texto = (
+            "A seguir está o texto extraído via OCR de uma nota fiscal brasileira. "
+            "Extraia CNPJ do emissor, data de emissão, valor total e classifique a despesa "
+            "entre ALIMENTACAO, VEICULO ou ESCRITORIO. Use null quando não encontrar. "
+            "Responda somente em JSON estrito: "
+            '{"cnpj":"...", "data":"DD/MM/AAAA", "valor":123.45, "tipo_despesa":"...", "explicacao":"..."}'
+        )
+        json_data = dict(parcial)
+        mesclar_resultado(json_data, await chamar_modelo_json(
+            [prompt_texto, "Texto OCR:", texto], "LLM (texto OCR)"))
+        if not campos_faltando(json_data):
+            hybrid_metrics.registrar("llm_texto")
+            return json_data
 
-            model_vision = genai.GenerativeModel(GEMINI_PRO_VISION_MODEL)
-            response = model_vision.generate_content(
-                [prompt, "Imagem:", image_parts[0]])
+    parte_documento = await montar_parte_documento(documento)
+    json_data = await chamar_modelo_json([prompt, rotulo, parte_documento], origem)
+    mesclar_resultado(json_data, parcial)
+    hybrid_metrics.registrar("visao")
+    return json_data
 
-            raw_response = "".join(
-                [part.text for part in response.parts if hasattr(part, "text")]
-            ).strip()
 
-            try:
-                if "```json" in raw_response:
-                    json_text = raw_response.split(
-                        "```json")[1].split("```")[0].strip()
-                    json_data = json.loads(json_text)
-                else:
-                    json_data = json.loads(raw_response)
-            except json.JSONDecodeError:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Erro ao decodificar JSON da resposta Vision: {raw_response}",
-                )
+async def extrair_dados_nota(documento: UploadSpool, session: AsyncSession) -> dict:
+    """
+    Extrai o JSON da nota fiscal via Gemini, consultando antes o cache de extração.
+    XML de NF-e é lido diretamente, sem o modelo.
+    """
+    content_type = documento.content_type
+
+    if content_type in ["text/xml", "application/xml"]:
+        json_data = await extrair_dados_nfe(documento, session)
+        if json_data is not None:
+            return json_data
+
+    prompt_configurado, prompt_versao = await config_cache.prompt_para(
+        session, tipo_do_documento(content_type))
+    prompt, rotulo, origem = montar_prompt_extracao(content_type, prompt_configurado)
+
+    # ============================================================
+    # CACHE DE EXTRAÇÃO (hash, prompt, modelo)
+    # ============================================================
+    modelo = provider_router.modelo()
+    json_data = await extraction_cache.buscar(session, documento.hash, prompt, modelo)
+    if json_data is not None:
+        reportar("cache_hit", modelo=modelo)
+    else:
+        # Uploads simultâneos do mesmo arquivo compartilham uma única chamada ao modelo
+        json_data = await extracoes_em_andamento.executar(
+            gerar_chave(documento.hash, prompt, modelo),
+            lambda: extrair_dados_modelo(documento, session, prompt, rotulo, origem, modelo))
 
-            if "valor" in json_data and json_data["valor"] is not None:
-                try:
-                    json_data["valor"] = float(json_data["valor"])
-                except ValueError:
-                    json_data["valor"] = None
+    json_data["prompt_versao"] = prompt_versao
+    return json_data
 
-            if "tipo_despesa" not in json_data:
-                json_data["tipo_despesa"] = ""
 
-            hash_value = gerar_hash_imagem(image_data)
-            invoice_data = json_data
+async def extrair_dados_modelo(documento: UploadSpool, session: AsyncSession, prompt: str,
+                               rotulo: str, origem: str, modelo: str) -> dict:
+    """
+    Extração pelo modelo (PDF por páginas, imagem híbrida ou chamada única), gravada no cache.
+    """
+    content_type = documento.content_type
+    json_data = None
 
-        # ============================================================
-        # OUTROS FORMATOS
-        # ============================================================
-        elif not content_type.startswith(("image/", "application/pdf")):
-            raise HTTPException(
-                status_code=400,
-                detail="Tipo de arquivo não suportado. Envie imagem, PDF ou XML.",
-            )
+    with coletar_modelos() as modelos:
+        if content_type == "application/pdf":
+            json_data = await extrair_dados_pdf(documento, prompt)
+            if json_data is not None and not campos_completos(json_data):
+                json_data = await completar_pdf(documento, prompt, rotulo, origem, json_data)
+        elif content_type.startswith("image/") and HIBRIDO_ENABLED:
+            json_data = await extrair_dados_imagem_hibrido(documento, prompt, rotulo, origem)
 
-        # ============================================================
-        # PERSISTÊNCIA E DUPLICIDADE
-        # ============================================================
-        logger.info(">>>Persistencia inicio")
-        existente = session.query(Invoice).filter_by(
-            imagem_hash=hash_value).first()
+        if json_data is None:
+            parte_documento = await montar_parte_documento(documento)
+            json_data = await chamar_modelo_json([prompt, rotulo, parte_documento], origem)
 
-        logger.info(">>>Persistencia verificado existente")
-        if existente:
-            if save:
-                raise HTTPException(
-                    status_code=400,
-                    detail="O arquivo já foi cadastrado anteriormente."
-                )
-            else:
-                return existente
+    # Conversão segura (valor numérico, data em DD/MM/AAAA)
+    normalizar_resultado(json_data)
 
-        status = "PENDENTE" if save else "CHECKING"
+    if "tipo_despesa" not in json_data:
+        json_data["tipo_despesa"] = ""
 
-        invoice = Invoice(
-            tipo_despesa=invoice_data.get("tipo_despesa", ""),
-            cnpj=invoice_data.get("cnpj"),
-            data_emissao=invoice_data.get("data"),
-            valor_total=invoice_data.get("valor"),
-            imagem_hash=hash_value,
-            status=status,
-        )
+    # O cache fica com o modelo que respondeu (failover/hedge podem trocar o provedor);
+    # sem chamada ao modelo (OCR + regras) vale o solicitado, e respostas de modelos
+    # diferentes na mesma extração não são gravadas
+    if len(modelos) <= 1:
+        modelo_resposta = next(iter(modelos), modelo)
+        await extraction_cache.gravar(
+            session, documento.hash, prompt, modelo_resposta, json_data)
 
-        logger.info(">>>Persistencia salvar")
-        if save:
-            session.add(invoice)
-            session.commit()
-            session.refresh(invoice)
+    return json_data
 
-        logger.info(">>>Persistencia retorno")
-        logger.info("Invoice to json"+str(invoice.__dict__))
-        return invoice
 
-    except HTTPException:
-        raise
+async def completar_pdf(documento: UploadSpool, prompt: str, rotulo: str, origem: str,
+                       parcial: dict) -> dict:
+    """
+    Nenhuma página trouxe todos os campos obrigatórios (ex.: CNPJ em uma página e total
+    em outra, sem texto suficiente em cada uma): faz uma chamada com o documento inteiro
+    e completa o resultado dela com o que as páginas encontraram. Se essa chamada falhar,
+    fica o resultado parcial das páginas.
+    """
+    logger.info(f"PDF {documento.hash}: campos incompletos nas páginas, enviando o documento inteiro")
+    try:
+        parte_documento = await montar_parte_documento(documento)
+        json_data = await chamar_modelo_json([prompt, rotulo, parte_documento], origem)
     except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Erro ao processar nota fiscal: {str(e)}"
-        )
+        logger.warning(f"PDF {documento.hash}: falha na chamada com o documento inteiro: {e}")
+        return parcial
+    mesclar_resultado(json_data, parcial)
+    return json_data
+
+
+def nova_invoice(json_data: dict, hash_value: str, status: str, phash: str | None = None,
+                 possivel_duplicada: int | None = None) -> Invoice:
+    return Invoice(
+        tipo_despesa=json_data.get("tipo_despesa", ""),
+        cnpj=json_data.get("cnpj"),
+        data_emissao=json_data.get("data"),
+        valor_total=json_data.get("valor"),
+        imagem_hash=hash_value,
+        imagem_phash=phash,
+        possivel_duplicada=possivel_duplicada,
+        status=status,
+        prompt_versao=json_data.get("prompt_versao"),
+    )
 
 
-async def extract_invoice_data(file: UploadFile, save: bool, session: Session):
+async def extract_invoice_data(file: UploadFile, save: bool, session: AsyncSession, provedor: str | None = None):
     """
     Recebe uma nota fiscal (imagem, XML ou PDF),
     extrai CNPJ, data, valor total e tipo_despesa (classificação LLM unificada).
     """
-    content_type = file.content_type.lower()
-
-    try:
-        # ============================================================
-        # CASO 1 - XML (extração e classificação via LLM)
-        # ============================================================
-        if content_type in ["text/xml", "application/xml"]:
-            xml_bytes = await file.read()
-            xml_text = xml_bytes.decode("utf-8", errors="ignore")
-
-            # Prompt consistente com IMAGEM e PDF
-            itemObject = session.query(Configurations).first()
-            prompt = (
-                itemObject.prompt
-                if itemObject and itemObject.prompt
-                else (
-                    "Analise o conteúdo a seguir (nota fiscal em formato XML) e extraia: "
-                    "CNPJ do emissor, data de emissão, valor total e classifique a despesa "
-                    "entre ALIMENTACAO, VEICULO ou ESCRITORIO. "
-                    "Responda SOMENTE em JSON estrito no formato:\n\n"
-                    '{"cnpj":"...", "data":"DD/MM/AAAA", "valor":123.45, "tipo_despesa":"...", "explicacao":"..."}'
-                )
-            )
-
-            model_text = genai.GenerativeModel(GEMINI_PRO_VISION_MODEL)
-            response = model_text.generate_content([prompt, "XML:", xml_text])
-
-            raw_response = "".join(
-                [part.text for part in response.parts if hasattr(part, "text")]
-            ).strip()
-
-            try:
-                # Extrai bloco JSON
-                if "```json" in raw_response:
-                    json_text = raw_response.split(
-                        "```json")[1].split("```")[0].strip()
-                    json_data = json.loads(json_text)
-                else:
-                    json_data = json.loads(raw_response)
-            except json.JSONDecodeError:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Erro ao decodificar JSON da resposta LLM (XML): {raw_response}",
-                )
-
-            # Conversão segura
-            if "valor" in json_data and json_data["valor"] is not None:
-                try:
-                    json_data["valor"] = float(json_data["valor"])
-                except ValueError:
-                    json_data["valor"] = None
-
-            if "tipo_despesa" not in json_data:
-                json_data["tipo_despesa"] = ""
+    provedor = provider_router.validar(provedor)
+    documento = await receber_upload(file)
+    with usar_provedor(provedor):
+        return await processar_documento(documento, save, session)
 
-            hash_value = gerar_hash_imagem(xml_bytes)
 
-        # ============================================================
-        # CASO 2 - IMAGEM (via Gemini Vision)
-        # ============================================================
-        elif content_type.startswith("image/"):
-            image_data = await file.read()
-            image_parts = [{"mime_type": content_type, "data": image_data}]
-
-            itemObject = session.query(Configurations).first()
-            prompt = (
-                itemObject.prompt
-                if itemObject and itemObject.prompt
-                else (
-                    "Analise esta imagem de nota fiscal e extraia CNPJ, data, valor total "
-                    "e tipo de despesa (ALIMENTACAO, VEICULO, ESCRITORIO). "
-                    "Responda somente em JSON estrito. "
-                    '{"cnpj":"...", "data":"DD/MM/AAAA", "valor":123.45, "tipo_despesa":"...", "explicacao":"..."}'
-                )
-            )
-
-            model_vision = genai.GenerativeModel(GEMINI_PRO_VISION_MODEL)
-            response = model_vision.generate_content(
-                [prompt, "Imagem:", image_parts[0]])
-
-            raw_response = "".join(
-                [part.text for part in response.parts if hasattr(part, "text")]
-            ).strip()
-
-            try:
-                if "```json" in raw_response:
-                    json_text = raw_response.split(
-                        "```json")[1].split("```")[0].strip()
-                    json_data = json.loads(json_text)
-                else:
-                    json_data = json.loads(raw_response)
-            except json.JSONDecodeError:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Erro ao decodificar JSON da resposta Vision: {raw_response}",
-                )
-
-            if "valor" in json_data and json_data["valor"] is not None:
-                try:
-                    json_data["valor"] = float(json_data["valor"])
-                except ValueError:
-                    json_data["valor"] = None
+async def extract_invoice_data_stream(file: UploadFile, save: bool, provedor: str | None):
+    """
+    Versão em streaming: o upload é copiado para um spool próprio (o FastAPI fecha o
+    UploadFile antes do corpo da resposta) e as etapas seguem como eventos SSE.
+    """
+    provedor = provider_router.validar(provedor)
+    documento = await receber_upload(file, manter=True)
+    return resposta_sse(acompanhar_extracao(documento, save, provedor))
 
-            if "tipo_despesa" not in json_data:
-                json_data["tipo_despesa"] = ""
 
-            hash_value = gerar_hash_imagem(image_data)
+async def acompanhar_extracao(documento: UploadSpool, save: bool, provedor: str | None):
+    acompanhamento = Acompanhamento()
 
-        # ============================================================
-        # CASO 3 - PDF (OCR via Gemini Vision)
-        # ============================================================
-        elif content_type == "application/pdf":
-            pdf_data = await file.read()
-            pdf_parts = [{"mime_type": content_type, "data": pdf_data}]
-
-            itemObject = session.query(Configurations).first()
-            prompt = (
-                itemObject.prompt
-                if itemObject and itemObject.prompt
-                else (
-                    "Leia este PDF de nota fiscal e extraia CNPJ, data de emissão, valor total "
-                    "e tipo de despesa (ALIMENTACAO, VEICULO, ESCRITORIO). "
-                    "Responda somente em JSON estrito. "
-                    '{"cnpj":"...", "data":"DD/MM/AAAA", "valor":123.45, "tipo_despesa":"...", "explicacao":"..."}'
-                )
-            )
+    async def executar():
+        # A sessão da dependência é encerrada antes do streaming; a tarefa usa a sua própria
+        async with SessionLocal() as session:
+            with acompanhar(acompanhamento), usar_provedor(provedor):
+                return await processar_documento(documento, save, session)
 
-            model_vision = genai.GenerativeModel(GEMINI_PRO_VISION_MODEL)
-            response = model_vision.generate_content(
-                [prompt, "Documento:", pdf_parts[0]])
+    tarefa = asyncio.create_task(executar())
+    try:
+        while True:
+            proxima = asyncio.ensure_future(acompanhamento.fila.get())
+            await asyncio.wait({tarefa, proxima}, return_when=asyncio.FIRST_COMPLETED)
+            if not proxima.done():
+                proxima.cancel()
+                break
+            yield evento_sse(*proxima.result())
 
-            raw_response = "".join(
-                [part.text for part in response.parts if hasattr(part, "text")]
-            ).strip()
+        while not acompanhamento.fila.empty():
+            yield evento_sse(*acompanhamento.fila.get_nowait())
 
-            try:
-                if "```json" in raw_response:
-                    json_text = raw_response.split(
-                        "```json")[1].split("```")[0].strip()
-                    json_data = json.loads(json_text)
-                else:
-                    json_data = json.loads(raw_response)
-            except json.JSONDecodeError:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Erro ao decodificar JSON da resposta OCR: {raw_response}",
-                )
+        try:
+            yield evento_sse("resultado", invoice_to_dict(tarefa.result()))
+        except HTTPException as e:
+            yield evento_sse("erro", {"status": e.status_code, "detalhe": e.detail})
+    finally:
+        tarefa.cancel()
+        documento.fechar()
 
-            if "valor" in json_data and json_data["valor"] is not None:
-                try:
-                    json_data["valor"] = float(json_data["valor"])
-                except ValueError:
-                    json_data["valor"] = None
 
-            if "tipo_despesa" not in json_data:
-                json_data["tipo_despesa"] = ""
+def invoice_to_dict(invoice: Invoice) -> dict:
+    return {coluna.name: getattr(invoice, coluna.name) for coluna in Invoice.__table__.columns}
 
-            hash_value = gerar_hash_imagem(pdf_data)
 
+async def processar_documento(documento: UploadSpool, save: bool, session: AsyncSession):
+    try:
         # ============================================================
-        # OUTROS FORMATOS
+        # DUPLICIDADE (antes de qualquer chamada ao modelo)
         # ============================================================
-        else:
-            raise HTTPException(
-                status_code=400,
-                detail="Tipo de arquivo não suportado. Envie imagem, PDF ou XML.",
-            )
+        hash_value = documento.hash
+        reportar("received", arquivo=documento.nome,
+                 content_type=documento.content_type, tamanho=documento.tamanho)
+        reportar("hashed", imagem_hash=hash_value)
 
-        # ============================================================
-        # PERSISTÊNCIA E DUPLICIDADE
-        # ============================================================
-        existente = session.query(Invoice).filter_by(
-            imagem_hash=hash_value).first()
+        existente = await buscar_duplicada(session, documento)
         if existente:
             if save:
                 raise HTTPException(
@@ -1026,21 +990,35 @@ async def extract_invoice_data(file: UploadFile, save: bool, session: Session):
             else:
                 return existente
 
+        # Imagem parecida com a de outra nota: extrai e grava normalmente, marcada para revisão
+        semelhante = await buscar_semelhante(session, documento)
+        if semelhante:
+            reportar("near_duplicate", id=semelhante.id, imagem_phash=documento.phash)
+
+        json_data = await extrair_dados_nota(documento, session)
+
+        # ============================================================
+        # PERSISTÊNCIA
+        # ============================================================
         status = "PENDENTE" if save else "CHECKING"
 
-        invoice = Invoice(
-            tipo_despesa=json_data.get("tipo_despesa", ""),
-            cnpj=json_data.get("cnpj"),
-            data_emissao=json_data.get("data"),
-            valor_total=json_data.get("valor"),
-            imagem_hash=hash_value,
-            status=status,
-        )
+        invoice = nova_invoice(json_data, hash_value, status, documento.phash,
+                               semelhante.id if semelhante else None)
 
         if save:
             session.add(invoice)
-            session.commit()
-            session.refresh(invoice)
+            try:
+                await session.commit()
+            except IntegrityError:
+                # Outra requisição gravou o mesmo arquivo enquanto o modelo respondia
+                await session.rollback()
+                raise HTTPException(
+                    status_code=400,
+                    detail="O arquivo já foi cadastrado anteriormente."
+                )
+            await session.refresh(invoice)
+            registrar_invoice(invoice)
+            reportar("persisted", id=invoice.id, status=invoice.status)
 
         return invoice
 
@@ -1053,26 +1031,111 @@ async def extract_invoice_data(file: UploadFile, save: bool, session: Session):
 
 
 @app.get("/invoices", tags=["Crud"], response_model=list[InvoiceResponse])
-def get_invoices(session: Session = Depends(get_session)):
+async def get_invoices(
+    request: Request,
+    limit: int = Query(INVOICES_PAGE_SIZE, ge=1, le=INVOICES_MAX_PAGE_SIZE),
+    cursor: int | None = None,
+    ordem: str = Query("asc", pattern="^(asc|desc)$"),
+    status: str | None = None,
+    cnpj: str | None = None,
+    tipo_despesa: str | None = None,
+    data_inicio: date | None = None,
+    data_fim: date | None = None,
+    valor_min: Decimal | None = None,
+    valor_max: Decimal | None = None,
+    fields: str | None = None,
+    session: AsyncSession = Depends(get_session),
+):
+    """
+    Retorna lista de documentos extraidos, paginada por id.
+
+    Quando a página vem cheia, o cabeçalho `X-Next-Cursor` traz o `cursor` da próxima.
+    Filtros: status, cnpj, tipo_despesa, data de emissão (`data_inicio`/`data_fim`, AAAA-MM-DD)
+    e valor total (`valor_min`/`valor_max`).
+    `fields` (ex.: `id,cnpj,valor_total`) limita as colunas retornadas: cada item segue o
+    InvoiceResponse, mas só com as chaves pedidas (e o id). A resposta traz um
+    `ETag`; com `If-None-Match` igual a página inalterada responde 304 sem corpo.
+    """
+    query = filtrar_invoices(select(*colunas_projecao(fields)),
+                             status, cnpj, tipo_despesa, data_inicio, data_fim,
+                             valor_min, valor_max)
+    resultado = await session.execute(paginar(query, limit, cursor, ordem == "desc"))
+    linhas = [dict(linha._mapping) for linha in resultado]
+
+    corpo = serializar(linhas)
+    headers = {"ETag": etag(corpo), "Cache-Control": "no-cache"}
+    if len(linhas) == limit:
+        headers["X-Next-Cursor"] = str(linhas[-1]["id"])
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if headers["ETag"] in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=corpo, media_type="application/json", headers=headers)
+
+
+@app.get("/invoices/summary", tags=["Crud"], response_model=list[InvoiceSummaryResponse],
+         response_model_exclude_none=True)
+async def get_invoices_summary(
+    agrupar: str = "tipo_despesa",
+    status: str | None = None,
+    cnpj: str | None = None,
+    tipo_despesa: str | None = None,
+    data_inicio: date | None = None,
+    data_fim: date | None = None,
+    session: AsyncSession = Depends(get_session),
+):
     """
-    Retorna lista de documentos extraidos.
+    Resumo dos gastos calculado no banco: quantidade, total, média, mínimo e máximo do
+    valor das notas por grupo.
+
+    `agrupar` combina `tipo_despesa`, `cnpj` e `mes` (ex.: `tipo_despesa,mes`).
+    Aceita os mesmos filtros de status, cnpj, tipo_despesa e data de emissão de `/invoices`.
+    """
+    return await resumir_invoices(session, agrupar, status=status, cnpj=cnpj,
+                            tipo_despesa=tipo_despesa, data_inicio=data_inicio,
+                            data_fim=data_fim)
+
+
+@app.get("/invoices/export", tags=["Crud"])
+async def export_invoices(
+    format: str = Query("csv", pattern="^(csv|ndjson|parquet)$"),
+    status: str | None = None,
+    cnpj: str | None = None,
+    tipo_despesa: str | None = None,
+    data_inicio: date | None = None,
+    data_fim: date | None = None,
+    valor_min: Decimal | None = None,
+    valor_max: Decimal | None = None,
+    fields: str | None = None,
+):
     """
-    items = session.query(Invoice).all()
+    Exporta as notas em csv, ndjson ou parquet, em streaming e ordenadas por id.
 
-    return items
+    Aceita os mesmos filtros e o mesmo `fields` de `/invoices`, sem paginação: as linhas
+    são lidas do banco em lotes e enviadas à medida que são lidas.
+    """
+    colunas = colunas_projecao(fields)
+    query = filtrar_invoices(select(*colunas), status, cnpj, tipo_despesa,
+                             data_inicio, data_fim, valor_min, valor_max)
+    exportador = EXPORTADORES[format]([coluna.key for coluna in colunas])
+    return StreamingResponse(
+        exportar_invoices(query.order_by(Invoice.id), exportador),
+        media_type=exportador.media_type,
+        headers={"Content-Disposition": f'attachment; filename="invoices.{format}"'},
+    )
 
 
 @app.get("/invoices/{id}", tags=["Crud"])
-def get_invoice(id: int, session: Session = Depends(get_session)):
+async def get_invoice(id: int, session: AsyncSession = Depends(get_session)):
     """
     Retorna um documento a parti do id.
     """
-    item = session.query(Invoice).get(id)
+    item = await session.get(Invoice, id)
     return item
 
 
 @app.post("/invoices/add", tags=["Crud"])
-def create_invoice(invoice: InvoiceRequest, session=Depends(get_session)):
+async def create_invoice(invoice: InvoiceRequest, session: AsyncSession = Depends(get_session)):
     """
     Adiciona um novo documento.
     """
@@ -1088,66 +1151,172 @@ def create_invoice(invoice: InvoiceRequest, session=Depends(get_session)):
         status="PROCESSADO"
     )
     session.add(itemObject)
-    session.commit()
-    session.refresh(itemObject)
+    await session.commit()
+    await session.refresh(itemObject)
     return itemObject
 
 
+@app.post("/invoices/bulk", tags=["Crud"])
+async def bulk_invoices(
+    request: Request,
+    conflito: str = Query("atualizar", pattern="^(atualizar|ignorar)$"),
+    session: AsyncSession = Depends(get_session),
+):
+    """
+    Importa notas em lote: corpo com array JSON ou NDJSON (`Content-Type: application/x-ndjson`),
+    cada registro no formato de `/invoices/add`.
+
+    As linhas são gravadas em lotes de BULK_LOTE, com um INSERT por lote. Se já existir uma
+    nota com o mesmo `imagem_hash`, `conflito=atualizar` (padrão) atualiza os campos e
+    `conflito=ignorar` mantém a nota existente. Retorna as quantidades, os ids criados e os
+    registros inválidos.
+    """
+    importacao = ImportacaoInvoices(session, atualizar=conflito == "atualizar")
+    async for registro in ler_registros(request):
+        await importacao.adicionar(registro)
+    await importacao.gravar()
+    return importacao.resumo()
+
+
+@app.post("/invoices/status", tags=["Crud"])
+async def update_invoices_status(pedido: InvoiceStatusRequest, session: AsyncSession = Depends(get_session)):
+    """
+    Muda o status de várias notas (por padrão, de PENDENTE/CHECKING para PROCESSADO) com
+    um UPDATE por lote de ids, ou um só para o `filtro`.
+
+    Em `notas`, cada item pode trazer a `versao` lida: se a nota mudou desde então, ela não
+    é alterada e volta como `conflito`. O resultado de cada nota vem em `resultados`
+    (`atualizada`, `conflito`, `status_invalido` ou `nao_encontrada`).
+    """
+    return await alterar_status(session, pedido)
+
+
+@app.post("/invoices/delete", tags=["Crud"])
+async def delete_invoices(pedido: InvoiceLoteRequest, session: AsyncSession = Depends(get_session)):
+    """
+    Exclui várias notas, por `notas` (com `versao` opcional) ou `filtro`, com um DELETE por
+    lote de ids. `origem` restringe aos status informados.
+    """
+    return await remover(session, pedido)
+
+
 @app.put("/invoices/{id}", tags=["Crud"])
-def update_invoice(id: int, invoice: InvoiceRequest, session=Depends(get_session)):
+async def update_invoice(id: int, invoice: InvoiceRequest, session: AsyncSession = Depends(get_session)):
     """
     Atualiza um documento parcialmente.
     """
-    itemObject = session.query(Invoice).get(id)
+    itemObject = await session.get(Invoice, id)
+    if itemObject is None:
+        raise HTTPException(status_code=404, detail="Documento não encontrado.")
+    if invoice.versao is not None and invoice.versao != itemObject.versao:
+        raise HTTPException(status_code=409, detail=f"Documento alterado (versão atual {itemObject.versao}).")
     itemObject.cnpj = invoice.cnpj
     itemObject.tipo_despesa = invoice.tipo_despesa
     itemObject.data_emissao = invoice.data_emissao
     itemObject.valor_total = invoice.valor_total
     itemObject.status = invoice.status
-    session.commit()
+    try:
+        await session.commit()
+    except StaleDataError:
+        # Alterado por outra requisição entre a leitura e o UPDATE (versao incrementada)
+        await session.rollback()
+        raise HTTPException(status_code=409, detail="Documento alterado por outra requisição.")
     return itemObject
 
 
 @app.delete("/invoices/{id}", tags=["Crud"])
-def delete_invoice(id: int, session=Depends(get_session)):
+async def delete_invoice(id: int, session: AsyncSession = Depends(get_session)):
     """
     Exclue um documento a partir do ID.
     """
-    itemObject = session.query(Invoice).get(id)
-    session.delete(itemObject)
-    session.commit()
-    session.close()
+    itemObject = await session.get(Invoice, id)
+    if itemObject is None:
+        raise HTTPException(status_code=404, detail="Documento não encontrado.")
+    await session.delete(itemObject)
+    await session.commit()
+    hash_index.remover(itemObject.imagem_hash)
     return 'Documento removido permanentemente.'
 
 
 @app.put("/configuration", tags=["Configuração"])
-def update_configuration(config: ConfigurationRequest, session=Depends(get_session)):
+async def update_configuration(config: ConfigurationRequest, session: AsyncSession = Depends(get_session)):
     """
     Atualiza Prompt de extração de dados. Prompt default: Analise esta imagem de nota fiscal. Extraia as seguintes informações e formate-as como um objeto JSON. Se um dado não for encontrado, use `null`. Não adicione nenhum texto antes ou depois do JSON. Certifique-se de que o JSON é válido: {\\\\"cnpj\\\\":[CNPJ da empresa emissora, apenas números], \\\\"data\\\\":[Data da emissão no formato DD/MM/AAAA], \\\\"valor\\\\":[Valor total pago da nota fiscal, em formato numérico com ponto como separador decimal, ex: 123.45]} 
     """
-    configUpdated = session.query(Configurations).first()
+    tipo = validar_tipo_documento(config.tipo_documento)
 
-    if configUpdated:
-        configUpdated.prompt = config.prompt
-        logger.warning("Encontrou:"+configUpdated.prompt)
-    else:
-        configUpdated = Configurations(prompt=config.prompt)
-        logger.warning("Novo:"+configUpdated.prompt)
+    atual = await config_cache.obter(session, tipo)
+    if atual is None or atual.prompt != config.prompt:
+        await extraction_cache.invalidar(session)
 
-    session.add(configUpdated)
-    session.commit()
-    session.refresh(configUpdated)
+    configUpdated, alterou = await config_cache.gravar(session, config.prompt, tipo)
+    if alterou:
+        logger.warning(f"Prompt ({tipo or 'todos'}) versão {configUpdated.versao}: {configUpdated.prompt}")
 
     return configUpdated
 
 
+def validar_tipo_documento(tipo: str | None) -> str | None:
+    if not tipo:
+        return None
+    if tipo not in TIPOS_DOCUMENTO:
+        raise HTTPException(
+            status_code=400,
+            detail=f"tipo_documento inválido. Use {', '.join(TIPOS_DOCUMENTO)} ou vazio.",
+        )
+    return tipo
+
+
 @app.get("/configuration", tags=["Configuração"])
-def get_configuration(session=Depends(get_session)):
+async def get_configuration(tipo_documento: str | None = None, session: AsyncSession = Depends(get_session)):
     """
-    Retorna prompt de extração de dados.
+    Retorna prompt de extração de dados (geral ou de um tipo de documento: xml, imagem, pdf).
+    Um tipo sem prompt próprio usa o geral; sem prompt geral, vem o primeiro prompt por tipo.
     """
-    config = session.query(Configurations).first()
+    config = await config_cache.vigente(session, validar_tipo_documento(tipo_documento))
     # configResponse = ConfigurationResponse(prompt=config.prompt)
     # session.close()
 
     return config
+
+
+@app.get("/metrics/executor", tags=["Monitoramento"])
+async def get_executor_metrics():
+    """
+    Retorna limites, chamadas em execução e tamanho da fila de cada pool (Gemini, Mistral, OCR, imagem).
+    """
+    return executor_metrics()
+
+
+@app.get("/metrics/provedores", tags=["Monitoramento"])
+async def get_provider_metrics():
+    """
+    Retorna, por provedor, latência p50/p95, taxa de erro e estado do circuit breaker, além
+    do total de hedges e fallbacks do roteador.
+    """
+    return provider_router.metrics()
+
+
+@app.get("/metrics/agendador", tags=["Monitoramento"])
+async def get_scheduler_metrics():
+    """
+    Retorna, por provedor, cotas RPM/TPM, tamanho da fila e tempo de espera na fila
+    (média, p95, máximo), além das extrações compartilhadas pelo mesmo hash.
+    """
+    return scheduler_metrics()
+
+
+@app.get("/metrics/hibrido", tags=["Monitoramento"])
+async def get_hybrid_metrics():
+    """
+    Retorna quantas extrações de imagem cada etapa resolveu (OCR + regras, LLM texto, visão).
+    """
+    return hybrid_metrics.metrics()
+
+
+@app.get("/metrics/preprocessamento", tags=["Monitoramento"])
+async def get_preprocess_metrics():
+    """
+    Retorna quantas imagens foram pré-processadas e a economia de bytes enviada ao modelo.
+    """
+    return preprocess_metrics.metrics()
@@ -0,0 +1,84 @@
+from sqlalchemy import bindparam, inspect, or_, select, text, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.database import Base
+import app.models  # noqa: F401 - registra as tabelas em Base.metadata
+from app.models import Invoice
+from app.normalize import formatar_data, normalizar_data, normalizar_valor
+
+BACKFILL_LOTE = 1000
+
+
+async def migrar(engine: AsyncEngine):
+    """
+    Atualiza bancos já existentes: `create_all` cria tabelas novas, mas não adiciona
+    colunas novas a tabelas antigas. Colunas ausentes são criadas (sempre anuláveis e
+    preenchidas com o default do modelo, se houver) e os índices declarados nos modelos
+    são criados se ainda não existirem.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(migrar_conexao)
+
+
+def migrar_conexao(conn: Connection):
+    Base.metadata.create_all(conn)
+    inspector = inspect(conn)
+
+    for table in Base.metadata.sorted_tables:
+        existentes = {coluna["name"] for coluna in inspector.get_columns(table.name)}
+        for coluna in table.columns:
+            if coluna.name in existentes:
+                continue
+            tipo = coluna.type.compile(dialect=conn.dialect)
+            conn.execute(text(
+                f'ALTER TABLE {table.name} ADD COLUMN {coluna.name} {tipo}'))
+            if coluna.default is not None and coluna.default.is_scalar:
+                conn.execute(update(table).values({coluna: coluna.default.arg}))
+
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+    preencher_colunas_tipadas(conn)
+
+
+def preencher_colunas_tipadas(conn: Connection) -> int:
+    """
+    Preenche valor_centavos e emissao das notas gravadas antes das colunas tipadas,
+    em lotes de BACKFILL_LOTE por id, e padroniza valor_total e data_emissao como na
+    extração. Valores que não puderem ser interpretados ficam como estão.
+    """
+    tabela = Invoice.__table__
+    pendentes = or_(
+        (tabela.c.valor_total.is_not(None)) & (tabela.c.valor_centavos.is_(None)),
+        (tabela.c.data_emissao.is_not(None)) & (tabela.c.emissao.is_(None)),
+    )
+    atualizar = update(tabela).where(tabela.c.id == bindparam("_id")).values(
+        valor_total=bindparam("_valor"), valor_centavos=bindparam("_centavos"),
+        data_emissao=bindparam("_data"), emissao=bindparam("_emissao"))
+
+    ultimo_id = 0
+    total = 0
+    while True:
+        linhas = conn.execute(
+            select(tabela.c.id, tabela.c.valor_total, tabela.c.data_emissao)
+            .where(pendentes, tabela.c.id > ultimo_id)
+            .order_by(tabela.c.id).limit(BACKFILL_LOTE)
+        ).all()
+        if not linhas:
+            return total
+
+        parametros = []
+        for linha in linhas:
+            valor = normalizar_valor(linha.valor_total)
+            emissao = normalizar_data(linha.data_emissao)
+            parametros.append({
+                "_id": linha.id,
+                "_valor": str(valor) if valor is not None else linha.valor_total,
+                "_centavos": int(valor * 100) if valor is not None else None,
+                "_data": formatar_data(emissao) or linha.data_emissao,
+                "_emissao": emissao,
+            })
+        conn.execute(atualizar, parametros)
+        ultimo_id = linhas[-1].id
+        total += len(linhas)
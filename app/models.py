@@ -1,5 +1,7 @@
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import BigInteger, Column, Date, Float, Index, Integer, LargeBinary, String, Text
+from sqlalchemy.orm import validates
 from app.database import Base
+from app.normalize import formatar_data, normalizar_data, normalizar_valor
 from sqlalchemy import Enum
 import enum
 
@@ -13,6 +15,8 @@ class Configurations(Base):
     __tablename__ = 'configurations'
     id = Column(Integer, primary_key=True)
     prompt = Column(String(2048))
+    tipo_documento = Column(String(10))  # xml / imagem / pdf; vazio = todos
+    versao = Column(Integer, index=True)  # contador global, incrementado a cada alteração
 
 
 class Item(Base):
@@ -30,3 +34,59 @@ class Invoice(Base):
     valor_total = Column(String(64))
     status = Column(String(10), default="PENDENTE")  # PENDENTE / CONFERIDO
     imagem_hash = Column(String(64), unique=True)
+    imagem_phash = Column(String(36))  # hash perceptual (pHash de 143 bits) das imagens
+    possivel_duplicada = Column(Integer)  # id da nota com imagem semelhante, para revisão
+    prompt_versao = Column(Integer)  # versão do prompt usado na extração
+    # Cópias tipadas de valor_total e data_emissao, mantidas pelos validadores abaixo
+    valor_centavos = Column(BigInteger, index=True)
+    emissao = Column(Date, index=True)
+    # Controle de concorrência otimista: incrementada a cada alteração
+    versao = Column(Integer, nullable=False, default=1)
+
+    # Filtros de GET /invoices com paginação por id (keyset)
+    __table_args__ = (
+        Index("ix_invoices_status_id", "status", "id"),
+        Index("ix_invoices_cnpj_id", "cnpj", "id"),
+        Index("ix_invoices_tipo_despesa_id", "tipo_despesa", "id"),
+    )
+    __mapper_args__ = {"version_id_col": versao}
+
+    @validates("valor_total")
+    def _normalizar_valor_total(self, key, valor):
+        numero = normalizar_valor(valor)
+        self.valor_centavos = int(numero * 100) if numero is not None else None
+        return str(numero) if numero is not None else valor
+
+    @validates("data_emissao")
+    def _normalizar_data_emissao(self, key, texto):
+        data = normalizar_data(texto)
+        self.emissao = data
+        return formatar_data(data) if data else texto
+
+
+class ExtractionCache(Base):
+    __tablename__ = 'extraction_cache'
+    id = Column(Integer, primary_key=True)
+    chave = Column(String(64), unique=True)  # sha256(hash, prompt, modelo)
+    imagem_hash = Column(String(64), index=True)
+    modelo = Column(String(64))
+    resultado = Column(Text)  # JSON extraído pelo modelo
+    criado_em = Column(Float)
+    acessado_em = Column(Float, index=True)
+
+
+class ExtractionJob(Base):
+    __tablename__ = 'extraction_jobs'
+    id = Column(Integer, primary_key=True)
+    status = Column(String(10), default="PENDENTE", index=True)  # PENDENTE / CHECKING / PROCESSADO / ERRO
+    arquivo = Column(String(256))
+    content_type = Column(String(128))
+    imagem_hash = Column(String(64), index=True)
+    conteudo = Column(LargeBinary)  # removido após o processamento
+    callback_url = Column(String(2048))
+    provedor = Column(String(20))  # provedor forçado no envio (vazio = roteador)
+    invoice_id = Column(Integer)
+    erro = Column(Text)
+    tentativas = Column(Integer, default=0)
+    criado_em = Column(Float)
+    atualizado_em = Column(Float)
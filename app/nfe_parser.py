@@ -0,0 +1,146 @@
+import io
+import xml.etree.ElementTree as ET
+from typing import BinaryIO
+
+NFE_NS = "http://www.portalfiscal.inf.br/nfe"
+
+# Prefixos de NCM/CFOP usados para classificar a despesa sem o LLM.
+# A ordem importa: VEICULO vem antes para que o etanol (2207) não caia em ALIMENTACAO.
+NCM_VEICULO = ("2710", "2207", "4011", "4013", "8507", "8511", "8708", "3819", "3820")
+CFOP_VEICULO = ("5655", "5656", "5667", "6655", "6656", "6667")
+NCM_ESCRITORIO = ("3215", "4802", "4816", "4817", "4820", "4821", "8443", "8471",
+                  "8472", "8473", "9608", "9609", "9610", "9611", "9612")
+# Capítulos 02 a 24 da NCM: alimentos e bebidas
+NCM_ALIMENTACAO = tuple(f"{capitulo:02d}" for capitulo in range(2, 25))
+
+# Fração mínima do valor dos itens que precisa cair em uma categoria
+LIMIAR_CLASSIFICACAO = 0.8
+
+
+def _tag(element) -> str:
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def _normalizar_data(data: str | None) -> str | None:
+    """
+    Converte AAAA-MM-DD[THH:MM:SS-03:00] para DD/MM/AAAA.
+    """
+    if not data:
+        return None
+    data = data.split("T")[0]
+    partes = data.split("-")
+    if len(partes) == 3:
+        return f"{partes[2]}/{partes[1]}/{partes[0]}"
+    return data
+
+
+def _to_float(valor: str | None) -> float | None:
+    try:
+        return float(valor.replace(",", ".")) if valor else None
+    except ValueError:
+        return None
+
+
+def extrair_nfe(xml: bytes | BinaryIO) -> dict | None:
+    """
+    Lê uma NF-e/NFC-e (com ou sem o envelope nfeProc) em streaming e retorna CNPJ do
+    emitente, data de emissão, valor total e os itens (NCM, CFOP, descrição, valor).
+
+    A leitura termina assim que `ICMSTot/vNF` é encontrado, ignorando transporte,
+    pagamento, informações adicionais e assinatura. Retorna None se o XML não for uma
+    NF-e válida ou se os campos obrigatórios não estiverem presentes.
+    """
+    dados = {"cnpj": None, "data": None, "valor": None, "itens": []}
+    caminho = []
+    item = None
+
+    try:
+        origem = io.BytesIO(xml) if isinstance(xml, bytes) else xml
+        for evento, element in ET.iterparse(origem, events=("start", "end")):
+            tag = _tag(element)
+
+            if evento == "start":
+                caminho.append(tag)
+                if tag == "prod":
+                    item = {}
+                continue
+
+            caminho.pop()
+            pai = caminho[-1] if caminho else None
+            texto = (element.text or "").strip()
+
+            if tag == "CNPJ" and pai == "emit":
+                dados["cnpj"] = texto
+            elif tag in ("dhEmi", "dEmi") and pai == "ide" and not dados["data"]:
+                dados["data"] = _normalizar_data(texto)
+            elif item is not None and pai == "prod":
+                if tag == "NCM":
+                    item["ncm"] = texto
+                elif tag == "CFOP":
+                    item["cfop"] = texto
+                elif tag == "xProd":
+                    item["descricao"] = texto
+                elif tag == "vProd":
+                    item["valor"] = _to_float(texto)
+            elif tag == "prod":
+                dados["itens"].append(item)
+                item = None
+            elif tag == "vNF" and pai == "ICMSTot":
+                dados["valor"] = _to_float(texto)
+                break
+
+            # Libera a memória dos elementos já processados
+            if tag in ("det", "emit", "dest", "ide"):
+                element.clear()
+    except ET.ParseError:
+        return None
+
+    if not (dados["cnpj"] and dados["data"] and dados["valor"] is not None):
+        return None
+    return dados
+
+
+def _categoria_item(item: dict) -> str | None:
+    ncm = item.get("ncm") or ""
+    cfop = item.get("cfop") or ""
+    if ncm.startswith(NCM_VEICULO) or cfop.startswith(CFOP_VEICULO):
+        return "VEICULO"
+    if ncm.startswith(NCM_ESCRITORIO):
+        return "ESCRITORIO"
+    if ncm.startswith(NCM_ALIMENTACAO):
+        return "ALIMENTACAO"
+    return None
+
+
+def inferir_tipo_despesa(itens: list[dict]) -> tuple[str | None, str]:
+    """
+    Classifica a despesa (ALIMENTACAO, VEICULO, ESCRITORIO) pelo NCM/CFOP dos itens.
+
+    Retorna (tipo, explicacao); tipo é None quando a classificação não é conclusiva.
+    """
+    if not itens:
+        return None, "Nota sem itens."
+
+    por_categoria = {}
+    total = 0.0
+    for item in itens:
+        valor = item.get("valor") or 0.0
+        total += valor
+        categoria = _categoria_item(item)
+        por_categoria[categoria] = por_categoria.get(categoria, 0.0) + valor
+
+    if total <= 0:
+        categorias = {_categoria_item(item) for item in itens}
+        if len(categorias) == 1 and None not in categorias:
+            tipo = categorias.pop()
+            return tipo, f"Classificado como {tipo} pelo NCM/CFOP dos itens."
+        return None, "Classificação inconclusiva pelo NCM/CFOP."
+
+    tipo, valor = max(
+        ((categoria, valor) for categoria, valor in por_categoria.items() if categoria),
+        key=lambda par: par[1],
+        default=(None, 0.0),
+    )
+    if tipo and valor / total >= LIMIAR_CLASSIFICACAO:
+        return tipo, f"Classificado como {tipo} pelo NCM/CFOP de {valor / total:.0%} do valor dos itens."
+    return None, "Classificação inconclusiva pelo NCM/CFOP."
@@ -0,0 +1,81 @@
+import re
+from datetime import date, datetime
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+FORMATOS_DATA = ("%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%Y-%m-%d", "%d/%m/%y")
+
+
+def normalizar_valor(valor) -> Decimal | None:
+    """
+    Converte o valor extraído (número, "123.45", "1.234,56", "R$ 10,00") em Decimal com
+    duas casas. Retorna None se não houver um número reconhecível.
+    """
+    if valor is None or isinstance(valor, bool):
+        return None
+    if isinstance(valor, (int, float, Decimal)):
+        numero = Decimal(str(valor))
+    else:
+        texto = re.sub(r"[^\d,.\-]", "", str(valor))
+        if not texto:
+            return None
+        # O último separador é o decimal ("1.234,56" ou "1,234.56"); repetido, é milhar
+        if "," in texto and "." in texto:
+            if texto.rfind(",") > texto.rfind("."):
+                texto = texto.replace(".", "").replace(",", ".")
+            else:
+                texto = texto.replace(",", "")
+        elif texto.count(",") == 1:
+            texto = texto.replace(",", ".")
+        else:
+            texto = texto.replace(",", "")
+            if texto.count(".") > 1:
+                texto = texto.replace(".", "")
+        try:
+            numero = Decimal(texto)
+        except InvalidOperation:
+            return None
+    if not numero.is_finite():
+        return None
+    return numero.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+
+def valor_em_centavos(valor) -> int | None:
+    numero = normalizar_valor(valor)
+    return int(numero * 100) if numero is not None else None
+
+
+def normalizar_data(texto) -> date | None:
+    """
+    Converte a data extraída (DD/MM/AAAA, DD-MM-AAAA, AAAA-MM-DD, DD/MM/AA) em date.
+    """
+    if texto is None:
+        return None
+    if isinstance(texto, date):
+        return texto
+    texto = str(texto).strip()[:10]
+    for formato in FORMATOS_DATA:
+        try:
+            data = datetime.strptime(texto, formato).date()
+        except ValueError:
+            continue
+        # "%Y" também aceita anos com 2 dígitos ("01/02/25" -> ano 25)
+        if data.year >= 1900:
+            return data
+    return None
+
+
+def formatar_data(data: date | None) -> str | None:
+    return data.strftime("%d/%m/%Y") if data else None
+
+
+def normalizar_resultado(json_data: dict) -> dict:
+    """
+    Padroniza o JSON extraído: valor numérico com duas casas e data em DD/MM/AAAA.
+    """
+    if "valor" in json_data:
+        valor = normalizar_valor(json_data["valor"])
+        json_data["valor"] = float(valor) if valor is not None else None
+    data = normalizar_data(json_data.get("data"))
+    if data:
+        json_data["data"] = formatar_data(data)
+    return json_data
@@ -0,0 +1,82 @@
+"""
+Compara o OCR por chamada (pytesseract, um subprocesso por imagem, em série; e o
+tesserocr criando a engine a cada imagem) com o OcrEngine (processos aquecidos e
+faixas em paralelo).
+
+Uso: python -m app.ocr_benchmark [imagens...] [--repeticoes N]
+Sem imagens, usa as notas de exemplo em notas-fiscais/.
+"""
+import argparse
+import asyncio
+import glob
+import time
+
+import pytesseract
+from PIL import Image
+
+from app.image_preprocess import preprocessar_para_ocr
+from app.ocr_engine import OCR_LANG, OCR_OEM, OCR_PSM, TESSEROCR_DISPONIVEL, OcrEngine
+
+
+def por_chamada(imagens: list[Image.Image]) -> float:
+    inicio = time.perf_counter()
+    for image in imagens:
+        pytesseract.image_to_string(
+            image, lang=OCR_LANG, config=f"--psm {OCR_PSM} --oem {OCR_OEM}")
+    return time.perf_counter() - inicio
+
+
+def tesserocr_por_chamada(imagens: list[Image.Image]) -> float:
+    import tesserocr
+
+    inicio = time.perf_counter()
+    for image in imagens:
+        with tesserocr.PyTessBaseAPI(lang=OCR_LANG, psm=OCR_PSM, oem=OCR_OEM) as api:
+            api.SetImage(image)
+            api.GetUTF8Text()
+    return time.perf_counter() - inicio
+
+
+async def com_engine(imagens: list[Image.Image]) -> tuple[float, float]:
+    engine = OcrEngine()
+    try:
+        inicio = time.perf_counter()
+        await engine.aquecer()
+        aquecimento = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        await asyncio.gather(*[engine.reconhecer(image) for image in imagens])
+        return aquecimento, time.perf_counter() - inicio
+    finally:
+        engine.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("imagens", nargs="*")
+    parser.add_argument("--repeticoes", type=int, default=3)
+    args = parser.parse_args()
+
+    caminhos = args.imagens or sorted(
+        glob.glob("notas-fiscais/*.PNG") + glob.glob("notas-fiscais/*.jpg"))
+    imagens = [preprocessar_para_ocr(open(caminho, "rb")) for caminho in caminhos]
+    imagens = imagens * args.repeticoes
+
+    print(f"{len(imagens)} imagens ({len(caminhos)} arquivos x {args.repeticoes})")
+
+    try:
+        tempo = por_chamada(imagens)
+        print(f"pytesseract por chamada: {tempo:.2f}s ({len(imagens) / tempo:.2f} img/s)")
+    except FileNotFoundError:
+        print("pytesseract por chamada: executável do Tesseract não encontrado")
+
+    if TESSEROCR_DISPONIVEL:
+        tempo = tesserocr_por_chamada(imagens)
+        print(f"tesserocr por chamada: {tempo:.2f}s ({len(imagens) / tempo:.2f} img/s)")
+
+    aquecimento, tempo = asyncio.run(com_engine(imagens))
+    print(f"OcrEngine: {tempo:.2f}s ({len(imagens) / tempo:.2f} img/s), aquecimento {aquecimento:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
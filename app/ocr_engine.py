@@ -0,0 +1,134 @@
+import asyncio
+import importlib.util
+import os
+
+import pytesseract
+from PIL import Image
+
+from app.executor import LIMITERS, BlockingPool, ProcessPool, image_pool
+from app.log_config import logger
+
+# Parâmetros configuráveis via variáveis de ambiente
+OCR_MAX_WORKERS = int(os.getenv("OCR_MAX_WORKERS", str(os.cpu_count() or 2)))
+OCR_LANG = os.getenv("OCR_LANG", "por")
+OCR_PSM = int(os.getenv("OCR_PSM", "6"))  # 6 = bloco único de texto (cupons)
+OCR_OEM = int(os.getenv("OCR_OEM", "1"))  # 1 = LSTM
+OCR_AQUECER = os.getenv("OCR_AQUECER", "true").lower() == "true"
+# Imagens mais altas que isto são divididas em faixas processadas em paralelo
+OCR_ALTURA_FAIXA = int(os.getenv("OCR_ALTURA_FAIXA", "1200"))
+# Janela (em pixels) em volta de cada corte onde se procura uma linha em branco
+JANELA_CORTE = 120
+
+# Sem tesserocr não há engine para manter carregada: o pool de processos não é usado
+TESSEROCR_DISPONIVEL = importlib.util.find_spec("tesserocr") is not None
+
+# Engine do Tesseract carregada uma vez por processo do pool
+_api = None
+
+
+def _inicializar_worker(lang: str, psm: int, oem: int):
+    global _api
+    try:
+        import tesserocr
+        _api = tesserocr.PyTessBaseAPI(lang=lang, psm=psm, oem=oem)
+    except Exception:
+        # Ex.: idioma sem traineddata; o aquecimento detecta e desativa o pool
+        _api = None
+
+
+def _aquecido() -> bool:
+    return _api is not None
+
+
+def _reconhecer_faixa(image: Image.Image) -> str:
+    if _api is not None:
+        _api.SetImage(image)
+        return _api.GetUTF8Text()
+    return _reconhecer_imagem(image)
+
+
+def _reconhecer_imagem(image: Image.Image) -> str:
+    """
+    OCR pelo executável do Tesseract (um subprocesso por chamada).
+    """
+    return pytesseract.image_to_string(
+        image, lang=OCR_LANG, config=f"--psm {OCR_PSM} --oem {OCR_OEM}")
+
+
+def dividir_faixas(image: Image.Image, altura_faixa: int = OCR_ALTURA_FAIXA) -> list[Image.Image]:
+    """
+    Divide imagens altas (cupons longos) em faixas horizontais. Cada corte é feito na
+    linha mais clara perto da altura alvo, para não cortar uma linha de texto ao meio.
+    """
+    image = image.convert("L")
+    largura, altura = image.size
+    if altura <= altura_faixa:
+        return [image]
+
+    # Brilho médio de cada linha da imagem
+    brilho = list(image.resize((1, altura), Image.BOX).getdata())
+
+    faixas = []
+    topo = 0
+    while altura - topo > altura_faixa:
+        alvo = topo + altura_faixa
+        inicio = max(alvo - JANELA_CORTE, topo + 1)
+        fim = min(alvo + JANELA_CORTE, altura - 1)
+        corte = max(range(inicio, fim), key=lambda y: brilho[y])
+        faixas.append(image.crop((0, topo, largura, corte)))
+        topo = corte
+    faixas.append(image.crop((0, topo, largura, altura)))
+    return faixas
+
+
+class OcrEngine:
+    """
+    OCR com processos Tesseract persistentes (tesserocr) e faixas de uma mesma imagem em
+    paralelo. Sem engine aquecida (tesserocr ausente ou sem carregar nos processos), cada
+    imagem inteira vai para o executável do Tesseract em um pool de threads: dividir em
+    faixas só multiplicaria os subprocessos.
+    """
+
+    def __init__(self, workers: int = OCR_MAX_WORKERS, aquecido: bool = TESSEROCR_DISPONIVEL):
+        self.workers = workers
+        self.aquecido = aquecido
+        if aquecido:
+            self.pool = ProcessPool("ocr", workers, initializer=_inicializar_worker,
+                                    initargs=(OCR_LANG, OCR_PSM, OCR_OEM))
+        else:
+            self.pool = BlockingPool("ocr", workers)
+
+    async def aquecer(self):
+        """
+        Inicia os processos do pool (e a engine em cada um) antes da primeira requisição.
+        Se a engine não carregar, o pool de processos é trocado pelo OCR por chamada.
+        """
+        if not self.aquecido:
+            return
+        prontos = await asyncio.gather(*[self.pool.run(_aquecido) for _ in range(self.pool.limite)])
+        if not all(prontos):
+            logger.warning(f"tesserocr não carregou a engine (OCR_LANG={OCR_LANG}); "
+                           "usando o executável do Tesseract por imagem")
+            self.desativar_pool()
+
+    def desativar_pool(self):
+        self.pool.shutdown()
+        LIMITERS.remove(self.pool)
+        self.aquecido = False
+        self.pool = BlockingPool("ocr", self.workers)
+
+    async def reconhecer(self, image: Image.Image) -> str:
+        """
+        Retorna o texto da imagem, juntando as faixas na ordem original.
+        """
+        if not self.aquecido:
+            return await self.pool.run(_reconhecer_imagem, image)
+        faixas = await image_pool.run(dividir_faixas, image)
+        textos = await asyncio.gather(*[self.pool.run(_reconhecer_faixa, faixa) for faixa in faixas])
+        return "\n".join(texto.strip("\n") for texto in textos)
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+ocr_engine = OcrEngine()
@@ -0,0 +1,108 @@
+import io
+import os
+from threading import Lock
+from typing import BinaryIO
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # sem pypdfium2 o PDF segue inteiro para o modelo
+    pdfium = None
+
+from app.image_preprocess import PREPROCESS_MAX_EDGE, PREPROCESS_QUALITY
+
+# Parâmetros configuráveis via variáveis de ambiente
+PDF_PAGINAS_POR_RODADA = int(os.getenv("PDF_PAGINAS_POR_RODADA", "2"))
+PDF_MIN_CARACTERES_TEXTO = int(os.getenv("PDF_MIN_CARACTERES_TEXTO", "80"))
+PDF_RENDER_SCALE = float(os.getenv("PDF_RENDER_SCALE", "2.0"))  # 144 dpi
+
+# Campos que encerram a leitura das páginas quando todos estão preenchidos
+CAMPOS_OBRIGATORIOS = ("cnpj", "data", "valor")
+
+# O pdfium não é thread-safe: todas as chamadas passam por este lock
+_pdfium_lock = Lock()
+
+
+def ordem_paginas(total: int) -> list[int]:
+    """
+    Ordem de leitura das páginas: primeira, última, segunda, penúltima...
+    Em faturas e contas os totais costumam estar na primeira ou na última página.
+    """
+    ordem = []
+    inicio, fim = 0, total - 1
+    while inicio <= fim:
+        ordem.append(inicio)
+        if fim != inicio:
+            ordem.append(fim)
+        inicio += 1
+        fim -= 1
+    return ordem
+
+
+def campos_completos(json_data: dict) -> bool:
+    return all(json_data.get(campo) not in (None, "") for campo in CAMPOS_OBRIGATORIOS)
+
+
+def mesclar_resultado(resultado: dict, parcial: dict):
+    """
+    Preenche em `resultado` os campos ainda vazios com os valores de uma página.
+    """
+    for campo, valor in parcial.items():
+        if resultado.get(campo) in (None, "") and valor not in (None, ""):
+            resultado[campo] = valor
+
+
+class PdfDocumento:
+    """
+    PDF aberto com o pdfium, com acesso página a página ao texto embutido e à
+    renderização (feita apenas para as páginas que precisarem de visão).
+    """
+
+    def __init__(self, stream: BinaryIO):
+        with _pdfium_lock:
+            self._pdf = pdfium.PdfDocument(stream)
+            self.total_paginas = len(self._pdf)
+
+    @classmethod
+    def abrir(cls, stream: BinaryIO) -> "PdfDocumento | None":
+        """
+        Retorna None se o pypdfium2 não estiver instalado ou o PDF não puder ser lido.
+        """
+        if pdfium is None:
+            return None
+        try:
+            return cls(stream)
+        except pdfium.PdfiumError:
+            return None
+
+    def texto(self, indice: int) -> str:
+        with _pdfium_lock:
+            page = self._pdf[indice]
+            try:
+                textpage = page.get_textpage()
+                try:
+                    return textpage.get_text_range()
+                finally:
+                    textpage.close()
+            finally:
+                page.close()
+
+    def renderizar(self, indice: int) -> bytes:
+        """
+        Renderiza a página em JPEG tons de cinza, limitada a PREPROCESS_MAX_EDGE.
+        """
+        with _pdfium_lock:
+            page = self._pdf[indice]
+            try:
+                image = page.render(scale=PDF_RENDER_SCALE, grayscale=True).to_pil()
+            finally:
+                page.close()
+
+        if max(image.size) > PREPROCESS_MAX_EDGE:
+            image.thumbnail((PREPROCESS_MAX_EDGE, PREPROCESS_MAX_EDGE))
+        saida = io.BytesIO()
+        image.convert("L").save(saida, format="JPEG", quality=PREPROCESS_QUALITY)
+        return saida.getvalue()
+
+    def fechar(self):
+        with _pdfium_lock:
+            self._pdf.close()
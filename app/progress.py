@@ -0,0 +1,85 @@
+import asyncio
+import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator
+
+from fastapi.responses import StreamingResponse
+
+# Etapas da extração: received, hashed, cache_hit, ocr_done, llm_first_token, persisted
+_acompanhamento: ContextVar["Acompanhamento | None"] = ContextVar(
+    "acompanhamento", default=None)
+
+
+def evento_sse(evento: str, dados: dict) -> str:
+    """
+    Formata um evento server-sent events (text/event-stream).
+    """
+    return f"event: {evento}\ndata: {json.dumps(dados, ensure_ascii=False, default=str)}\n\n"
+
+
+def resposta_sse(eventos: AsyncIterator[str]) -> StreamingResponse:
+    return StreamingResponse(
+        eventos,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+class Acompanhamento:
+    """
+    Fila das etapas de uma extração, consumida pela resposta SSE.
+    """
+
+    def __init__(self):
+        self.fila: asyncio.Queue = asyncio.Queue()
+        self.inicio = time.monotonic()
+        self.etapas = set()
+
+    def reportar(self, etapa: str, dados: dict):
+        self.etapas.add(etapa)
+        self.fila.put_nowait(
+            (etapa, {"ms": round((time.monotonic() - self.inicio) * 1000), **dados}))
+
+
+@contextmanager
+def acompanhar(acompanhamento: Acompanhamento):
+    """
+    Envia para `acompanhamento` as etapas reportadas dentro do bloco.
+    """
+    token = _acompanhamento.set(acompanhamento)
+    try:
+        yield acompanhamento
+    finally:
+        _acompanhamento.reset(token)
+
+
+def reportar(etapa: str, **dados):
+    """
+    Registra uma etapa da extração em andamento; sem acompanhamento ativo não faz nada.
+    """
+    acompanhamento = _acompanhamento.get()
+    if acompanhamento is not None:
+        acompanhamento.reportar(etapa, dados)
+
+
+def reportar_uma_vez(etapa: str, **dados):
+    """
+    Como `reportar`, mas só a primeira ocorrência (ex.: várias páginas ou chamadas em hedge).
+    """
+    acompanhamento = _acompanhamento.get()
+    if acompanhamento is not None and etapa not in acompanhamento.etapas:
+        acompanhamento.reportar(etapa, dados)
+
+
+async def marcar_primeiro_token(pedacos: AsyncIterator[str], provedor: str) -> AsyncIterator[str]:
+    """
+    Repassa o stream do modelo reportando `llm_first_token` no primeiro pedaço com texto.
+    """
+    primeiro = True
+    async for pedaco in pedacos:
+        if primeiro and pedaco:
+            primeiro = False
+            reportar_uma_vez("llm_first_token", provedor=provedor)
+        yield pedaco
@@ -0,0 +1,494 @@
+import asyncio
+import io
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import httpx
+from fastapi import HTTPException
+
+from app.executor import gemini_limiter, image_pool, mistral_limiter
+from app.image_preprocess import preprocessar_para_ocr
+from app.log_config import logger
+from app.ocr_engine import ocr_engine
+from app.progress import marcar_primeiro_token, reportar, reportar_uma_vez
+from app.providers import provider_clients
+from app.response_parser import GEMINI_STREAM, MISTRAL_JSON_MODE, configuracao_gemini, ler_stream_json, pedacos_gemini, pedacos_mistral, texto_resposta
+from app.scheduler import estimar_tokens, gemini_scheduler, mistral_scheduler
+
+# Provedores em ordem de prioridade (gemini, mistral, stub)
+PROVEDORES = [nome.strip() for nome in os.getenv(
+    "PROVEDORES", "gemini,mistral").split(",") if nome.strip()]
+
+GEMINI_EXTRACAO_MODEL = os.getenv(
+    "GEMINI_EXTRACAO_MODEL", "models/gemini-2.5-flash")
+MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
+MISTRAL_API_URL = os.getenv("MISTRAL_API_URL")
+MISTRAL_MODEL = os.getenv("MISTRAL_MODEL", "mistral-medium")
+MISTRAL_MAX_TOKENS = int(os.getenv("MISTRAL_MAX_TOKENS", "400"))
+
+# Provedor local para testes: devolve sempre o mesmo JSON
+STUB_RESPOSTA = os.getenv(
+    "STUB_RESPOSTA",
+    '{"cnpj":"00000000000000", "data":"01/01/2000", "valor":0.0, "tipo_despesa":"ESCRITORIO", "explicacao":"stub"}')
+STUB_LATENCIA_SECONDS = float(os.getenv("STUB_LATENCIA_SECONDS", "0"))
+
+# Hedge: dispara o próximo provedor se o primário não responder a tempo.
+# O atraso é o p95 do primário (mínimo ROUTER_HEDGE_MIN_SECONDS) ou
+# ROUTER_HEDGE_SECONDS enquanto não houver amostras suficientes.
+ROUTER_HEDGE_ENABLED = os.getenv(
+    "ROUTER_HEDGE_ENABLED", "true").lower() == "true"
+ROUTER_HEDGE_SECONDS = float(os.getenv("ROUTER_HEDGE_SECONDS", "10"))
+ROUTER_HEDGE_MIN_SECONDS = float(os.getenv("ROUTER_HEDGE_MIN_SECONDS", "2"))
+ROUTER_MIN_AMOSTRAS = int(os.getenv("ROUTER_MIN_AMOSTRAS", "20"))
+ROUTER_JANELA = int(os.getenv("ROUTER_JANELA", "200"))
+
+# Circuit breaker: abre após N falhas seguidas e testa de novo após o intervalo
+CIRCUIT_FALHAS = int(os.getenv("CIRCUIT_FALHAS", "5"))
+CIRCUIT_ABERTO_SECONDS = float(os.getenv("CIRCUIT_ABERTO_SECONDS", "30"))
+
+STATUS_RETENTAVEIS = {408, 429, 500, 502, 503, 504}
+
+_provedor_forcado: ContextVar[str | None] = ContextVar(
+    "provedor_forcado", default=None)
+_modelos_respondentes: ContextVar[set[str] | None] = ContextVar(
+    "modelos_respondentes", default=None)
+
+
+class ProviderError(Exception):
+    """
+    Falha de um provedor. `retentavel` indica que outro provedor pode ser tentado
+    (timeout, 429, 5xx); as demais falhas são devolvidas ao cliente.
+    """
+
+    def __init__(self, provedor: str, causa: Exception, retentavel: bool):
+        super().__init__(f"{provedor}: {causa}")
+        self.provedor = provedor
+        self.causa = causa
+        self.retentavel = retentavel
+
+
+def erro_retentavel(e: Exception) -> bool:
+    if isinstance(e, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in STATUS_RETENTAVEIS
+    # Exceções do google.api_core trazem o status HTTP em `code`
+    return getattr(e, "code", None) in STATUS_RETENTAVEIS
+
+
+class Provider:
+    """
+    Provedor de extração: recebe as partes do prompt (texto ou {"mime_type", "data"})
+    e devolve o texto da resposta do modelo.
+
+    O roteador chama `preparar` (trabalho local, ex.: OCR) e `reservar` (cota do
+    agendador) antes de medir a chamada: só o tempo e as falhas de `gerar` contam na
+    latência, no hedge e no circuit breaker do provedor.
+    """
+    nome = ""
+    modelo = ""
+
+    @property
+    def disponivel(self) -> bool:
+        return True
+
+    def aceita(self, partes: list) -> bool:
+        return True
+
+    async def preparar(self, partes: list) -> list:
+        return partes
+
+    async def reservar(self, partes: list):
+        pass
+
+    async def gerar(self, partes: list) -> str:
+        raise NotImplementedError
+
+
+class GeminiProvider(Provider):
+    nome = "gemini"
+    modelo = GEMINI_EXTRACAO_MODEL
+
+    async def reservar(self, partes: list):
+        await gemini_scheduler.reservar(estimar_tokens(partes))
+
+    async def gerar(self, partes: list) -> str:
+        try:
+            return await gemini_limiter.run(self._gerar, partes)
+        except Exception as e:
+            if getattr(e, "code", None) == 429:
+                gemini_scheduler.cota_excedida()
+            raise
+
+    async def _gerar(self, partes: list) -> str:
+        model = provider_clients.gemini(self.modelo)
+        response = await model.generate_content_async(
+            partes,
+            stream=GEMINI_STREAM,
+            generation_config=configuracao_gemini(),
+            request_options=provider_clients.gemini_options)
+        if not GEMINI_STREAM:
+            reportar_uma_vez("llm_first_token", provedor=self.nome)
+            return texto_resposta(response).strip()
+        return await ler_stream_json(
+            marcar_primeiro_token(pedacos_gemini(response), self.nome))
+
+
+class MistralProvider(Provider):
+    """
+    Mistral só recebe texto: imagens passam antes pelo OCR local.
+    """
+    nome = "mistral"
+    modelo = MISTRAL_MODEL
+
+    @property
+    def disponivel(self) -> bool:
+        return bool(MISTRAL_API_URL and MISTRAL_API_KEY)
+
+    def aceita(self, partes: list) -> bool:
+        return all(not isinstance(parte, dict) or parte["mime_type"].startswith("image/")
+                   for parte in partes)
+
+    async def preparar(self, partes: list) -> list:
+        textos = []
+        for parte in partes:
+            if isinstance(parte, dict):
+                image = await image_pool.run(preprocessar_para_ocr, io.BytesIO(parte["data"]))
+                texto_ocr = await ocr_engine.reconhecer(image)
+                reportar("ocr_done", caracteres=len(texto_ocr), provedor=self.nome)
+                textos.append(f"Texto extraído via OCR:\n---\n{texto_ocr}\n---")
+            else:
+                textos.append(str(parte))
+        return textos
+
+    async def reservar(self, partes: list):
+        await mistral_scheduler.reservar(estimar_tokens(partes))
+
+    async def gerar(self, partes: list) -> str:
+        textos = partes
+        payload = {
+            "model": self.modelo,
+            "messages": [{"role": "user", "content": "\n\n".join(textos)}],
+            "temperature": 0.3,
+            "max_tokens": MISTRAL_MAX_TOKENS,
+            "stream": True,
+        }
+        if MISTRAL_JSON_MODE:
+            payload["response_format"] = {"type": "json_object"}
+
+        return await mistral_limiter.run(self._gerar, payload)
+
+    async def _gerar(self, payload: dict) -> str:
+        headers = {
+            "Authorization": f"Bearer {MISTRAL_API_KEY}",
+            "Content-Type": "application/json"
+        }
+        client = provider_clients.http("mistral")
+        async with client.stream("POST", MISTRAL_API_URL, headers=headers, json=payload) as resp:
+            if resp.status_code >= 400:
+                await resp.aread()
+                if resp.status_code == 429:
+                    mistral_scheduler.cota_excedida()
+                resp.raise_for_status()
+            return await ler_stream_json(
+                marcar_primeiro_token(pedacos_mistral(resp.aiter_lines()), self.nome))
+
+
+class StubProvider(Provider):
+    nome = "stub"
+    modelo = "stub"
+
+    async def gerar(self, partes: list) -> str:
+        if STUB_LATENCIA_SECONDS:
+            await asyncio.sleep(STUB_LATENCIA_SECONDS)
+        return STUB_RESPOSTA
+
+
+class ProviderStats:
+    """
+    Latências (janela de ROUTER_JANELA chamadas), taxa de erro e circuit breaker de um provedor.
+    """
+
+    def __init__(self):
+        self.latencias = deque(maxlen=ROUTER_JANELA)
+        self.resultados = deque(maxlen=ROUTER_JANELA)
+        self.chamadas = 0
+        self.falhas = 0
+        self.falhas_seguidas = 0
+        self.aberto_ate = 0.0
+        self.sondando = False
+
+    @property
+    def circuito(self) -> str:
+        if self.falhas_seguidas < CIRCUIT_FALHAS:
+            return "FECHADO"
+        if time.monotonic() < self.aberto_ate:
+            return "ABERTO"
+        return "SEMIABERTO"
+
+    def permitir(self) -> bool:
+        """
+        Reserva uma chamada. No estado SEMIABERTO só uma chamada de teste passa por vez.
+        """
+        circuito = self.circuito
+        if circuito == "ABERTO":
+            return False
+        if circuito == "SEMIABERTO":
+            if self.sondando:
+                return False
+            self.sondando = True
+        return True
+
+    def registrar_sucesso(self, latencia: float):
+        self.chamadas += 1
+        self.latencias.append(latencia)
+        self.resultados.append(True)
+        self.falhas_seguidas = 0
+        self.sondando = False
+
+    def registrar_falha(self):
+        self.chamadas += 1
+        self.falhas += 1
+        self.resultados.append(False)
+        self.falhas_seguidas += 1
+        self.sondando = False
+        if self.falhas_seguidas >= CIRCUIT_FALHAS:
+            self.aberto_ate = time.monotonic() + CIRCUIT_ABERTO_SECONDS
+
+    def liberar(self):
+        """
+        Chamada interrompida (hedge perdedor, cancelamento, fila do agendador esgotada):
+        não conta como sucesso nem falha.
+        """
+        self.sondando = False
+
+    def percentil(self, p: float) -> float | None:
+        if not self.latencias:
+            return None
+        ordenadas = sorted(self.latencias)
+        return ordenadas[min(len(ordenadas) - 1, int(p * len(ordenadas)))]
+
+    def metrics(self) -> dict:
+        p50 = self.percentil(0.5)
+        p95 = self.percentil(0.95)
+        return {
+            "chamadas": self.chamadas,
+            "falhas": self.falhas,
+            "taxa_erro": round(self.resultados.count(False) / len(self.resultados), 3)
+            if self.resultados else 0.0,
+            "p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000) if p95 is not None else None,
+            "circuito": self.circuito,
+        }
+
+
+class ProviderRouter:
+    """
+    Encaminha as extrações para os provedores em ordem de prioridade.
+
+    Se o primário falhar com erro retentável (timeout, 429, 5xx) o próximo é chamado;
+    se demorar mais que o atraso de hedge, o próximo é disparado em paralelo e vale a
+    primeira resposta. Provedores com o circuito aberto são pulados.
+    """
+
+    def __init__(self, provedores: list[Provider], ordem: list[str]):
+        self.provedores = {provedor.nome: provedor for provedor in provedores}
+        desconhecidos = [nome for nome in ordem if nome not in self.provedores]
+        if desconhecidos:
+            raise ValueError(f"Provedores desconhecidos em PROVEDORES: {desconhecidos}")
+        self.ordem = ordem
+        self.stats = {nome: ProviderStats() for nome in self.provedores}
+        self.hedges = 0
+        self.fallbacks = 0
+
+    def validar(self, nome: str | None) -> str | None:
+        if nome and nome not in self.provedores:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Provedor inválido. Use {', '.join(self.provedores)}.",
+            )
+        return nome or None
+
+    def modelo(self) -> str:
+        """
+        Modelo do provedor preferido para a requisição (usado na busca do cache de extração).
+        A resposta pode vir de outro provedor (failover ou hedge): veja `gerar`.
+        """
+        nome = _provedor_forcado.get() or self.ordem[0]
+        return self.provedores[nome].modelo
+
+    def candidatos(self, partes: list) -> list[Provider]:
+        forcado = _provedor_forcado.get()
+        nomes = [forcado] if forcado else self.ordem
+        return [self.provedores[nome] for nome in nomes
+                if self.provedores[nome].disponivel and self.provedores[nome].aceita(partes)]
+
+    def atraso_hedge(self, provedor: Provider) -> float:
+        stats = self.stats[provedor.nome]
+        if len(stats.latencias) < ROUTER_MIN_AMOSTRAS:
+            return ROUTER_HEDGE_SECONDS
+        return max(stats.percentil(0.95), ROUTER_HEDGE_MIN_SECONDS)
+
+    async def _chamar(self, provedor: Provider, partes: list, iniciada: asyncio.Event) -> str:
+        """
+        Prepara e reserva a cota fora da medição: a espera na fila do agendador (e o 503
+        quando ela estoura) é local, não uma falha ou lentidão do provedor. `iniciada` é
+        sinalizado quando a chamada ao provedor começa, para o relógio do hedge.
+        """
+        stats = self.stats[provedor.nome]
+        partes = await provedor.preparar(partes)
+        await provedor.reservar(partes)
+
+        iniciada.set()
+        inicio = time.monotonic()
+        try:
+            texto = await provedor.gerar(partes)
+        except Exception as e:
+            stats.registrar_falha()
+            raise ProviderError(provedor.nome, e, erro_retentavel(e)) from e
+        stats.registrar_sucesso(time.monotonic() - inicio)
+        return texto
+
+    def _criar_chamada(self, provedor: Provider, partes: list, iniciada: asyncio.Event) -> asyncio.Task:
+        """
+        Dispara `_chamar` numa tarefa. A vaga reservada em `permitir` é devolvida quando a
+        tarefa termina sem registrar sucesso nem falha, inclusive cancelada antes de começar
+        (o corpo de `_chamar` nem chega a executar).
+        """
+        stats = self.stats[provedor.nome]
+
+        def encerrar(tarefa: asyncio.Task):
+            if tarefa.cancelled() or not isinstance(tarefa.exception(), (ProviderError, type(None))):
+                stats.liberar()
+
+        tarefa = asyncio.create_task(self._chamar(provedor, partes, iniciada))
+        tarefa.add_done_callback(encerrar)
+        return tarefa
+
+    async def gerar(self, partes: list) -> tuple[str, Provider]:
+        """
+        Retorna o texto da resposta e o provedor que de fato respondeu.
+        """
+        fila = iter(self.candidatos(partes))
+        pendentes: dict[asyncio.Task, Provider] = {}
+        iniciadas: dict[asyncio.Task, asyncio.Event] = {}
+        ultimo_erro = None
+
+        def disparar() -> bool:
+            for provedor in fila:
+                if self.stats[provedor.nome].permitir():
+                    iniciada = asyncio.Event()
+                    tarefa = self._criar_chamada(provedor, partes, iniciada)
+                    pendentes[tarefa] = provedor
+                    iniciadas[tarefa] = iniciada
+                    return True
+            return False
+
+        if not disparar():
+            raise HTTPException(
+                status_code=503, detail="Nenhum provedor de extração disponível.")
+
+        try:
+            hedge_disponivel = ROUTER_HEDGE_ENABLED
+            while pendentes:
+                atraso = None
+                if hedge_disponivel and len(pendentes) == 1:
+                    tarefa, provedor = next(iter(pendentes.items()))
+                    if not iniciadas[tarefa].is_set():
+                        # Ainda na fila do agendador: o hedge só conta a partir da chamada
+                        inicio = asyncio.create_task(iniciadas[tarefa].wait())
+                        await asyncio.wait({tarefa, inicio}, return_when=asyncio.FIRST_COMPLETED)
+                        inicio.cancel()
+                        if not tarefa.done():
+                            continue
+                    else:
+                        atraso = self.atraso_hedge(provedor)
+
+                concluidas, _ = await asyncio.wait(
+                    pendentes, timeout=atraso, return_when=asyncio.FIRST_COMPLETED)
+
+                if not concluidas:
+                    # Primário lento: dispara o próximo provedor em paralelo
+                    hedge_disponivel = False
+                    if disparar():
+                        self.hedges += 1
+                    continue
+
+                for tarefa in concluidas:
+                    provedor = pendentes.pop(tarefa)
+                    try:
+                        return tarefa.result(), provedor
+                    except ProviderError as e:
+                        if not e.retentavel:
+                            raise e.causa
+                        logger.warning(f"Provedor {provedor.nome} falhou: {e.causa}")
+                        ultimo_erro = e
+                    except HTTPException:
+                        # Fila do agendador esgotada (local): vale a chamada ainda em andamento
+                        if not pendentes:
+                            raise
+
+                if not pendentes and disparar():
+                    self.fallbacks += 1
+        finally:
+            for tarefa in pendentes:
+                tarefa.cancel()
+
+        raise HTTPException(
+            status_code=503,
+            detail=f"Provedores de extração indisponíveis: {ultimo_erro}",
+        )
+
+    def metrics(self) -> dict:
+        return {
+            "ordem": self.ordem,
+            "hedges": self.hedges,
+            "fallbacks": self.fallbacks,
+            "provedores": {
+                nome: {
+                    "disponivel": provedor.disponivel,
+                    "modelo": provedor.modelo,
+                    **self.stats[nome].metrics(),
+                }
+                for nome, provedor in self.provedores.items()
+            },
+        }
+
+
+@contextmanager
+def usar_provedor(nome: str | None):
+    """
+    Força um provedor (sem failover) nas extrações feitas dentro do bloco.
+    """
+    token = _provedor_forcado.set(nome)
+    try:
+        yield
+    finally:
+        _provedor_forcado.reset(token)
+
+
+@contextmanager
+def coletar_modelos():
+    """
+    Reúne em um conjunto os modelos que responderam às chamadas feitas dentro do bloco
+    (anotados com `anotar_modelo`), para gravar o resultado no cache com o modelo certo.
+    """
+    modelos: set[str] = set()
+    token = _modelos_respondentes.set(modelos)
+    try:
+        yield modelos
+    finally:
+        _modelos_respondentes.reset(token)
+
+
+def anotar_modelo(provedor: Provider):
+    modelos = _modelos_respondentes.get()
+    if modelos is not None:
+        modelos.add(provedor.modelo)
+
+
+provider_router = ProviderRouter(
+    [GeminiProvider(), MistralProvider(), StubProvider()], PROVEDORES)
@@ -0,0 +1,76 @@
+import os
+
+import google.generativeai as genai
+import httpx
+
+# Timeouts por provedor (segundos)
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "60"))
+MISTRAL_TIMEOUT_SECONDS = float(os.getenv("MISTRAL_TIMEOUT_SECONDS", "60"))
+CALLBACK_TIMEOUT_SECONDS = float(
+    os.getenv("JOB_CALLBACK_TIMEOUT_SECONDS", "10"))
+
+# Pool de conexões HTTP (keep-alive) de cada cliente
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "32"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "16"))
+HTTP_KEEPALIVE_EXPIRY_SECONDS = float(
+    os.getenv("HTTP_KEEPALIVE_EXPIRY_SECONDS", "60"))
+
+
+class ProviderClients:
+    """
+    Clientes dos provedores compartilhados entre requisições.
+
+    Instâncias de `GenerativeModel` são reaproveitadas por nome de modelo (o cliente gRPC
+    do Gemini mantém a conexão aberta) e cada provedor HTTP tem um `httpx.AsyncClient`
+    com pool keep-alive, evitando um handshake TCP+TLS por chamada. Criado no lifespan
+    e fechado no shutdown; fora da API (worker, scripts) os clientes são criados sob demanda.
+    """
+
+    def __init__(self):
+        self._modelos: dict[str, genai.GenerativeModel] = {}
+        self._http: dict[str, httpx.AsyncClient] = {}
+        self.timeouts = {
+            "gemini": GEMINI_TIMEOUT_SECONDS,
+            "mistral": MISTRAL_TIMEOUT_SECONDS,
+            "callback": CALLBACK_TIMEOUT_SECONDS,
+        }
+
+    def gemini(self, modelo: str) -> genai.GenerativeModel:
+        if modelo not in self._modelos:
+            self._modelos[modelo] = genai.GenerativeModel(modelo)
+        return self._modelos[modelo]
+
+    @property
+    def gemini_options(self) -> dict:
+        """
+        `request_options` das chamadas ao Gemini (timeout do provedor).
+        """
+        return {"timeout": self.timeouts["gemini"]}
+
+    def http(self, provedor: str) -> httpx.AsyncClient:
+        cliente = self._http.get(provedor)
+        if cliente is None or cliente.is_closed:
+            cliente = httpx.AsyncClient(
+                timeout=self.timeouts[provedor],
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS,
+                ),
+            )
+            self._http[provedor] = cliente
+        return cliente
+
+    def iniciar(self, modelos: list[str]):
+        for modelo in modelos:
+            self.gemini(modelo)
+        self.http("mistral")
+
+    async def fechar(self):
+        for cliente in self._http.values():
+            await cliente.aclose()
+        self._http.clear()
+        self._modelos.clear()
+
+
+provider_clients = ProviderClients()
@@ -0,0 +1,161 @@
+import json
+import os
+from typing import AsyncIterator
+
+from fastapi import HTTPException
+
+# Geração em streaming e saída JSON estrita (response_mime_type / response_schema)
+GEMINI_STREAM = os.getenv("GEMINI_STREAM", "true").lower() == "true"
+GEMINI_JSON_MODE = os.getenv("GEMINI_JSON_MODE", "true").lower() == "true"
+GEMINI_RESPONSE_SCHEMA = os.getenv(
+    "GEMINI_RESPONSE_SCHEMA", "true").lower() == "true"
+MISTRAL_JSON_MODE = os.getenv("MISTRAL_JSON_MODE", "true").lower() == "true"
+
+# Todos os campos são opcionais: o mesmo schema serve para a nota inteira, uma página
+# de PDF ou só a classificação da despesa.
+SCHEMA_NOTA_FISCAL = {
+    "type": "OBJECT",
+    "properties": {
+        "cnpj": {"type": "STRING", "nullable": True},
+        "data": {"type": "STRING", "nullable": True},
+        "valor": {"type": "NUMBER", "nullable": True},
+        "tipo_despesa": {"type": "STRING", "nullable": True},
+        "explicacao": {"type": "STRING", "nullable": True},
+    },
+}
+
+
+def configuracao_gemini() -> dict | None:
+    """
+    `generation_config` das extrações: pede ao Gemini JSON estrito (sem blocos ```json).
+    """
+    if not GEMINI_JSON_MODE:
+        return None
+    configuracao = {"response_mime_type": "application/json"}
+    if GEMINI_RESPONSE_SCHEMA:
+        configuracao["response_schema"] = SCHEMA_NOTA_FISCAL
+    return configuracao
+
+
+class JsonIncremental:
+    """
+    Recebe a resposta do modelo em pedaços e reconhece o primeiro objeto JSON assim que
+    a chave de fechamento chega. Texto antes (```json, comentários) e depois do objeto
+    (explicações em prosa, fechamento do bloco) é ignorado.
+    """
+
+    def __init__(self):
+        self.texto = ""
+        self.resultado: dict | None = None
+        self.json_texto: str | None = None
+        self._pos = 0
+        self._inicio = None
+        self._profundidade = 0
+        self._em_string = False
+        self._escape = False
+
+    @property
+    def completo(self) -> bool:
+        return self.resultado is not None
+
+    def alimentar(self, pedaco: str) -> dict | None:
+        """
+        Acrescenta um pedaço da resposta; retorna o objeto quando ele estiver completo.
+        """
+        if self.completo:
+            return self.resultado
+        self.texto += pedaco
+
+        while self._pos < len(self.texto):
+            caractere = self.texto[self._pos]
+            self._pos += 1
+
+            if self._inicio is None:
+                if caractere == "{":
+                    self._inicio = self._pos - 1
+                    self._profundidade = 1
+                continue
+
+            if self._em_string:
+                if self._escape:
+                    self._escape = False
+                elif caractere == "\\":
+                    self._escape = True
+                elif caractere == '"':
+                    self._em_string = False
+                continue
+
+            if caractere == '"':
+                self._em_string = True
+            elif caractere == "{":
+                self._profundidade += 1
+            elif caractere == "}":
+                self._profundidade -= 1
+                if self._profundidade == 0:
+                    candidato = self.texto[self._inicio:self._pos]
+                    try:
+                        objeto = json.loads(candidato)
+                    except json.JSONDecodeError:
+                        # Chaves dentro de prosa: procura o próximo objeto
+                        self._pos = self._inicio + 1
+                        self._inicio = None
+                        continue
+                    self.resultado = objeto
+                    self.json_texto = candidato
+                    return objeto
+        return None
+
+
+def decodificar_json(raw_response: str, origem: str) -> dict:
+    """
+    Decodifica o primeiro objeto JSON da resposta do modelo, com ou sem bloco ```json.
+    """
+    parser = JsonIncremental()
+    resultado = parser.alimentar(raw_response)
+    if resultado is None:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Erro ao decodificar JSON da resposta {origem}: {raw_response}",
+        )
+    return resultado
+
+
+async def ler_stream_json(pedacos: AsyncIterator[str]) -> str:
+    """
+    Consome o stream até o objeto JSON fechar e devolve só o texto do objeto, sem esperar
+    o restante da geração. Se o objeto não fechar, devolve o texto recebido.
+    """
+    parser = JsonIncremental()
+    async for pedaco in pedacos:
+        if parser.alimentar(pedaco) is not None:
+            return parser.json_texto
+    return parser.texto
+
+
+def texto_resposta(response) -> str:
+    """
+    Texto de uma resposta (ou de um pedaço do stream) do Gemini.
+    """
+    return "".join(
+        [part.text for part in response.parts if hasattr(part, "text")])
+
+
+async def pedacos_gemini(response) -> AsyncIterator[str]:
+    async for pedaco in response:
+        yield texto_resposta(pedaco)
+
+
+async def pedacos_mistral(linhas: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Texto dos eventos `data:` do streaming (SSE) da API de chat do Mistral.
+    """
+    async for linha in linhas:
+        if not linha.startswith("data:"):
+            continue
+        dados = linha[len("data:"):].strip()
+        if dados == "[DONE]":
+            return
+        escolhas = json.loads(dados).get("choices") or [{}]
+        conteudo = (escolhas[0].get("delta") or {}).get("content")
+        if conteudo:
+            yield conteudo
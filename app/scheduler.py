@@ -0,0 +1,281 @@
+import asyncio
+import copy
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi import HTTPException
+
+# Cotas por provedor (0 = sem limite)
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "0"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "0"))
+MISTRAL_RPM = int(os.getenv("MISTRAL_RPM", "0"))
+MISTRAL_TPM = int(os.getenv("MISTRAL_TPM", "0"))
+
+# Tempo máximo na fila antes de responder 503 com Retry-After
+AGENDADOR_MAX_ESPERA_SECONDS = float(
+    os.getenv("AGENDADOR_MAX_ESPERA_SECONDS", "120"))
+
+# Estimativa de tokens usada no balde de TPM (a conta exata só vem na resposta)
+TOKENS_POR_IMAGEM = int(os.getenv("TOKENS_POR_IMAGEM", "258"))
+TOKENS_RESPOSTA = int(os.getenv("TOKENS_RESPOSTA", "400"))
+
+# Prioridades: menor valor sai primeiro da fila
+PRIORIDADE_INTERATIVA = 0
+PRIORIDADE_LOTE = 1
+PRIORIDADE_JOB = 2
+NOMES_PRIORIDADE = {
+    PRIORIDADE_INTERATIVA: "interativa",
+    PRIORIDADE_LOTE: "lote",
+    PRIORIDADE_JOB: "job",
+}
+
+_prioridade: ContextVar[int] = ContextVar(
+    "prioridade", default=PRIORIDADE_INTERATIVA)
+
+AGENDADORES = []
+
+
+@contextmanager
+def usar_prioridade(prioridade: int):
+    """
+    Define a prioridade das chamadas aos modelos feitas dentro do bloco.
+    """
+    token = _prioridade.set(prioridade)
+    try:
+        yield
+    finally:
+        _prioridade.reset(token)
+
+
+def estimar_tokens(partes: list) -> int:
+    """
+    Estimativa grosseira: ~4 caracteres por token, um valor fixo por imagem e a resposta.
+    """
+    tokens = TOKENS_RESPOSTA
+    for parte in partes:
+        if isinstance(parte, dict):
+            tokens += TOKENS_POR_IMAGEM
+        else:
+            tokens += math.ceil(len(str(parte)) / 4)
+    return tokens
+
+
+class TokenBucket:
+    """
+    Balde de fichas reposto continuamente a `por_minuto` fichas por minuto.
+    """
+
+    def __init__(self, por_minuto: int):
+        self.capacidade = por_minuto
+        self.saldo = float(por_minuto)
+        self._atualizado = time.monotonic()
+
+    @property
+    def ilimitado(self) -> bool:
+        return self.capacidade <= 0
+
+    def _repor(self):
+        agora = time.monotonic()
+        self.saldo = min(self.capacidade, self.saldo +
+                         (agora - self._atualizado) * self.capacidade / 60)
+        self._atualizado = agora
+
+    def espera(self, quantidade: int) -> float:
+        """
+        Segundos até haver `quantidade` fichas (limitada à capacidade do balde).
+        """
+        if self.ilimitado:
+            return 0.0
+        self._repor()
+        falta = min(quantidade, self.capacidade) - self.saldo
+        return max(0.0, falta * 60 / self.capacidade)
+
+    def consumir(self, quantidade: int):
+        if not self.ilimitado:
+            self._repor()
+            self.saldo -= min(quantidade, self.capacidade)
+
+    def esvaziar(self):
+        if not self.ilimitado:
+            self._repor()
+            self.saldo = min(self.saldo, 0.0)
+
+
+class _Entrada:
+    def __init__(self, prioridade: int, ordem: int, tokens: int):
+        self.prioridade = prioridade
+        self.ordem = ordem
+        self.tokens = tokens
+        self.vez: asyncio.Future | None = None
+
+    def __lt__(self, outra: "_Entrada"):
+        return (self.prioridade, self.ordem) < (outra.prioridade, outra.ordem)
+
+
+class RateScheduler:
+    """
+    Fila de prioridade na frente das chamadas a um provedor, liberadas conforme os baldes
+    de requisições (RPM) e tokens (TPM). Só o primeiro da fila aguarda a reposição dos
+    baldes; os demais esperam a vez sem consumir CPU.
+    """
+
+    def __init__(self, nome: str, rpm: int, tpm: int):
+        self.nome = nome
+        self.rpm = TokenBucket(rpm)
+        self.tpm = TokenBucket(tpm)
+        self._fila: list[_Entrada] = []
+        self._ordem = itertools.count()
+        self.esperas = deque(maxlen=500)
+        self.espera_max = 0.0
+        self.liberadas = {nome: 0 for nome in NOMES_PRIORIDADE.values()}
+        self.expiradas = 0
+        self.cotas_excedidas = 0
+        AGENDADORES.append(self)
+
+    def _avisar_primeiro(self):
+        if self._fila:
+            primeiro = self._fila[0]
+            if primeiro.vez is not None and not primeiro.vez.done():
+                primeiro.vez.set_result(None)
+
+    async def reservar(self, tokens: int):
+        """
+        Aguarda a vez na fila (pela prioridade do contexto) e consome as fichas da chamada.
+        """
+        prioridade = _prioridade.get()
+        entrada = _Entrada(prioridade, next(self._ordem), tokens)
+        inicio = time.monotonic()
+        limite = inicio + AGENDADOR_MAX_ESPERA_SECONDS
+        loop = asyncio.get_running_loop()
+
+        heapq.heappush(self._fila, entrada)
+        self._avisar_primeiro()
+        try:
+            while True:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    self.expiradas += 1
+                    raise HTTPException(
+                        status_code=503,
+                        detail=f"Fila de chamadas ao {self.nome} excedeu {AGENDADOR_MAX_ESPERA_SECONDS:.0f}s.",
+                        headers={"Retry-After": str(math.ceil(AGENDADOR_MAX_ESPERA_SECONDS / 4))},
+                    )
+
+                if self._fila[0] is not entrada:
+                    entrada.vez = loop.create_future()
+                    try:
+                        await asyncio.wait_for(entrada.vez, restante)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                espera = max(self.rpm.espera(1), self.tpm.espera(tokens))
+                if espera <= 0:
+                    heapq.heappop(self._fila)
+                    self.rpm.consumir(1)
+                    self.tpm.consumir(tokens)
+                    break
+                # Acorda periodicamente para ceder a vez a uma chamada mais prioritária
+                await asyncio.sleep(min(espera, restante, 0.5))
+        except BaseException:
+            if entrada in self._fila:
+                self._fila.remove(entrada)
+                heapq.heapify(self._fila)
+            raise
+        finally:
+            self._avisar_primeiro()
+
+        espera_total = time.monotonic() - inicio
+        self.esperas.append(espera_total)
+        self.espera_max = max(self.espera_max, espera_total)
+        self.liberadas[NOMES_PRIORIDADE.get(prioridade, str(prioridade))] += 1
+
+    def cota_excedida(self):
+        """
+        O provedor respondeu 429 mesmo dentro da cota estimada: esvazia o balde de
+        requisições para que as próximas aguardem a reposição em vez de insistir.
+        """
+        self.cotas_excedidas += 1
+        self.rpm.esvaziar()
+
+    def metrics(self) -> dict:
+        esperas = sorted(self.esperas)
+        return {
+            "nome": self.nome,
+            "rpm": self.rpm.capacidade or None,
+            "tpm": self.tpm.capacidade or None,
+            "em_fila": len(self._fila),
+            "liberadas": self.liberadas,
+            "espera_media_ms": round(sum(esperas) / len(esperas) * 1000) if esperas else 0,
+            "espera_p95_ms": round(esperas[min(len(esperas) - 1, int(0.95 * len(esperas)))] * 1000)
+            if esperas else 0,
+            "espera_max_ms": round(self.espera_max * 1000),
+            "expiradas": self.expiradas,
+            "cotas_excedidas": self.cotas_excedidas,
+        }
+
+
+class SingleFlight:
+    """
+    Junta chamadas concorrentes com a mesma chave: a primeira executa e as demais
+    recebem uma cópia do mesmo resultado (ou da mesma exceção).
+    """
+
+    def __init__(self):
+        self._em_andamento: dict[str, asyncio.Future] = {}
+        self.compartilhadas = 0
+
+    async def executar(self, chave: str, func):
+        while True:
+            futuro = self._em_andamento.get(chave)
+            if futuro is None:
+                break
+            self.compartilhadas += 1
+            try:
+                return copy.deepcopy(await asyncio.shield(futuro))
+            except asyncio.CancelledError:
+                # A chamada original foi cancelada: tenta de novo (ou assume a execução)
+                if futuro.cancelled():
+                    continue
+                raise
+
+        futuro = asyncio.get_running_loop().create_future()
+        self._em_andamento[chave] = futuro
+        try:
+            resultado = await func()
+        except asyncio.CancelledError:
+            futuro.cancel()
+            raise
+        except Exception as e:
+            futuro.set_exception(e)
+            futuro.exception()  # evita o aviso de exceção não lida sem outros interessados
+            raise
+        finally:
+            del self._em_andamento[chave]
+
+        futuro.set_result(resultado)
+        return copy.deepcopy(resultado)
+
+    def metrics(self) -> dict:
+        return {
+            "em_andamento": len(self._em_andamento),
+            "compartilhadas": self.compartilhadas,
+        }
+
+
+gemini_scheduler = RateScheduler("gemini", GEMINI_RPM, GEMINI_TPM)
+mistral_scheduler = RateScheduler("mistral", MISTRAL_RPM, MISTRAL_TPM)
+extracoes_em_andamento = SingleFlight()
+
+
+def scheduler_metrics() -> dict:
+    return {
+        "agendadores": [agendador.metrics() for agendador in AGENDADORES],
+        "single_flight": extracoes_em_andamento.metrics(),
+    }
@@ -1,3 +1,5 @@
+from datetime import date
+from decimal import Decimal
 from typing import List
 from pydantic import BaseModel
 
@@ -6,14 +8,18 @@ from pydantic import BaseModel
 
 class PromptRequest(BaseModel):
     prompt: str
+    stream: bool = False
 
 
 class ConfigurationRequest(BaseModel):
     prompt: str
+    tipo_documento: str | None = None  # xml / imagem / pdf; vazio = todos
 
 
 class ConfigurationResponse(BaseModel):
     prompt: str
+    tipo_documento: str | None = None
+    versao: int | None = None
 
 # --- Dados de Nota Fiscal ---
 
@@ -25,12 +31,29 @@ class InvoiceResponse(BaseModel):
     data_emissao: str | None = None
     valor_total: float | None = None
     imagem_hash: str | None = None
+    imagem_phash: str | None = None
+    possivel_duplicada: int | None = None
+    prompt_versao: int | None = None
+    valor_centavos: int | None = None
+    emissao: date | None = None
+    versao: int | None = None
     # observacao: str = "Dados extraídos. A precisão depende da qualidade da imagem e do modelo LLM."
     # nome_arquivo_imagem: str | None = None # Novo campo para o nome do arquivo da imagem
     status: str | None = None  # Novo campo para o status da persistência
 
 
 # --- Dados de Nota Fiscal ---
+class InvoiceSummaryResponse(BaseModel):
+    tipo_despesa: str | None = None
+    cnpj: str | None = None
+    mes: str | None = None  # AAAA-MM da data de emissão
+    quantidade: int
+    total: str | None = None
+    media: str | None = None
+    minimo: str | None = None
+    maximo: str | None = None
+
+
 class InvoiceRequest(BaseModel):
     id: int | None = None
     tipo_despesa: str | None = None
@@ -39,6 +62,49 @@ class InvoiceRequest(BaseModel):
     valor_total: float | None = None
     imagem_hash: str | None = None
     status: str | None = None  # Novo campo para o status da persistência
+    versao: int | None = None  # versão lida; se a nota mudou desde então, o PUT responde 409
+
+
+# --- Operações em lote ---
+
+
+class InvoiceVersao(BaseModel):
+    id: int
+    versao: int | None = None  # sem versão, altera a nota em qualquer versão
+
+
+class InvoiceFiltro(BaseModel):
+    cnpj: str | None = None
+    tipo_despesa: str | None = None
+    data_inicio: date | None = None
+    data_fim: date | None = None
+    valor_min: Decimal | None = None
+    valor_max: Decimal | None = None
+
+
+class InvoiceLoteRequest(BaseModel):
+    # Informe as notas (com a versão lida) ou um filtro
+    notas: List[InvoiceVersao] | None = None
+    filtro: InvoiceFiltro | None = None
+    origem: List[str] | None = None  # status atuais aceitos; vazio = qualquer um
+
+
+class InvoiceStatusRequest(InvoiceLoteRequest):
+    status: str = "PROCESSADO"
+    origem: List[str] | None = ["PENDENTE", "CHECKING"]
+
+# --- Jobs de extração ---
+
+
+class JobResponse(BaseModel):
+    id: int
+    status: str
+    arquivo: str | None = None
+    imagem_hash: str | None = None
+    invoice_id: int | None = None
+    erro: str | None = None
+    tentativas: int | None = None
+    callback_url: str | None = None
 
 # Esquemas para a requisição e resposta
 
@@ -0,0 +1,150 @@
+import asyncio
+import io
+import os
+from pathlib import Path
+
+os.environ.setdefault("GOOGLE_API_KEY", "teste")
+
+import pytest
+from fastapi import HTTPException
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+import app.dedupe as dedupe
+import app.main as main
+from app.database import Base
+from app.dedupe import PerceptualIndex
+from app.hash_util import distancia_hamming, gerar_hash_perceptual
+from app.ingest import UploadSpool
+from app.models import Invoice
+
+NOTAS = Path(__file__).resolve().parent.parent / "notas-fiscais"
+
+PHASH_A = "0" * 35 + "1"
+PHASH_B = "f" * 36
+
+
+@pytest.fixture
+def sessoes(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'invoices.db'}")
+
+    async def criar():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    asyncio.run(criar())
+    yield async_sessionmaker(bind=engine, expire_on_commit=False)
+    asyncio.run(engine.dispose())
+
+
+async def _gravar(sessoes, **campos) -> Invoice:
+    async with sessoes() as session:
+        invoice = Invoice(status="PENDENTE", **campos)
+        session.add(invoice)
+        await session.commit()
+        return invoice
+
+
+async def _buscar(sessoes, indice: PerceptualIndex, phash: str):
+    async with sessoes() as session:
+        return await indice.buscar(session, phash)
+
+
+def test_nota_de_outro_processo_com_id_menor_entra_no_indice(sessoes):
+    indice = PerceptualIndex(distancia_maxima=0)
+
+    async def cenario():
+        # Outro processo grava a nota 1; este grava e registra a nota 2 antes de ler a 1
+        await _gravar(sessoes, id=1, imagem_hash="a", imagem_phash=PHASH_A)
+        local = await _gravar(sessoes, id=2, imagem_hash="b", imagem_phash=PHASH_B)
+        indice.registrar(local.imagem_phash, local.id)
+        return await _buscar(sessoes, indice, PHASH_A)
+
+    encontrada = asyncio.run(cenario())
+    assert encontrada is not None and encontrada[0].id == 1
+
+
+def test_nota_confirmada_fora_de_ordem_entra_no_indice(sessoes):
+    indice = PerceptualIndex(distancia_maxima=0)
+
+    async def cenario():
+        await _gravar(sessoes, id=2, imagem_hash="b", imagem_phash=PHASH_B)
+        assert await _buscar(sessoes, indice, PHASH_A) is None
+        # A transação que reservou o id 1 confirma depois da leitura do id 2
+        await _gravar(sessoes, id=1, imagem_hash="a", imagem_phash=PHASH_A)
+        return await _buscar(sessoes, indice, PHASH_A)
+
+    encontrada = asyncio.run(cenario())
+    assert encontrada is not None and encontrada[0].id == 1
+
+
+# Uma linha (valor ou data) trocada em notas de exemplo: o pHash quase não muda
+EDICOES = {
+    "nota2.PNG": ((360, 66, 570, 78), "123,45"),
+    "nota5.PNG": ((360, 382, 570, 391), "18/05/2025"),
+    "talo-de-conta-de-luz-na-foto-talo-de-conta-de-luz-da-copel-P42A50.jpg": ((532, 774, 843, 784), "98,76"),
+}
+
+
+def _imagem(nome: str, editada: bool = False) -> bytes:
+    image = ImageOps.exif_transpose(Image.open(NOTAS / nome)).convert("RGB")
+    if editada:
+        caixa, texto = EDICOES[nome]
+        desenho = ImageDraw.Draw(image)
+        desenho.rectangle(caixa, fill=(255, 255, 255))
+        desenho.text((caixa[0] + 2, caixa[1]), texto, fill=(0, 0, 0),
+                     font=ImageFont.load_default(size=caixa[3] - caixa[1]))
+    saida = io.BytesIO()
+    image.save(saida, "JPEG", quality=95)
+    return saida.getvalue()
+
+
+@pytest.fixture
+def processar(sessoes, monkeypatch):
+    monkeypatch.setattr(dedupe, "hash_index", dedupe.HashIndex())
+    monkeypatch.setattr(dedupe, "perceptual_index", dedupe.PerceptualIndex())
+    valores = iter(["10.00", "20.00", "30.00"])
+
+    async def extrair_dados_nota(documento, session):
+        return {"cnpj": "11222333000181", "data": "01/02/2025", "valor": next(valores),
+                "tipo_despesa": "ALIMENTACAO"}
+
+    monkeypatch.setattr(main, "extrair_dados_nota", extrair_dados_nota)
+
+    def _processar(nome: str, conteudo: bytes, save: bool):
+        async def executar():
+            async with sessoes() as session:
+                documento = UploadSpool.de_bytes(nome, "image/jpeg", conteudo)
+                return await main.processar_documento(documento, save, session)
+        return asyncio.run(executar())
+
+    return _processar
+
+
+@pytest.mark.parametrize("nome", EDICOES)
+def test_outra_nota_do_mesmo_modelo_e_gravada_e_sinalizada(processar, nome):
+    original = processar(nome, _imagem(nome), save=True)
+
+    editada = _imagem(nome, editada=True)
+    distancia = distancia_hamming(original.imagem_phash, gerar_hash_perceptual(io.BytesIO(editada)))
+    assert distancia <= dedupe.PHASH_DISTANCIA_MAXIMA
+
+    # /check devolve os dados extraídos desta nota, não os da nota parecida
+    conferida = processar(nome, editada, save=False)
+    assert conferida.id is None and conferida.valor_total == "20.00"
+    assert conferida.possivel_duplicada == original.id
+
+    gravada = processar(nome, editada, save=True)
+    assert gravada.id != original.id and gravada.valor_total == "30.00"
+    assert gravada.possivel_duplicada == original.id
+
+
+def test_mesmo_arquivo_continua_recusado(processar):
+    nome = "nota2.PNG"
+    original = processar(nome, _imagem(nome), save=True)
+    assert original.possivel_duplicada is None
+
+    with pytest.raises(HTTPException) as erro:
+        processar(nome, _imagem(nome), save=True)
+    assert erro.value.status_code == 400
+    assert processar(nome, _imagem(nome), save=False).id == original.id
@@ -0,0 +1,79 @@
+import io
+import itertools
+import os
+from pathlib import Path
+
+os.environ.setdefault("GOOGLE_API_KEY", "teste")
+
+import pytest
+from PIL import Image, ImageEnhance, ImageOps
+
+from app.dedupe import PHASH_DISTANCIA_MAXIMA
+from app.hash_util import PHASH_BITS, distancia_hamming, gerar_hash_perceptual
+
+NOTAS = Path(__file__).resolve().parent.parent / "notas-fiscais"
+RECIBOS = ["nota2.PNG", "nota3.PNG", "nota5.PNG", "nota6.PNG",
+           "talo-de-conta-de-luz-na-foto-talo-de-conta-de-luz-da-copel-P42A50.jpg"]
+
+
+def _abrir(nome: str) -> Image.Image:
+    return ImageOps.exif_transpose(Image.open(NOTAS / nome)).convert("RGB")
+
+
+def _jpeg(image: Image.Image, qualidade: int = 85) -> bytes:
+    saida = io.BytesIO()
+    image.save(saida, "JPEG", quality=qualidade)
+    return saida.getvalue()
+
+
+def _na_mesa(image: Image.Image) -> Image.Image:
+    """
+    Simula a foto da nota sobre uma mesa escura, fora do centro.
+    """
+    mesa = Image.new("RGB", (image.width + 200, image.height + 240), (45, 40, 35))
+    mesa.paste(image, (60, 90))
+    return mesa
+
+
+def _metade(image: Image.Image) -> Image.Image:
+    return image.resize((image.width // 2, image.height // 2), Image.LANCZOS)
+
+
+def _phash(dados: bytes) -> str:
+    return gerar_hash_perceptual(io.BytesIO(dados))
+
+
+# Variações de um mesmo recibo que devem ser reconhecidas
+TRANSFORMACOES = {
+    "recompressao": lambda im: _jpeg(im, 40),
+    "metade_da_resolucao": lambda im: _jpeg(_metade(im)),
+    "brilho": lambda im: _jpeg(ImageEnhance.Brightness(im).enhance(1.2)),
+    "margem_branca": lambda im: _jpeg(ImageOps.expand(im, border=max(im.size) // 20, fill=(255, 255, 255))),
+    "foto_na_mesa": lambda im: _jpeg(_na_mesa(im)),
+    "foto_na_mesa_reduzida": lambda im: _jpeg(_metade(_na_mesa(im)), 60),
+}
+
+
+@pytest.mark.parametrize("transformacao", TRANSFORMACOES)
+@pytest.mark.parametrize("nome", RECIBOS)
+def test_variacoes_do_mesmo_recibo_ficam_dentro_do_limite(nome, transformacao):
+    image = _abrir(nome)
+    original = _phash(_jpeg(image, 95))
+    variacao = _phash(TRANSFORMACOES[transformacao](image))
+    assert distancia_hamming(original, variacao) <= PHASH_DISTANCIA_MAXIMA
+
+
+def test_notas_diferentes_ficam_fora_do_limite():
+    hashes = [_phash(_jpeg(_abrir(arquivo.name), 95)) for arquivo in sorted(NOTAS.iterdir())]
+    for a, b in itertools.combinations(hashes, 2):
+        assert distancia_hamming(a, b) > 2 * PHASH_DISTANCIA_MAXIMA
+
+
+def test_hash_tem_tamanho_fixo():
+    phash = _phash(_jpeg(_abrir(RECIBOS[0])))
+    assert len(phash) == (PHASH_BITS + 3) // 4
+    assert int(phash, 16) < 2 ** PHASH_BITS
+
+
+def test_arquivo_que_nao_e_imagem_nao_tem_hash():
+    assert gerar_hash_perceptual(io.BytesIO(b"%PDF-1.4 nao e imagem")) is None
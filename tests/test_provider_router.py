@@ -0,0 +1,84 @@
+import asyncio
+import os
+
+os.environ.setdefault("GOOGLE_API_KEY", "teste")
+
+import pytest
+from fastapi import HTTPException
+
+import app.provider_router as router_module
+import app.scheduler as scheduler_module
+from app.provider_router import GeminiProvider, ProviderRouter, StubProvider
+from app.scheduler import RateScheduler
+
+
+class GeminiInstantaneo(GeminiProvider):
+    """
+    Gemini que responde na hora: só a fila do agendador pode atrasar a chamada.
+    """
+
+    async def _gerar(self, partes: list) -> str:
+        return '{"cnpj": null}'
+
+
+@pytest.fixture
+def agendador_lento(monkeypatch):
+    # 1 requisição por minuto e fila de no máximo 0,3 s: só a primeira chamada passa
+    agendador = RateScheduler("teste", 1, 0)
+    monkeypatch.setattr(router_module, "gemini_scheduler", agendador)
+    monkeypatch.setattr(scheduler_module, "AGENDADOR_MAX_ESPERA_SECONDS", 0.3)
+    return agendador
+
+
+async def _chamar_varias(router: ProviderRouter, quantidade: int) -> list:
+    return await asyncio.gather(
+        *[router.gerar(["prompt"]) for _ in range(quantidade)], return_exceptions=True)
+
+
+def test_fila_do_agendador_nao_abre_o_circuito(agendador_lento, monkeypatch):
+    monkeypatch.setattr(router_module, "ROUTER_HEDGE_ENABLED", False)
+    router = ProviderRouter([GeminiInstantaneo()], ["gemini"])
+
+    resultados = asyncio.run(_chamar_varias(router, 8))
+
+    sucessos = [r for r in resultados if not isinstance(r, BaseException)]
+    recusas = [r for r in resultados if isinstance(r, HTTPException)]
+    assert len(sucessos) == 1
+    assert len(recusas) == 7 and all(r.status_code == 503 for r in recusas)
+
+    metricas = router.stats["gemini"].metrics()
+    assert metricas["falhas"] == 0
+    assert metricas["taxa_erro"] == 0.0
+    assert metricas["circuito"] == "FECHADO"
+
+
+def test_fila_do_agendador_nao_dispara_hedge(agendador_lento, monkeypatch):
+    monkeypatch.setattr(router_module, "ROUTER_HEDGE_ENABLED", True)
+    monkeypatch.setattr(router_module, "ROUTER_HEDGE_SECONDS", 0.05)
+    router = ProviderRouter([GeminiInstantaneo(), StubProvider()], ["gemini", "stub"])
+
+    asyncio.run(_chamar_varias(router, 8))
+
+    assert router.hedges == 0
+    assert router.stats["stub"].chamadas == 0
+    assert router.stats["gemini"].metrics()["p95_ms"] < 50
+
+
+def test_sonda_cancelada_antes_de_comecar_libera_o_circuito():
+    router = ProviderRouter([StubProvider()], ["stub"])
+    provedor, stats = router.provedores["stub"], router.stats["stub"]
+    stats.falhas_seguidas = router_module.CIRCUIT_FALHAS
+    assert stats.circuito == "SEMIABERTO"
+
+    async def cancelar_logo():
+        assert stats.permitir()
+        chamada = router._criar_chamada(provedor, ["prompt"], asyncio.Event())
+        # Cancelada antes do primeiro passo: o corpo de _chamar não executa
+        chamada.cancel()
+        await asyncio.gather(chamada, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    asyncio.run(cancelar_logo())
+
+    assert not stats.sondando
+    assert stats.permitir()